@@ -0,0 +1,291 @@
+/*
+ * libwapiti.c: a minimal in-process interface to Wapiti, used by
+ * sem/libwapiti.py through ctypes.
+ *
+ * It is compiled with the sources of Wapiti (except wapiti.c, which holds
+ * the command line driver) into a shared library, see setup.py. Wapiti
+ * reports errors by calling exit, which would kill the python interpreter:
+ * its sources are compiled with -Dexit=sem_wapiti_exit so that errors jump
+ * back to the interface function that was called, which then returns an
+ * error code. Memory allocated before the error is lost.
+ *
+ * MIT License
+ *
+ * Copyright (c) 2018 Yoann Dupont
+ *
+ * Permission is hereby granted, free of charge, to any person obtaining a copy
+ * of this software and associated documentation files (the "Software"), to deal
+ * in the Software without restriction, including without limitation the rights
+ * to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ * copies of the Software, and to permit persons to whom the Software is
+ * furnished to do so, subject to the following conditions:
+ *
+ * The above copyright notice and this permission notice shall be included in all
+ * copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ * IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ * FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ * AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ * LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ * OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+ * SOFTWARE.
+ */
+
+#include <setjmp.h>
+#include <stdbool.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+#include "wapiti.h"
+#include "decoder.h"
+#include "model.h"
+#include "options.h"
+#include "progress.h"
+#include "quark.h"
+#include "reader.h"
+#include "sequence.h"
+#include "tools.h"
+#include "trainers.h"
+
+/* The jump point of the interface function running in the current thread,
+ * NULL outside of them (eg: in training threads spawned by Wapiti).
+ */
+static __thread jmp_buf *sem_wapiti_jump = NULL;
+
+void sem_wapiti_exit(int status) {
+	(void)status;
+	if (sem_wapiti_jump != NULL)
+		longjmp(*sem_wapiti_jump, 1);
+	abort();
+}
+
+static const char *sem_wapiti_types[] = {"maxent", "memm", "crf"};
+
+static const struct {
+	char *name;
+	void (* train)(mdl_t *mdl);
+} sem_wapiti_trainers[] = {
+	{"l-bfgs", trn_lbfgs},
+	{"sgd-l1", trn_sgdl1},
+	{"bcd",    trn_bcd  },
+	{"rprop",  trn_rprop},
+	{"rprop+", trn_rprop},
+	{"rprop-", trn_rprop},
+};
+
+/* train_args_t:
+ *   The arguments of sem_wapiti_train.
+ */
+typedef struct {
+	uint32_t     N;
+	const uint32_t *lens;
+	const char **lines;
+	const char  *pattern, *type, *algo;
+	uint32_t     maxiter;
+	double       rho1, rho2;
+	uint32_t     nthread;
+	int          compact;
+} train_args_t;
+
+static mdl_t *sem_wapiti_new(void) {
+	opt_t *opt = xmalloc(sizeof(opt_t));
+	*opt = opt_defaults;
+	mdl_t *mdl = mdl_new(rdr_new(opt->maxent));
+	mdl->opt = opt;
+	return mdl;
+}
+
+/* sem_wapiti_raw:
+ *   Returns the raw sequence of T lines, which are not copied.
+ */
+static raw_t *sem_wapiti_raw(uint32_t T, const char **lines) {
+	raw_t *raw = xmalloc(sizeof(raw_t) + sizeof(char *) * T);
+	raw->len = T;
+	memcpy(raw->lines, lines, sizeof(char *) * T);
+	return raw;
+}
+
+static mdl_t *do_load(FILE *file) {
+	mdl_t *mdl = sem_wapiti_new();
+	mdl_load(mdl, file);
+	return mdl;
+}
+
+static void do_label(mdl_t *mdl, uint32_t N, const uint32_t *lens, const char **lines, uint32_t *out) {
+	for (uint32_t n = 0; n < N; n++) {
+		const uint32_t T = lens[n];
+		if (T != 0) {
+			raw_t *raw = sem_wapiti_raw(T, lines);
+			seq_t *seq = rdr_raw2seq(mdl->reader, raw, false);
+			double score;
+			double *psc = xmalloc(sizeof(double) * T);
+			tag_viterbi(mdl, seq, out, &score, psc);
+			free(psc);
+			rdr_freeseq(seq);
+			free(raw);
+		}
+		lines += T;
+		out += T;
+	}
+}
+
+static mdl_t *do_train(const train_args_t *args) {
+	mdl_t *mdl = sem_wapiti_new();
+	opt_t *opt = mdl->opt;
+	opt->maxiter = args->maxiter;
+	opt->rho1 = args->rho1;
+	opt->rho2 = args->rho2;
+	opt->nthread = (args->nthread == 0 ? 1 : args->nthread);
+	opt->compact = (args->compact != 0);
+
+	uint32_t typ, trn;
+	const uint32_t ntyp = sizeof(sem_wapiti_types) / sizeof(sem_wapiti_types[0]);
+	const uint32_t ntrn = sizeof(sem_wapiti_trainers) / sizeof(sem_wapiti_trainers[0]);
+	for (typ = 0; typ < ntyp; typ++)
+		if (!strcmp(args->type, sem_wapiti_types[typ]))
+			break;
+	if (typ == ntyp)
+		fatal("unknown model type '%s'", args->type);
+	mdl->type = typ;
+	for (trn = 0; trn < ntrn; trn++)
+		if (!strcmp(args->algo, sem_wapiti_trainers[trn].name))
+			break;
+	if (trn == ntrn)
+		fatal("unknown algorithm '%s'", args->algo);
+	opt->algo = sem_wapiti_trainers[trn].name;
+
+	if (args->pattern != NULL) {
+		FILE *file = fopen(args->pattern, "r");
+		if (file == NULL)
+			pfatal("cannot open pattern file");
+		rdr_loadpat(mdl->reader, file);
+		fclose(file);
+		qrk_lock(mdl->reader->obs, false);
+	}
+
+	const char **lines = args->lines;
+	dat_t *dat = xmalloc(sizeof(dat_t));
+	dat->lbl = true;
+	dat->mlen = 0;
+	dat->nseq = 0;
+	dat->seq = xmalloc(sizeof(seq_t *) * (args->N == 0 ? 1 : args->N));
+	for (uint32_t n = 0; n < args->N; n++) {
+		const uint32_t T = args->lens[n];
+		if (T != 0) {
+			raw_t *raw = sem_wapiti_raw(T, lines);
+			dat->seq[dat->nseq++] = rdr_raw2seq(mdl->reader, raw, true);
+			dat->mlen = max(dat->mlen, T);
+			free(raw);
+		}
+		lines += T;
+	}
+	mdl->train = dat;
+	if (dat->nseq == 0)
+		fatal("no train data loaded");
+	qrk_lock(mdl->reader->lbl, true);
+	qrk_lock(mdl->reader->obs, true);
+
+	// uit_setup is not called, it would replace the SIGINT handler of the
+	// caller.
+	mdl_sync(mdl);
+	gettimeofday(&mdl->timer, NULL);
+	if (opt->stopwin != 0)
+		mdl->werr = xmalloc(sizeof(double) * opt->stopwin);
+	mdl->wcnt = mdl->wpos = 0;
+	sem_wapiti_trainers[trn].train(mdl);
+	if (opt->compact)
+		mdl_compact(mdl);
+	rdr_freedat(mdl->train);
+	mdl->train = NULL;
+	return mdl;
+}
+
+/*******************************************************************************
+ * Interface
+ ******************************************************************************/
+
+/* sem_wapiti_load:
+ *   Loads the model in filename, returns NULL on error.
+ */
+void *sem_wapiti_load(const char *filename) {
+	FILE *file = fopen(filename, "r");
+	if (file == NULL)
+		return NULL;
+	jmp_buf env;
+	mdl_t *mdl = NULL;
+	if (setjmp(env) == 0) {
+		sem_wapiti_jump = &env;
+		mdl = do_load(file);
+	}
+	sem_wapiti_jump = NULL;
+	fclose(file);
+	return mdl;
+}
+
+/* sem_wapiti_save:
+ *   Saves the model in filename, returns 0 on success.
+ */
+int sem_wapiti_save(void *model, const char *filename) {
+	FILE *file = fopen(filename, "w");
+	if (file == NULL)
+		return -1;
+	mdl_save((mdl_t *)model, file);
+	return fclose(file);
+}
+
+void sem_wapiti_free(void *model) {
+	mdl_t *mdl = model;
+	opt_t *opt = mdl->opt;
+	mdl_free(mdl);
+	free(opt);
+}
+
+uint32_t sem_wapiti_nlabels(void *model) {
+	return ((mdl_t *)model)->nlbl;
+}
+
+const char *sem_wapiti_label_name(void *model, uint32_t label) {
+	return qrk_id2str(((mdl_t *)model)->reader->lbl, label);
+}
+
+/* sem_wapiti_label:
+ *   Labels N sequences with Viterbi. Sequence n is made of lens[n] lines,
+ *   lines of all sequences being given one after the other, each line
+ *   holding the columns of a token separated by tabulations. The label of
+ *   every line is written in out. Returns 0 on success.
+ */
+int sem_wapiti_label(void *model, uint32_t N, const uint32_t *lens, const char **lines, uint32_t *out) {
+	jmp_buf env;
+	if (setjmp(env) != 0) {
+		sem_wapiti_jump = NULL;
+		return -1;
+	}
+	sem_wapiti_jump = &env;
+	do_label(model, N, lens, lines, out);
+	sem_wapiti_jump = NULL;
+	return 0;
+}
+
+/* sem_wapiti_train:
+ *   Trains a new model on N labeled sequences, given as in sem_wapiti_label
+ *   with the label as last column. pattern is the pattern file to use, if
+ *   any. Returns the model or NULL on error.
+ */
+void *sem_wapiti_train(uint32_t N, const uint32_t *lens, const char **lines,
+                       const char *pattern, const char *type, const char *algo,
+                       uint32_t maxiter, double rho1, double rho2,
+                       uint32_t nthread, int compact) {
+	const train_args_t args = {N, lens, lines, pattern, type, algo, maxiter,
+	                           rho1, rho2, nthread, compact};
+	jmp_buf env;
+	mdl_t *mdl = NULL;
+	if (setjmp(env) == 0) {
+		sem_wapiti_jump = &env;
+		mdl = do_train(&args);
+	}
+	sem_wapiti_jump = NULL;
+	return mdl;
+}
@@ -0,0 +1,319 @@
+#-*- coding: utf-8 -*-
+
+"""
+file: binary.py
+
+Description: a binary, memory-mappable storage format for CRF models.
+
+author: Yoann Dupont
+
+MIT License
+
+Copyright (c) 2018 Yoann Dupont
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+A binary model file is made of:
+    - an 8 bytes magic string;
+    - the size of the header, as a little endian unsigned 64 bits integer;
+    - a JSON header describing the model and the location of its sections;
+    - the sections themselves, each one aligned on 8 bytes.
+
+Sections are raw little endian arrays. String lists (labels, templates and
+observations) are stored as two sections: "<name>.data" holds the strings
+separated by newlines and "<name>.offsets" holds the int64 byte offset of
+every string in data, plus the total size, so that any string can be read
+without decoding the others. Unicode strings are encoded in utf-8, byte
+strings (models loaded without an encoding, as annotators do) are stored as
+they are: the "encodings" header key gives, for every string list, "utf-8"
+or null for byte strings.
+Weights are stored as they are in memory, so loading a model amounts to
+mapping the file and creating views over the weight and offset sections.
+int8 quantized weights have an additional "scales" section, the size of
+their blocks is given by the "block_size" header key.
+If numpy is installed, the sorted hashes of observations and their ids are
+stored in the "observations.hashes" and "observations.ids" sections (see
+sem.CRF.observations). Hashes only depend on the bytes of observations, so
+they are valid for any interpreter. Version 1 files stored hashes that
+depended on the interpreter, they are computed again from observations.
+Unknown header keys and sections are ignored by the reader, which allows new
+sections to be added without breaking older files.
+"""
+
+import array
+import json
+import mmap
+import struct
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from sem.coder import Coder
+from sem.CRF.model import Model, QuantizedWeights
+from sem.CRF.observations import HashedObservations
+from sem.CRF.template import ListPattern
+
+MAGIC = b"SEMCRF\x00\x01"
+VERSION = 2
+ALIGNMENT = 8
+
+_header_size = struct.Struct("<Q")
+
+# section type -> size in bytes
+_itemsizes = {u"bytes": 1, u"int8": 1, u"int32": 4, u"int64": 8, u"float16": 2, u"float32": 4, u"float64": 8}
+
+# section type -> struct format character, for types writable without numpy
+_formats = {u"bytes": "B", u"int32": "i", u"int64": "q", u"float32": "f", u"float64": "d"}
+
+# section types readable without numpy, their format is also an array typecode
+_array_types = (u"bytes", u"int32", u"float32", u"float64")
+
+def is_binary_model(filename):
+    """
+    Tells whether filename is a binary model by looking at its first bytes.
+    """
+    with open(filename, "rb") as fd:
+        return fd.read(len(MAGIC)) == MAGIC
+
+def _padding(position):
+    return (ALIGNMENT - position % ALIGNMENT) % ALIGNMENT
+
+def _string_sections(strings):
+    """
+    Returns the data and offsets sections of a list of strings, and their
+    encoding: None if there are byte strings, which are stored as they
+    are, "utf-8" otherwise.
+    """
+    encoding = (None if any(isinstance(s, str) for s in strings) else u"utf-8")
+    encoded = [(s.encode("utf-8") if isinstance(s, unicode) else s) for s in strings]
+    offsets = [0]
+    for s in encoded:
+        offsets.append(offsets[-1] + len(s) + 1)
+    return b"\n".join(encoded) + (b"\n" if encoded else b""), _to_bytes(offsets, u"int64"), encoding
+
+def _to_bytes(values, dtype):
+    """
+    Returns the little endian raw bytes of a list or buffer of numbers.
+    """
+    if numpy is not None:
+        return numpy.asarray(values, dtype=numpy.dtype(str(dtype)).newbyteorder("<")).tostring()
+    return struct.pack("<%i%s" %(len(values), _formats[dtype]), *values)
+
+def write_binary(model, filename):
+    """
+    Writes model to filename in binary format.
+    """
+    weights = model.weights
+    if isinstance(weights, QuantizedWeights):
+        dtype = u"int8"
+        weights = weights.values
+    elif numpy is not None and isinstance(weights, numpy.ndarray):
+        dtype = unicode(model.weights.dtype.name)
+    elif isinstance(model.weights, array.array) and model.weights.typecode == "f":
+        dtype = u"float32"
+    else:
+        dtype = u"float64"
+
+    sections = []
+    encodings = {}
+    for name, strings in [(u"labels", model.tagset), (u"templates", [unicode(t) for t in model.templates]), (u"observations", model.observations)]:
+        data, offsets, encodings[name] = _string_sections(list(strings))
+        sections.append((name + u".data", u"bytes", len(data), data))
+        sections.append((name + u".offsets", u"int64", len(offsets) // 8, offsets))
+    if numpy is not None:
+        if isinstance(model.observations, HashedObservations):
+            index = model.observations
+        else:
+            index = HashedObservations.from_strings(list(model.observations))
+        sections.append((u"observations.hashes", u"int64", len(index.hashes), _to_bytes(index.hashes, u"int64")))
+        sections.append((u"observations.ids", u"int32", len(index.ids), _to_bytes(index.ids, u"int32")))
+    sections.append((u"uoff", u"int32", len(model.uoff), _to_bytes(model.uoff, u"int32")))
+    sections.append((u"boff", u"int32", len(model.boff), _to_bytes(model.boff, u"int32")))
+    sections.append((u"weights", dtype, len(weights), _to_bytes(weights, dtype)))
+    if isinstance(model.weights, QuantizedWeights):
+        sections.append((u"scales", u"float32", len(model.weights.scales), _to_bytes(model.weights.scales, u"float32")))
+
+    # offsets are relative to the first section, so that the header does not
+    # have to know its own size.
+    header = {u"version": VERSION, u"max_col": model._max_col, u"dtype": dtype, u"encodings": encodings, u"sections": {}}
+    if isinstance(model.weights, QuantizedWeights):
+        header[u"block_size"] = model.weights.block_size
+    position = 0
+    for name, kind, count, data in sections:
+        header[u"sections"][name] = {u"type": kind, u"offset": position, u"count": count}
+        position += len(data) + _padding(len(data))
+    header = json.dumps(header, sort_keys=True).encode("utf-8")
+    header += b" " * _padding(len(MAGIC) + _header_size.size + len(header))
+
+    with open(filename, "wb") as O:
+        O.write(MAGIC)
+        O.write(_header_size.pack(len(header)))
+        O.write(header)
+        for name, kind, count, data in sections:
+            O.write(data)
+            O.write(b"\x00" * _padding(len(data)))
+
+class _Sections(object):
+    """
+    Read access to the sections of a mapped binary model.
+    """
+    def __init__(self, buf, start, header):
+        self._buf = buf
+        self._start = start
+        self._sections = header[u"sections"]
+        self._encodings = header.get(u"encodings", {})
+
+    def __contains__(self, name):
+        return name in self._sections
+
+    def bytes(self, name):
+        section = self._sections[name]
+        begin = self._start + section[u"offset"]
+        return self._buf[begin : begin + section[u"count"] * _itemsizes[section[u"type"]]]
+
+    def array(self, name):
+        """
+        Returns the section as a read-only numpy view of the mapped file if
+        numpy is installed, as an array.array copy otherwise. int8, int64 and
+        float16 sections are only available with numpy.
+        """
+        section = self._sections[name]
+        kind = section[u"type"]
+        if numpy is None and kind not in _array_types:
+            raise ValueError(u"%s sections require numpy" %kind)
+        if numpy is not None:
+            return numpy.frombuffer(self._buf, dtype=numpy.dtype(str(kind)).newbyteorder("<"), count=section[u"count"], offset=self._start + section[u"offset"])
+        buf = array.array(_formats[kind])
+        buf.fromstring(self.bytes(name))
+        if sys.byteorder != "little":
+            buf.byteswap()
+        return buf
+
+    def encoding(self, name):
+        """
+        The encoding of a string list, None for byte strings.
+        """
+        return self._encodings.get(name, u"utf-8")
+
+    def strings(self, name):
+        data = self.bytes(name + u".data")
+        if not data:
+            return []
+        data = data[:-1]
+        if self.encoding(name) is not None:
+            data = data.decode(self.encoding(name))
+        return data.split(b"\n")
+
+    def mapped_strings(self, name):
+        section = self._sections[name + u".data"]
+        return _MappedStrings(self._buf, self._start + section[u"offset"], self.array(name + u".offsets"), self.encoding(name))
+
+class _MappedStrings(object):
+    """
+    The strings of a mapped section, decoded when accessed (unless they
+    are byte strings). Requires numpy.
+    """
+    def __init__(self, buf, start, offsets, encoding=u"utf-8"):
+        self._buf = buf
+        self._start = start
+        self._offsets = offsets
+        self._encoding = encoding
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        begin = self._start + int(self._offsets[index])
+        end = self._start + int(self._offsets[index+1]) - 1
+        data = self._buf[begin : end]
+        return (data.decode(self._encoding) if self._encoding is not None else data)
+
+    def __iter__(self):
+        if len(self) == 0:
+            return iter([])
+        data = self._buf[self._start : self._start + int(self._offsets[-1]) - 1]
+        if self._encoding is not None:
+            data = data.decode(self._encoding)
+        return iter(data.split(b"\n"))
+
+def read_binary(filename, backend=None, observation_index=None, verify_hashes=False):
+    """
+    Loads a binary model. The file is mapped in memory and, if numpy is
+    installed, weights and offsets are read-only views of the mapping, so
+    that processes loading the same model share its pages.
+    
+    observation_index is either "coder" (a dictionary of observation
+    strings) or "hashed" (see sem.CRF.observations), the default being
+    "hashed" if numpy is installed. Hashed observations are read from the
+    file, their strings are decoded only when needed. If verify_hashes is
+    True, the string of every observation found by hash is checked.
+    """
+    with open(filename, "rb") as fd:
+        buf = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    if buf[: len(MAGIC)] != MAGIC:
+        raise ValueError(u"not a binary model: %s" %filename)
+    return _read_buffer(buf, backend=backend, observation_index=observation_index, verify_hashes=verify_hashes)
+
+def loads_binary(data, backend=None, observation_index=None, verify_hashes=False):
+    """
+    Loads a binary model from a string, which the model then refers to
+    instead of a mapped file (see read_binary for the other arguments).
+    """
+    if data[: len(MAGIC)] != MAGIC:
+        raise ValueError(u"not a binary model")
+    return _read_buffer(data, backend=backend, observation_index=observation_index, verify_hashes=verify_hashes)
+
+def _read_buffer(buf, backend=None, observation_index=None, verify_hashes=False):
+    size, = _header_size.unpack(buf[len(MAGIC) : len(MAGIC) + _header_size.size])
+    start = len(MAGIC) + _header_size.size
+    header = json.loads(buf[start : start + size].decode("utf-8"))
+    if header[u"version"] > VERSION:
+        raise ValueError(u"unsupported binary model version: %s (max: %s)" %(header[u"version"], VERSION))
+    sections = _Sections(buf, start + size, header)
+
+    model = Model(backend=backend)
+    model._max_col = header[u"max_col"]
+    model._tagset = Coder.fromlist(sections.strings(u"labels"))
+    model._templates = [ListPattern.from_string(template) for template in sections.strings(u"templates")]
+    if observation_index is None:
+        observation_index = (u"hashed" if numpy is not None else u"coder")
+    if observation_index == u"hashed":
+        strings = (sections.mapped_strings(u"observations") if numpy is not None else None)
+        if u"observations.hashes" in sections and header[u"version"] >= 2:
+            model._observations = HashedObservations(sections.array(u"observations.hashes"), sections.array(u"observations.ids"), strings, verify=verify_hashes)
+        else:
+            model._observations = HashedObservations.from_strings(strings, verify=verify_hashes)
+    elif observation_index == u"coder":
+        model._observations = Coder.fromlist(sections.strings(u"observations"))
+    else:
+        raise ValueError(u"unknown observation index: %s (available: coder, hashed)" %observation_index)
+    model._uoff = sections.array(u"uoff")
+    model._boff = sections.array(u"boff")
+    model._weights = sections.array(u"weights")
+    if u"scales" in sections:
+        model._weights = QuantizedWeights(model._weights, sections.array(u"scales"), header[u"block_size"])
+    if numpy is None:
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+    else:
+        model._mapping = buf # keeps the file mapped as long as the model lives
+    return model
@@ -0,0 +1,132 @@
+#-*- coding: utf-8 -*-
+
+"""
+file: cache.py
+
+Description: a bounded LRU cache of decoded sentences, so that sentences
+seen many times (bylines, copyright notices...) are decoded only once.
+
+author: Yoann Dupont
+
+MIT License
+
+Copyright (c) 2018 Yoann Dupont
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import collections
+import sys
+import threading
+
+def entry_size(key, value):
+    """
+    An estimate of the number of bytes used by a cache entry, made of the
+    sizes of its strings and of the lists holding them.
+    """
+    size = sys.getsizeof(key) + sys.getsizeof(value)
+    for part in (key, value):
+        for item in part:
+            if isinstance(item, (tuple, list)):
+                size += sys.getsizeof(item)
+                for element in item:
+                    if isinstance(element, (tuple, list)):
+                        size += sys.getsizeof(element) + sum(sys.getsizeof(column) for column in element)
+                    else:
+                        size += sys.getsizeof(element)
+            else:
+                size += sys.getsizeof(item)
+    return size
+
+class DecodeCache(object):
+    """
+    Maps keys (see Model.cache_key) to decoding results, evicting the
+    least recently used entries beyond max_entries entries or max_bytes
+    bytes (None for no limit, sizes being estimated by entry_size).
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=None):
+        self._max_entries = (int(max_entries) if max_entries is not None else None)
+        self._max_bytes = (int(max_bytes) if max_bytes is not None else None)
+        self._entries = collections.OrderedDict() # least recently used first
+        self._sizes = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Returns the value of key, None if it is not in the cache.
+        """
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            size = entry_size(key, value)
+            if self._max_bytes is not None and size > self._max_bytes:
+                return
+            self._entries[key] = value
+            self._sizes[key] = size
+            self._bytes += size
+            while (self._max_entries is not None and len(self._entries) > self._max_entries) or (self._max_bytes is not None and self._bytes > self._max_bytes):
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """
+        Returns the number of hits and misses, the hit rate, the number of
+        evictions and the number of entries and bytes in the cache.
+        """
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                u"hits": self._hits,
+                u"misses": self._misses,
+                u"hit_rate": (float(self._hits) / lookups if lookups else 0.0),
+                u"evictions": self._evictions,
+                u"entries": len(self._entries),
+                u"bytes": self._bytes,
+                u"max_entries": self._max_entries,
+                u"max_bytes": self._max_bytes
+            }
+
+    def _remove(self, key):
+        del self._entries[key]
+        self._bytes -= self._sizes.pop(key)
@@ -0,0 +1,219 @@
+#-*- coding: utf-8 -*-
+
+"""
+file: constraints.py
+
+Description: constraints on the transitions between labels, used to forbid
+invalid label sequences when tagging.
+
+author: Yoann Dupont
+
+MIT License
+
+Copyright (c) 2018 Yoann Dupont
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import codecs
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SCHEMES = (u"BIO", u"BIOES", u"underscore")
+
+# BIOES flags, BILOU ones are handled as their equivalent
+_BEGIN = u"B"
+_IN = u"I"
+_END = u"EL"
+_SINGLE = u"SU"
+_OUT = u"O"
+
+def _split(tag):
+    """
+    Returns the flag and the type of a BIO/BIOES tag.
+    """
+    if tag == _OUT:
+        return _OUT, None
+    return tag[0], tag[2:]
+
+def guess_scheme(tags):
+    """
+    Returns the tagging scheme of a tagset: "BIO" or "BIOES" for chunking
+    (BILOU being handled as BIOES), "underscore" for SEM POS tagging, where
+    "_X" continues a multiword "X", or None if no scheme is recognized.
+    """
+    tags = list(tags)
+    if tags and all(tag == _OUT or (len(tag) > 2 and tag[1] == u"-" and tag[0] in _BEGIN + _IN + _END + _SINGLE) for tag in tags):
+        if any(tag[0] in _END + _SINGLE for tag in tags if tag != _OUT):
+            return u"BIOES"
+        return u"BIO"
+    if any(tag.startswith(u"_") for tag in tags):
+        return u"underscore"
+    return None
+
+def scheme_transitions(tags, scheme):
+    """
+    Returns the allowed transitions of a scheme as a set of (previous, next)
+    label pairs, along with the sets of labels allowed at the beginning and
+    at the end of a sentence.
+    """
+    if scheme not in SCHEMES:
+        raise ValueError(u"unknown tagging scheme: %s (available: %s)" %(scheme, u", ".join(SCHEMES)))
+
+    tags = list(tags)
+    allowed = set()
+    if scheme == u"underscore":
+        for previous in tags:
+            for tag in tags:
+                if not tag.startswith(u"_") or previous.lstrip(u"_") == tag[1:]:
+                    allowed.add((previous, tag))
+        first = set(tag for tag in tags if not tag.startswith(u"_"))
+        return allowed, first, set(tags)
+
+    for previous in tags:
+        pflag, ptype = _split(previous)
+        # whether previous opens a chunk that still has to be continued
+        opened = (pflag in _BEGIN + _IN) and scheme == u"BIOES"
+        for tag in tags:
+            flag, ttype = _split(tag)
+            if flag in _IN + _END:
+                ok = (pflag in _BEGIN + _IN and ptype == ttype)
+            else:
+                ok = not opened
+            if ok:
+                allowed.add((previous, tag))
+    first = set(tag for tag in tags if _split(tag)[0] not in _IN + _END)
+    if scheme == u"BIOES":
+        last = set(tag for tag in tags if _split(tag)[0] not in _BEGIN + _IN)
+    else:
+        last = set(tags)
+    return allowed, first, last
+
+class Constraints(object):
+    """
+    The allowed transitions between the labels of a model, as well as the
+    labels allowed at the beginning and at the end of a sentence.
+
+    For every label y, predecessors[y] is the list of labels (as indices in
+    tags) that may precede it. numpy backends use masks instead, where
+    forbidden transitions are -inf.
+    """
+
+    def __init__(self, tags, allowed, first=None, last=None):
+        self._tags = list(tags)
+        Y = len(self._tags)
+        self._allowed = [[(self._tags[yp], self._tags[y]) in allowed for y in range(Y)] for yp in range(Y)]
+        self._predecessors = [[yp for yp in range(Y) if self._allowed[yp][y]] for y in range(Y)]
+        self._first = [first is None or tag in first for tag in self._tags]
+        self._last = [last is None or tag in last for tag in self._tags]
+        self._masks = None
+
+    @classmethod
+    def from_scheme(cls, tags, scheme=None):
+        """
+        Constraints of a tagging scheme, guessed from tags if None.
+        """
+        tags = list(tags)
+        if scheme is None:
+            scheme = guess_scheme(tags)
+            if scheme is None:
+                raise ValueError(u"could not guess the tagging scheme of: %s" %(u", ".join(tags)))
+        allowed, first, last = scheme_transitions(tags, scheme)
+        return cls(tags, allowed, first=first, last=last)
+
+    @classmethod
+    def from_whitelist(cls, tags, filename, encoding="utf-8"):
+        """
+        Constraints read from a file with one allowed transition per line:
+        the previous and the next labels separated by whitespaces. A line
+        with "^" as previous label (resp. "$" as next label) allows a label
+        to begin (resp. end) a sentence. If there is no such line, every
+        label may begin (resp. end) a sentence.
+        """
+        allowed = set()
+        first = set()
+        last = set()
+        with codecs.open(filename, "rU", encoding) as input_stream:
+            for line in input_stream:
+                line = line.strip()
+                if not line or line.startswith(u"#"):
+                    continue
+                previous, tag = line.split()
+                if previous == u"^":
+                    first.add(tag)
+                elif tag == u"$":
+                    last.add(previous)
+                else:
+                    allowed.add((previous, tag))
+        return cls(tags, allowed, first=(first or None), last=(last or None))
+
+    @property
+    def tags(self):
+        return self._tags
+
+    @property
+    def transitions(self):
+        """
+        The Y*Y matrix of allowed transitions: transitions[yp][y] tells
+        whether label y may follow label yp.
+        """
+        return self._allowed
+
+    @property
+    def predecessors(self):
+        return self._predecessors
+
+    @property
+    def first(self):
+        return self._first
+
+    @property
+    def last(self):
+        return self._last
+
+    def allowed(self, previous, tag):
+        return self._allowed[self._tags.index(previous)][self._tags.index(tag)]
+
+    def is_valid(self, tags):
+        """
+        Tells whether a sequence of labels respects the constraints.
+        """
+        indices = [self._tags.index(tag) for tag in tags]
+        if not indices:
+            return True
+        if not (self._first[indices[0]] and self._last[indices[-1]]):
+            return False
+        return all(self._allowed[yp][y] for yp, y in zip(indices, indices[1:]))
+
+    def masks(self):
+        """
+        Returns the transition (Y*Y), first and last (Y) masks, where
+        allowed values are 0 and forbidden ones -inf. Requires numpy.
+        """
+        if self._masks is None:
+            inf = float("-inf")
+            self._masks = (
+                numpy.where(numpy.array(self._allowed, dtype=bool).reshape((len(self._tags), len(self._tags))), 0.0, inf),
+                numpy.where(numpy.array(self._first, dtype=bool), 0.0, inf),
+                numpy.where(numpy.array(self._last, dtype=bool), 0.0, inf)
+            )
+        return self._masks
@@ -0,0 +1,100 @@
+#-*- coding: utf-8 -*-
+
+"""
+file: lexicon.py
+
+Description: a form -> labels index used to restrict the labels a token may
+take when tagging.
+
+author: Yoann Dupont
+
+MIT License
+
+Copyright (c) 2018 Yoann Dupont
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import codecs
+import os.path
+
+class Lexicon(object):
+    """
+    The labels every known form may take. A form is looked up as is and
+    lowercased, so that capitalized words at the beginning of sentences are
+    found. Unknown forms have no candidates, they may take any label.
+    """
+
+    def __init__(self, entries=None):
+        self._entries = {}
+        for form, labels in (entries or {}).items():
+            for label in labels:
+                self.add(form, label)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, form):
+        return self.candidates(form) is not None
+
+    def add(self, form, label):
+        self._entries.setdefault(form, set()).add(label)
+
+    @classmethod
+    def from_directory(cls, directory, encoding="utf-8"):
+        """
+        Reads a lexicon from a directory with one file per label, each
+        file containing one form per line (the layout of Lefff
+        dictionaries in resources/dictionaries/fr/lefff).
+        """
+        lexicon = cls()
+        for label in sorted(os.listdir(directory)):
+            filename = os.path.join(directory, label)
+            if not os.path.isfile(filename):
+                continue
+            if not isinstance(label, unicode):
+                label = label.decode("utf-8")
+            with codecs.open(filename, "rU", encoding) as input_stream:
+                for line in input_stream:
+                    form = line.strip()
+                    if form:
+                        lexicon.add(form, label)
+        return lexicon
+
+    def candidates(self, form, continuations=False):
+        """
+        Returns the set of labels form may take, or None if it is unknown.
+        If continuations is True, the "_" continuation of every label is
+        added (see sem.CRF.constraints).
+        """
+        labels = self._entries.get(form)
+        lower = form.lower()
+        if lower != form and lower in self._entries:
+            labels = (labels or set()) | self._entries[lower]
+        if labels is None:
+            return None
+        if continuations:
+            labels = labels | set(u"_" + label for label in labels)
+        return labels
+
+    def sentence_candidates(self, forms, continuations=False):
+        """
+        Returns the candidates of every form of a sentence.
+        """
+        return [self.candidates(form, continuations=continuations) for form in forms]
@@ -29,26 +29,259 @@ SOFTWARE.
 """
 
 import time, codecs
+import io
+import hashlib
+import copy
 import itertools
+import heapq
+import array
+import math
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from sem.coder import Coder
-from template  import ListPattern
+from template  import ListPattern, CompiledTemplates
+from observations import HashedObservations
+from constraints import Constraints
+
+def available_backends():
+    """
+    Returns the decoding backends that can be used with the current
+    installation. The pure python backend is always available, the numpy
+    one requires numpy to be installed.
+    """
+    
+    backends = [u"python"]
+    if numpy is not None:
+        backends.append(u"numpy")
+    return backends
+
+def default_backend():
+    return available_backends()[-1]
+
+_array_typecodes = {u"float64": "d", u"float32": "f"}
+_numpy_weight_types = (u"float64", u"float32", u"float16")
+
+def weight_buffer(size, dtype=u"float64"):
+    """
+    Returns a contiguous buffer of size zero weights. It is a numpy array if
+    numpy is installed, an array.array otherwise. float16 weights require
+    numpy.
+    """
+    if numpy is not None and dtype in _numpy_weight_types:
+        return numpy.zeros(size, dtype=dtype)
+    if dtype not in _array_typecodes:
+        supported = (_numpy_weight_types if numpy is not None else sorted(_array_typecodes))
+        raise ValueError(u"unsupported weight type: %s (supported: %s)" %(dtype, u", ".join(supported)))
+    return array.array(_array_typecodes[dtype], [0.0]) * size
+
+def offset_buffer(offsets):
+    """
+    Returns a contiguous int32 buffer holding the given offsets. It is a
+    numpy array if numpy is installed, an array.array otherwise.
+    """
+    if numpy is not None:
+        return numpy.array(offsets, dtype=numpy.int32)
+    return array.array("i", offsets)
+
+def nbytes(buf):
+    """
+    The number of bytes used by a weight or offset buffer.
+    """
+    if numpy is not None and isinstance(buf, (numpy.ndarray, QuantizedWeights)):
+        return buf.nbytes
+    if isinstance(buf, array.array):
+        return buf.itemsize * len(buf)
+    return sys.getsizeof(buf) + sum(sys.getsizeof(item) for item in buf)
+
+def _accumulate(target, features, weights):
+    """
+    Adds weight blocks to the rows of target, features[i] giving the
+    offsets in weights of the blocks to add to target[i]. The block size is
+    the size of a row.
+    Blocks are added rank by rank so that every row sums its blocks in
+    order, which gives the exact same result as adding them one by one.
+    The blocks of a rank are gathered in one copy, which is much faster
+    than adding views of weights one by one.
+    """
+    rows = target.reshape((len(target), -1))
+    span = numpy.arange(rows.shape[1])
+    rank = 0
+    indices = [i for i in range(len(features)) if features[i]]
+    while indices:
+        offsets = numpy.array([features[i][rank] for i in indices], dtype=numpy.int64)
+        rows[indices] += weights[offsets[:, None] + span]
+        rank += 1
+        indices = [i for i in indices if len(features[i]) > rank]
+
+def _group_offsets(offsets, rows, length):
+    """
+    Returns the offsets of observations grouped by token, rows[k][t] being
+    the id of the observation of the k-th template at token t, or -1 if it
+    is unknown. Observations without offset (-1) are left out.
+    """
+    if not rows:
+        return [[] for _t in range(length)]
+    if numpy is not None and isinstance(offsets, numpy.ndarray):
+        ids = numpy.array(rows, dtype=numpy.int64)
+        values = numpy.where(ids != -1, offsets[ids], -1).T.tolist()
+    else:
+        values = [[(offsets[o] if o != -1 else -1) for o in column] for column in zip(*rows)]
+    return [[off for off in column if off != -1] for column in values]
+
+def _logsumexp(values):
+    """
+    Returns log(sum(exp(values))) for a list of floats, -inf if it is empty.
+    """
+    if not values:
+        return float("-inf")
+    highest = max(values)
+    if highest == float("-inf"):
+        return highest
+    return highest + math.log(sum(math.exp(value - highest) for value in values))
+
+def _logsumexp_numpy(values, axis):
+    """
+    Returns log(sum(exp(values))) along axis of a numpy array, rows that are
+    only -inf give -inf.
+    """
+    highest = values.max(axis=axis)
+    shift = numpy.where(numpy.isfinite(highest), highest, 0.0)
+    with numpy.errstate(divide="ignore"):
+        return shift + numpy.log(numpy.exp(values - numpy.expand_dims(shift, axis)).sum(axis=axis))
+
+class QuantizedWeights(object):
+    """
+    int8 weights with a float32 scale for every block of block_size
+    consecutive weights: weight i is values[i] * scales[i // block_size].
+    Indexing returns dequantized values, so that it can be used in place of
+    a numpy array of weights. Requires numpy.
+    """
+    def __init__(self, values, scales, block_size):
+        self.values = values
+        self.scales = scales
+        self.block_size = block_size
+    
+    @classmethod
+    def from_weights(cls, weights, block_size=32):
+        """
+        Quantizes weights, the scale of a block maps its largest absolute
+        weight to 127.
+        """
+        weights = numpy.asarray(weights, dtype=numpy.float64)
+        n_blocks = (len(weights) + block_size - 1) // block_size
+        blocks = numpy.zeros(n_blocks * block_size)
+        blocks[: len(weights)] = weights
+        blocks = blocks.reshape((n_blocks, block_size))
+        scales = (numpy.abs(blocks).max(axis=1) / 127.0).astype(numpy.float32)
+        divisors = numpy.where(scales > 0.0, scales, 1.0).astype(numpy.float64)
+        values = numpy.rint(blocks / divisors[:, None]).clip(-127, 127).astype(numpy.int8)
+        return cls(values.ravel()[: len(weights)], scales, block_size)
+    
+    def __len__(self):
+        return len(self.values)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            index = numpy.arange(*index.indices(len(self.values)))
+        else:
+            index = numpy.asarray(index)
+        return self.values[index] * self.scales[index // self.block_size]
+    
+    def __iter__(self):
+        return iter(self.tolist())
+    
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.scales.nbytes
+    
+    def dequantize(self):
+        return self[:]
+    
+    def tolist(self):
+        return self.dequantize().tolist()
 
 class Model(object):
-    def __init__(self, constraints={}):
+    def __init__(self, constraints=None, backend=None):
         self._tagset       = Coder()
         self._templates    = []
         self._observations = Coder()
         self._uoff         = []
         self._boff         = []
-        self._weights      = [] # list
+        self._weights      = [] # list, or contiguous buffer once compacted
         self._max_col      = 0
+        self._np_weights   = None # numpy copy of list weights, created on demand
+        self._mapping      = None # memory mapped file of binary models
+        self._compiled     = None # templates compiled for instanciation
+        self._constraints  = constraints
+        self._backend      = None
+        self.backend       = backend
+        self._decode_cache = None # see sem.CRF.cache
+        self._fingerprint  = None # (weights, constraints, digest)
     
     def __call__(self, x):
         return self.tag_viterbi(x)
     
     @classmethod
-    def from_wapiti_model(cls, filename, encoding="utf-8", verbose=True):
+    def load(cls, filename, encoding="utf-8", backend=None, dtype=u"float64", observation_index=None, verify_hashes=False):
+        """
+        Loads a model either in binary or in Wapiti format. Binary models
+        keep the weight type they were compiled with.
+        """
+        from sem.CRF.binary import is_binary_model
+        if filename.endswith(u".tar.gz"):
+            return cls.from_archive(filename[: -len(u".tar.gz")], encoding=encoding, backend=backend, dtype=dtype, observation_index=observation_index, verify_hashes=verify_hashes)
+        if is_binary_model(filename):
+            return cls.from_binary(filename, backend=backend, observation_index=observation_index, verify_hashes=verify_hashes)
+        return cls.from_wapiti_model(filename, encoding=encoding, backend=backend, dtype=dtype, observation_index=observation_index or u"coder", verify_hashes=verify_hashes)
+    
+    @classmethod
+    def from_binary(cls, filename, backend=None, observation_index=None, verify_hashes=False):
+        """
+        Loads a model written by write_binary, see sem.CRF.binary.
+        """
+        from sem.CRF.binary import read_binary
+        return read_binary(filename, backend=backend, observation_index=observation_index, verify_hashes=verify_hashes)
+    
+    @classmethod
+    def from_archive(cls, model, encoding="utf-8", backend=None, dtype=u"float64", observation_index=None, verify_hashes=False):
+        """
+        Loads model, in binary or in Wapiti format, from model.tar.gz
+        without extracting it (see sem.misc.read_archived_model). Binary
+        models then live in memory instead of being mapped.
+        """
+        from sem.misc import read_archived_model
+        from sem.CRF.binary import loads_binary, MAGIC
+        data = read_archived_model(model)
+        if data.startswith(MAGIC):
+            return loads_binary(data, backend=backend, observation_index=observation_index, verify_hashes=verify_hashes)
+        return cls.from_wapiti_model(io.BytesIO(data), encoding=encoding, backend=backend, dtype=dtype, observation_index=observation_index or u"coder", verify_hashes=verify_hashes)
+    
+    def write_binary(self, filename):
+        """
+        Writes the model in binary format, see sem.CRF.binary.
+        """
+        from sem.CRF.binary import write_binary
+        write_binary(self, filename)
+    
+    @classmethod
+    def from_wapiti_model(cls, filename, encoding="utf-8", verbose=True, backend=None, dtype=u"float64", observation_index=u"coder", verify_hashes=False):
+        """
+        Loads a model in Wapiti format. filename may also be a file opened
+        in binary mode.
+        
+        observation_index is either "coder" (a dictionary of observation
+        strings) or "hashed" (a sorted array of observation hashes, see
+        sem.CRF.observations). Hashed observations do not keep their
+        strings unless verify_hashes is True, in which case a model cannot
+        be written or pruned.
+        """
+        if observation_index not in (u"coder", u"hashed"):
+            raise ValueError(u"unknown observation index: %s (available: coder, hashed)" %observation_index)
         MODEL = 0
         READER = 1
         READ_TEMPLATE = 2
@@ -56,7 +289,7 @@ class Model(object):
         OBSERVATIONS = 4
         FEATURES = 5
         
-        model           = Model()
+        model           = Model(backend=backend)
         n_weights       = -1
         n_patterns      = -1
         n_labels        = -1
@@ -64,11 +297,14 @@ class Model(object):
         current_feature = 0
         state           = MODEL
         line_index      = 0
-        if encoding is None:
-            fd = open(filename, "rU")
+        if hasattr(filename, "read"):
+            lines = [(line.decode(encoding) if encoding is not None else line).strip() for line in filename]
         else:
-            fd = codecs.open(filename, "rU", encoding)
-        lines = [line.strip() for line in fd.readlines()]
+            if encoding is None:
+                fd = open(filename, "rU")
+            else:
+                fd = codecs.open(filename, "rU", encoding)
+            lines = [line.strip() for line in fd.readlines()]
         
         n_weights = int(lines[line_index].split(u"#")[-1])
         line_index += 1
@@ -103,27 +339,42 @@ class Model(object):
         line_index += 1
         model._uoff = [-1]*n_observations
         model._boff = [-1]*n_observations
-        for line in lines[line_index : line_index+n_observations]:
+        observations = [u""]*n_observations
+        for nth, line in enumerate(lines[line_index : line_index+n_observations]):
             obs      = line[line.index(":")+1 : -1]
             n_feats  = (n_labels if obs[0] in "u*" else 0)
             n_feats += (n_labels**2 if obs[0] in "b*" else 0)
             
-            model.observations.add(obs)
+            observations[nth] = obs
             if obs[0] in "u*":
-                model.uoff[len(model.observations)-1] = current_feature
+                model.uoff[nth] = current_feature
             if obs[0] in "b*":
-                model.boff[len(model.observations)-1] = current_feature + (n_labels if obs[0]==u"*" else 0)
+                model.boff[nth] = current_feature + (n_labels if obs[0]==u"*" else 0)
             current_feature += n_feats
         line_index += n_observations
-        model._weights = [0.0]*current_feature
+        if observation_index == u"hashed":
+            model._observations = HashedObservations.from_strings(observations, keep_strings=verify_hashes, verify=verify_hashes)
+        else:
+            model._observations = Coder.fromlist(observations)
+        model._uoff = offset_buffer(model._uoff)
+        model._boff = offset_buffer(model._boff)
+        model._weights = weight_buffer(current_feature, dtype)
         state = FEATURES
         """if verbose:
             print "observations:", time.time()-s"""
         
         s = time.time()
-        for line in lines[-n_weights : ]:
+        indices = [0]*n_weights
+        values = [0.0]*n_weights
+        for nth, line in enumerate(lines[-n_weights : ]):
             index, weight = line.split("=")
-            model.weights[int(index)] = float.fromhex(weight)#(float.fromhex(weight) if "x" in weight else float(weight))
+            indices[nth] = int(index)
+            values[nth] = float.fromhex(weight)#(float.fromhex(weight) if "x" in weight else float(weight))
+        if numpy is not None:
+            model._weights[indices] = values
+        else:
+            for index, value in itertools.izip(indices, values):
+                model._weights[index] = value
         """if verbose:
             print "features:", time.time()-s"""
         
@@ -159,48 +410,337 @@ class Model(object):
     def weights(self):
         return self._weights
     
-    def tag_viterbi(self, sentence):
+    @property
+    def nbytes(self):
+        """
+        The number of bytes used by weights and offsets.
+        """
+        return nbytes(self._weights) + nbytes(self._uoff) + nbytes(self._boff)
+    
+    def compact(self, dtype=u"float64"):
+        """
+        Stores weights in a contiguous buffer of dtype ("float64", "float32"
+        or, with numpy, "float16") and offsets in contiguous int32 buffers.
+        """
+        if numpy is not None:
+            weights = weight_buffer(len(self._weights), dtype)
+            weights[:] = self._dense_weights()
+        else:
+            weights = weight_buffer(0, dtype)
+            weights.fromlist(list(self._weights))
+        self._weights = weights
+        self._uoff = offset_buffer(self._uoff)
+        self._boff = offset_buffer(self._boff)
+        self._np_weights = None
+    
+    def _dense_weights(self):
+        if isinstance(self._weights, QuantizedWeights):
+            return self._weights.dequantize()
+        return self._weights
+    
+    def quantize(self, dtype=u"int8", block_size=32):
+        """
+        Reduces the precision of weights to dtype: "float16", or "int8" with
+        a float32 scale for every block of block_size weights. Quantized
+        weights take 4 (float16) to 8 (int8) times less memory than float64
+        ones, at the cost of slightly different scores. Requires numpy.
+        """
+        if numpy is None:
+            raise ValueError(u"weight quantization requires numpy")
+        if dtype == u"int8":
+            self._weights = QuantizedWeights.from_weights(self._dense_weights(), block_size)
+            self._uoff = offset_buffer(self._uoff)
+            self._boff = offset_buffer(self._boff)
+            self._np_weights = None
+        elif dtype == u"float16":
+            self.compact(dtype)
+        else:
+            raise ValueError(u"unsupported quantization: %s (supported: float16, int8)" %dtype)
+    
+    def prune(self, threshold=0.0):
+        """
+        Removes the observations whose weights are all lower than or equal
+        to threshold in absolute value. Removed observations are ignored
+        when tagging, like unknown ones, so a threshold of 0 does not change
+        the output of the model. Quantized weights are dequantized.
+        
+        Returns the number of removed observations.
+        """
+        Y = len(self._tagset)
+        weights = self._dense_weights()
+        is_numpy = (numpy is not None and isinstance(weights, numpy.ndarray))
+        if is_numpy:
+            block_max = lambda start, size: (float(numpy.abs(weights[start : start+size]).max()) if size else 0.0)
+        else:
+            block_max = lambda start, size: max([abs(w) for w in weights[start : start+size]] or [0.0])
+        
+        observations = Coder()
+        uoff = []
+        boff = []
+        pieces = []
+        position = 0
+        for o, obs in enumerate(self._observations):
+            has_u = (self._uoff[o] != -1)
+            has_b = (self._boff[o] != -1)
+            start = (self._uoff[o] if has_u else self._boff[o])
+            size = (Y if has_u else 0) + (Y*Y if has_b else 0)
+            if not (has_u or has_b) or block_max(start, size) <= threshold:
+                continue
+            observations.add(obs)
+            uoff.append(position if has_u else -1)
+            boff.append(position + (Y if has_u else 0) if has_b else -1)
+            pieces.append(weights[start : start+size])
+            position += size
+        
+        n_removed = len(self._observations) - len(observations)
+        if is_numpy:
+            weights = (numpy.concatenate(pieces) if pieces else weights[:0])
+        elif isinstance(weights, array.array):
+            weights = array.array(weights.typecode)
+            for piece in pieces:
+                weights.extend(piece)
+        else:
+            weights = list(itertools.chain.from_iterable(pieces))
+        if not isinstance(self._uoff, list):
+            uoff = offset_buffer(uoff)
+            boff = offset_buffer(boff)
+        self._observations = observations
+        self._uoff = uoff
+        self._boff = boff
+        self._weights = weights
+        self._np_weights = None
+        return n_removed
+    
+    @property
+    def backend(self):
+        """
+        The name of the backend used for decoding.
+        """
+        return self._backend
+    
+    @backend.setter
+    def backend(self, backend):
+        if backend is None:
+            backend = default_backend()
+        if backend not in available_backends():
+            raise ValueError(u"unavailable backend: %s (available: %s)" %(backend, u", ".join(available_backends())))
+        self._backend = backend
+    
+    @property
+    def constraints(self):
+        """
+        The constraints on label transitions used when tagging (see
+        sem.CRF.constraints), None if every transition is allowed.
+        """
+        return self._constraints
+    
+    @constraints.setter
+    def constraints(self, constraints):
+        if constraints is not None and constraints.tags != list(self._tagset):
+            raise ValueError(u"constraints labels do not match model labels")
+        self._constraints = constraints
+    
+    def constrain(self, transitions=u"scheme", encoding="utf-8"):
+        """
+        Sets the constraints on label transitions. transitions is either
+        "scheme" (derive them from the tagging scheme of the labels), the
+        name of a scheme (BIO, BIOES or underscore), the name of a whitelist
+        file (see Constraints.from_whitelist) or None to remove constraints.
+        """
+        if transitions is None:
+            self.constraints = None
+        elif transitions == u"scheme":
+            self.constraints = Constraints.from_scheme(self._tagset)
+        elif transitions in (u"BIO", u"BIOES", u"underscore"):
+            self.constraints = Constraints.from_scheme(self._tagset, transitions)
+        else:
+            self.constraints = Constraints.from_whitelist(self._tagset, transitions, encoding=encoding)
+    
+    def view(self):
+        """
+        Returns a model sharing the labels, templates, observations and
+        weights of this one, whose constraints and backend can be changed
+        without affecting it. Data built on demand for decoding is built
+        first, so that views share it too.
+        """
+        self.compiled_templates()
+        if self._backend == u"numpy":
+            self._numpy_weights()
+        return copy.copy(self)
+    
+    @property
+    def decode_cache(self):
+        """
+        The cache of Viterbi results used by tag_viterbi and tag_batch
+        (see sem.CRF.cache.DecodeCache), None for no cache.
+        """
+        return self._decode_cache
+    
+    @decode_cache.setter
+    def decode_cache(self, cache):
+        self._decode_cache = cache
+    
+    def fingerprint(self):
+        """
+        Returns a digest of the labels, templates, weights and constraints
+        of the model, computed again when weights or constraints change.
+        """
+        if self._fingerprint is None or self._fingerprint[0] is not self._weights or self._fingerprint[1] is not self._constraints:
+            sha1 = hashlib.sha1()
+            sha1.update(u"\n".join(self._tagset).encode("utf-8"))
+            sha1.update(u"\n".join([unicode(template) for template in self._templates]).encode("utf-8"))
+            for weights in ((self._weights.values, self._weights.scales) if isinstance(self._weights, QuantizedWeights) else (self._weights,)):
+                if isinstance(weights, list):
+                    weights = array.array("d", weights)
+                sha1.update(weights.tobytes() if numpy is not None and isinstance(weights, numpy.ndarray) else weights.tostring())
+            if self._constraints is not None:
+                sha1.update(repr((self._constraints._allowed, self._constraints._first, self._constraints._last)))
+            self._fingerprint = (self._weights, self._constraints, sha1.hexdigest())
+        return self._fingerprint[2]
+    
+    def cache_key(self, sentence, candidates=None):
+        """
+        Returns the key of the decoding of sentence in the decode cache:
+        its feature columns, its candidates and the fingerprint of the
+        model.
+        """
+        return (self.fingerprint(), tuple([tuple(token) for token in sentence]), (tuple([(frozenset(labels) if labels is not None else None) for labels in candidates]) if candidates is not None else None))
+    
+    def compiled_templates(self):
+        """
+        Returns the templates of the model compiled for instanciation. They
+        are compiled again if templates changed.
+        """
+        if self._compiled is None or self._compiled.templates != self._templates:
+            self._compiled = CompiledTemplates(self._templates)
+        return self._compiled
+    
+    def feature_offsets(self, sentence):
+        """
+        Returns, for each token of sentence, the offsets in weights of its
+        unigram and bigram features.
+        """
+        
+        compiled = self.compiled_templates()
+        T = len(sentence)
+        if isinstance(self._observations, HashedObservations) and not self._observations.verify:
+            # observations are looked up by hash, their strings are only
+            # built for templates whose kind depends on the sentence.
+            hashes = compiled.hashes(sentence)
+            flat_ids = self._observations.encode_hashes(hashes.ravel())
+            id_rows = [flat_ids[k*T : (k+1)*T] for k in range(len(hashes))]
+            instances = (compiled.instanciate(sentence) if None in compiled.kinds else [None] * len(hashes))
+        elif isinstance(self._observations, HashedObservations):
+            instances = compiled.instanciate(sentence)
+            flat_ids = self._observations.encode_many([obs for observations in instances for obs in observations])
+            id_rows = [flat_ids[k*T : (k+1)*T] for k in range(len(instances))]
+        else:
+            instances = compiled.instanciate(sentence)
+            obs_encode = self._observations.encode
+            id_rows = [map(obs_encode, observations) for observations in instances]
+        
+        u_rows = []
+        b_rows = []
+        for kind, observations, ids in itertools.izip(compiled.kinds, instances, id_rows):
+            if kind is None:
+                u_rows.append([(o if obs[:1] in u"u*" else -1) for o, obs in itertools.izip(ids, observations)])
+                b_rows.append([(o if obs[:1] in u"b*" else -1) for o, obs in itertools.izip(ids, observations)])
+            else:
+                if kind in u"u*":
+                    u_rows.append(ids)
+                if kind in u"b*":
+                    b_rows.append(ids)
+        
+        return _group_offsets(self._uoff, u_rows, len(sentence)), _group_offsets(self._boff, b_rows, len(sentence))
+    
+    def tag_viterbi(self, sentence, candidates=None):
+        """
+        Returns the best tagging of sentence according to the model along
+        with the score of every tag and the score of the whole sequence.
+        If the model has constraints, only the taggings that respect them
+        are considered.
+        
+        candidates, if given, holds for every token the set of labels it
+        may take (see sem.CRF.lexicon), or None if it may take any label.
+        Labels unknown to the model are ignored.
+        
+        The computation is delegated to the current backend, every backend
+        gives the same result. Results are looked up in the decode cache
+        first, if any.
+        """
+        if self._decode_cache is not None:
+            key = self.cache_key(sentence, candidates)
+            result = self._decode_cache.get(key)
+            if result is None:
+                result = self._tag_viterbi(sentence, candidates)
+                self._decode_cache.put(key, (list(result[0]), list(result[1]), result[2]))
+            return (list(result[0]), list(result[1]), result[2])
+        return self._tag_viterbi(sentence, candidates)
+    
+    def _tag_viterbi(self, sentence, candidates=None):
+        if self._backend == u"numpy":
+            return self._tag_viterbi_numpy(sentence, candidates)
+        return self._tag_viterbi_python(sentence, candidates)
+    
+    def _states(self, candidates, length):
+        """
+        Returns, for each of the length tokens, the sorted indices of the
+        labels it may take according to candidates.
+        """
+        range_Y = range(len(self._tagset))
+        if candidates is None:
+            return [range_Y] * length
+        encode = self._tagset.encode
+        states = []
+        for labels in candidates:
+            indices = (sorted(set(encode(label) for label in labels) - set([-1])) if labels else None)
+            states.append(indices or range_Y)
+        return states
+    
+    def _state_masks(self, candidates, length):
+        """
+        Returns the length*Y array where labels a token may not take are
+        -inf and the others 0.
+        """
+        Y = len(self._tagset)
+        masks = numpy.zeros((length, Y))
+        for t, states in enumerate(self._states(candidates, length)):
+            if len(states) < Y:
+                masks[t] = float("-inf")
+                masks[t, states] = 0.0
+        return masks
+    
+    def _weight_block(self):
+        """
+        Returns a function giving the size weights starting at offset off:
+        a view of the weight buffer if it is a numpy array, a copy
+        otherwise (quantized weights and array.array cannot be viewed as
+        floats).
+        """
+        # avoiding dots
+        weights_ = self._weights
+        return lambda off, size: weights_[off : off+size]
+    
+    def _psi_python(self, sentence, states):
+        """
+        Returns the T*Y*Y score cube of sentence as nested lists (see
+        _psi_numpy). Scores are only computed for the labels in states (see
+        _states), the others are 0.
+        """
         Y = len(self.tagset)
         T = len(sentence)
         range_Y = range(Y)
         range_T = range(T)
         psi = [[[0.0]*Y for _y1 in range_Y] for _t in range_T]
-        back = [[0]*Y for _t in range_T]
-        cur = [0.0]*Y
-        old = [0.0]*Y
-        psc = [0.0]*T
-        sc = -2**30
-        tag = [u"" for _t in range_T]
-        # avoiding dots
-        weights_ = self._weights
-        obs_encode = self._observations.encode
-        templates_ = self._templates
-        uoff_ = self._uoff
-        boff_ = self._boff
+        block = self._weight_block()
+        
+        unigram_offsets, bigram_offsets = self.feature_offsets(sentence)
+        unigrams = [[block(off, Y) for off in offsets] for offsets in unigram_offsets]
+        bigrams = [[block(off, Y*Y) for off in offsets] for offsets in bigram_offsets]
         
-        unigrams = []
-        bigrams = []
-        for t in range_T:
-            unigrams.append([])
-            bigrams.append([])
-            u_append = unigrams[-1].append
-            b_append = bigrams[-1].append
-            for template in templates_:
-                obs = template.instanciate(sentence, t)
-                o = obs_encode(obs)
-                #if t == 0: print obs, "--", o
-                if o != -1:
-                    if obs[0] == 'u' and uoff_[o] != -1:
-                        #u_append(uoff_[o])
-                        u_append(weights_[uoff_[o] : uoff_[o]+Y])
-                    if obs[0] == 'b' and boff_[o] != -1:
-                        #b_append(boff_[o])
-                        b_append(weights_[boff_[o] : boff_[o]+Y*Y])
-        
-        # compute scores in psi
         for t in range_T:
             unigrams_T = unigrams[t]
-            for y in range_Y:
+            for y in states[t]:
                 sum_ = 0.0
                 for w in unigrams_T:
                     sum_ += w[y]
@@ -208,21 +748,63 @@ class Model(object):
                     psi[t][yp][y] = sum_
         for t in range(1,T):
             bigrams_T = bigrams[t]
-            d = 0
-            for yp, y in itertools.product(range_Y, range_Y):
-                for w in bigrams_T:
-                    psi[t][yp][y] += w[d]
-                d += 1
+            for yp in states[t-1]:
+                for y in states[t]:
+                    d = yp*Y + y
+                    for w in bigrams_T:
+                        psi[t][yp][y] += w[d]
+        
+        return psi
+    
+    def _tag_viterbi_python(self, sentence, candidates=None):
+        Y = len(self.tagset)
+        T = len(sentence)
+        if T == 0:
+            return [], [], 0.0
+        
+        range_Y = range(Y)
+        range_T = range(T)
+        back = [[0]*Y for _t in range_T]
+        cur = [0.0]*Y
+        old = [0.0]*Y
+        psc = [0.0]*T
+        sc = -2**30
+        tag = [u"" for _t in range_T]
+        
+        # states[t] are the labels token t may take, scores are only
+        # computed for them.
+        states = self._states(candidates, T)
+        psi = self._psi_python(sentence, states)
+        
+        # with constraints or candidates, only legal predecessors are
+        # visited and impossible states are scored -inf.
+        constraints = self._constraints
+        restricted = (constraints is not None or candidates is not None)
+        lowest = (float("-inf") if restricted else -2**30)
         
         for y in range_Y:
             cur[y] = psi[0][0][y]
+            if constraints is not None and not constraints.first[y]:
+                cur[y] = lowest
+        if restricted and T > 0 and len(states[0]) < Y:
+            first = set(states[0])
+            cur = [(cur[y] if y in first else lowest) for y in range_Y]
         for t in range(1,T):
             for y in range_Y:
                 old[y] = cur[y]
-            for y in range_Y:
-                bst = -2**30
+            previous = states[t-1]
+            if restricted:
+                cur = [lowest]*Y
+            for y in states[t]:
+                if constraints is None:
+                    predecessors = previous
+                elif len(previous) == Y:
+                    predecessors = constraints.predecessors[y]
+                else:
+                    predecessors = [yp for yp in previous if constraints.transitions[yp][y]]
+                bst = lowest
                 idx = 0
-                for yp in range_Y:
+                for yp in predecessors:
                     val = old[yp] + psi[t][yp][y]
                     if val > bst:
                         bst = val
@@ -230,6 +812,8 @@ class Model(object):
                 back[t][y] = idx
                 cur[y] = bst
         
+        if constraints is not None:
+            cur = [(cur[y] if constraints.last[y] else lowest) for y in range_Y]
         bst = 0
         for y in range(1,Y):
             if cur[y] > cur[bst]:
@@ -244,23 +828,529 @@ class Model(object):
         
         return tag, psc, sc
     
+    def tag_batch(self, sentences, batch_size=64, bucket_width=8, candidates=None):
+        """
+        Tags a list of sentences. Returns, for each sentence in the same
+        order, the same (tags, tag scores, sequence score) triple as
+        tag_viterbi. candidates, if given, holds the candidates of every
+        sentence (see tag_viterbi).
+        
+        With the numpy backend, sentences are grouped in buckets of similar
+        lengths (at most bucket_width apart) of at most batch_size
+        sentences. Each bucket is padded and decoded at once. Sentences
+        found in the decode cache, if any, or repeated in sentences are
+        decoded only once.
+        """
+        if candidates is None:
+            candidates = [None] * len(sentences)
+        if self._decode_cache is None:
+            return self._tag_batch(sentences, batch_size, bucket_width, candidates)
+        
+        keys = [self.cache_key(sentence, sentence_candidates) for sentence, sentence_candidates in itertools.izip(sentences, candidates)]
+        found = {}
+        first = {} # key -> index of its first sentence
+        missing = []
+        for index, key in enumerate(keys):
+            if key not in first:
+                first[key] = index
+                result = self._decode_cache.get(key)
+                if result is None:
+                    missing.append(index)
+                else:
+                    found[key] = result
+        if missing:
+            decoded = self._tag_batch([sentences[index] for index in missing], batch_size, bucket_width, [candidates[index] for index in missing])
+            for index, result in itertools.izip(missing, decoded):
+                result = (list(result[0]), list(result[1]), result[2])
+                self._decode_cache.put(keys[index], result)
+                found[keys[index]] = result
+        for index, key in enumerate(keys):
+            if first[key] != index:
+                self._decode_cache.get(key) # repeated sentences count as hits, as when decoded one by one
+        return [(list(found[key][0]), list(found[key][1]), found[key][2]) for key in keys]
+    
+    def _tag_batch(self, sentences, batch_size, bucket_width, candidates):
+        if self._backend != u"numpy":
+            return [self._tag_viterbi(sentence, sentence_candidates) for sentence, sentence_candidates in itertools.izip(sentences, candidates)]
+        
+        results = [None] * len(sentences)
+        order = sorted(range(len(sentences)), key=lambda i: len(sentences[i]))
+        bucket = []
+        for index in order:
+            if len(sentences[index]) == 0:
+                results[index] = ([], [], 0.0)
+                continue
+            if bucket and (len(bucket) >= batch_size or len(sentences[index]) - len(sentences[bucket[0]]) >= bucket_width):
+                self._tag_bucket_numpy(sentences, bucket, results, candidates)
+                bucket = []
+            bucket.append(index)
+        if bucket:
+            self._tag_bucket_numpy(sentences, bucket, results, candidates)
+        
+        return results
+    
+    def _tag_bucket_numpy(self, sentences, bucket, results, candidates):
+        """
+        Runs Viterbi on the sentences whose indices are in bucket, all at
+        once, and stores their taggings in results. Sentences are padded to
+        the longest one, the recursion is frozen for a sentence once its
+        last token is reached.
+        """
+        Y = len(self.tagset)
+        B = len(bucket)
+        lengths = numpy.array([len(sentences[index]) for index in bucket])
+        T = int(lengths.max())
+        weights_ = self._numpy_weights()
+        
+        offsets = [self.feature_offsets(sentences[index]) for index in bucket]
+        
+        unigrams = numpy.zeros((B*T, Y))
+        _accumulate(unigrams, [offs for b in range(B) for offs in offsets[b][0] + [[]]*(T-lengths[b])], weights_)
+        unigrams = unigrams.reshape((B, T, Y))
+        
+        masks = None
+        if any(candidates[index] is not None for index in bucket):
+            masks = numpy.zeros((B, T, Y))
+            for b, index in enumerate(bucket):
+                masks[b, : lengths[b]] = self._state_masks(candidates[index], lengths[b])
+        
+        back = numpy.zeros((B, T, Y), dtype=numpy.int64)
+        cur = unigrams[:, 0, :].copy()
+        if self._constraints is not None:
+            transitions, first, last = self._constraints.masks()
+            cur += first
+        if masks is not None:
+            cur += masks[:, 0, :]
+        for t in range(1, T):
+            psi = numpy.repeat(unigrams[:, t, None, :], Y, axis=1)
+            _accumulate(psi, [(offsets[b][1][t] if t < lengths[b] else []) for b in range(B)], weights_)
+            val = cur[:, :, None] + psi
+            if self._constraints is not None:
+                val += transitions
+            if masks is not None:
+                val += masks[:, t, None, :]
+            back[:, t, :] = val.argmax(axis=1)
+            active = (t < lengths)[:, None]
+            cur = numpy.where(active, val.max(axis=1), cur)
+        
+        if self._constraints is not None:
+            cur = cur + last
+        bst = cur.argmax(axis=1)
+        scores = cur[numpy.arange(B), bst]
+        paths = numpy.zeros((B, T), dtype=numpy.int64)
+        for t in reversed(range(T)):
+            active = t < lengths
+            paths[active, t] = bst[active]
+            bst = numpy.where(active, back[numpy.arange(B), t, bst], bst)
+        
+        decode = self._tagset.decode
+        for b, index in enumerate(bucket):
+            L = lengths[b]
+            path = [int(y) for y in paths[b, :L]]
+            psc = [0.0]*L
+            for t in range(L):
+                y = path[t]
+                yp = (path[t-1] if t != 0 else 0)
+                score = float(unigrams[b, t, y])
+                if t != 0:
+                    for off in offsets[b][1][t]:
+                        score += weights_[off + yp*Y + y]
+                psc[t] = float(score)
+            results[index] = ([decode(y) for y in path], psc, float(scores[b]))
+    
+    def _numpy_weights(self):
+        if isinstance(self._weights, (numpy.ndarray, QuantizedWeights)):
+            return self._weights
+        if self._np_weights is None or len(self._np_weights) != len(self._weights):
+            self._np_weights = numpy.asarray(self._weights, dtype=numpy.float64)
+        return self._np_weights
+    
+    def _psi_numpy(self, sentence):
+        """
+        Returns the T*Y*Y score cube of sentence, where psi[t, yp, y] is the
+        score of going from label yp at t-1 to label y at t.
+        Weights are added in the same order as in the python backend so that
+        both give exactly the same scores.
+        """
+        Y = len(self.tagset)
+        T = len(sentence)
+        weights_ = self._numpy_weights()
+        unigram_offsets, bigram_offsets = self.feature_offsets(sentence)
+        
+        unigrams = numpy.zeros((T, Y))
+        _accumulate(unigrams, unigram_offsets, weights_)
+        psi = numpy.repeat(unigrams[:, None, :], Y, axis=1)
+        _accumulate(psi, [[]] + bigram_offsets[1:], weights_)
+        
+        return psi
+    
+    def _tag_viterbi_numpy(self, sentence, candidates=None):
+        T = len(sentence)
+        if T == 0:
+            return [], [], 0.0
+        
+        psi = self._psi_numpy(sentence)
+        masks = (self._state_masks(candidates, T) if candidates is not None else None)
+        back = numpy.zeros((T, psi.shape[2]), dtype=numpy.int64)
+        cur = psi[0, 0].copy()
+        if self._constraints is not None:
+            transitions, first, last = self._constraints.masks()
+            cur += first
+        if masks is not None:
+            cur += masks[0]
+        for t in range(1, T):
+            val = cur[:, None] + psi[t]
+            if self._constraints is not None:
+                val += transitions
+            if masks is not None:
+                val += masks[t]
+            back[t] = val.argmax(axis=0)
+            cur = val.max(axis=0)
+        
+        if self._constraints is not None:
+            cur = cur + last
+        bst = int(cur.argmax())
+        sc = float(cur[bst])
+        tag = [u""]*T
+        psc = [0.0]*T
+        decode = self._tagset.decode
+        for t in reversed(range(T)):
+            yp = (int(back[t, bst]) if t != 0 else 0)
+            tag[t] = decode(bst)
+            psc[t] = float(psi[t, yp, bst])
+            bst = yp
+        
+        return tag, psc, sc
+    
+    def tag_beam(self, sentence, beam_size=8, candidates=None):
+        """
+        Returns the (tags, tag scores, sequence score) triple of sentence
+        found by beam search: only the beam_size best labels of a token are
+        extended to the next one, so that bigram weights are read for
+        beam_size*Y transitions instead of Y*Y. It is faster than
+        tag_viterbi for large tagsets but may miss the best tagging. If
+        beam_size is at least the size of the tagset, both give the same
+        result. Constraints and candidates are handled as in tag_viterbi.
+        """
+        Y = len(self._tagset)
+        T = len(sentence)
+        if T == 0:
+            return [], [], 0.0
+        
+        constraints = self._constraints
+        states = self._states(candidates, T)
+        block = self._weight_block()
+        unigram_offsets, bigram_offsets = self.feature_offsets(sentence)
+        
+        # cur[y] is the score of the best partial tagging ending with y and
+        # back[t][y] the previous label and the score of y in it.
+        back = [{} for _t in range(T)]
+        cur = {}
+        for t in range(T):
+            unigrams = [block(off, Y) for off in unigram_offsets[t]]
+            old = cur
+            beam = sorted(heapq.nlargest(beam_size, old, key=lambda y: (old[y], -y)))
+            bigrams = dict((yp, [block(off + yp*Y, Y) for off in bigram_offsets[t]]) for yp in beam)
+            cur = {}
+            for y in states[t]:
+                sum_ = 0.0
+                for w in unigrams:
+                    sum_ += w[y]
+                if t == 0:
+                    if constraints is None or constraints.first[y]:
+                        cur[y] = sum_
+                        back[t][y] = (0, sum_)
+                    continue
+                idx = None
+                for yp in beam:
+                    if constraints is not None and not constraints.transitions[yp][y]:
+                        continue
+                    score = sum_
+                    for w in bigrams[yp]:
+                        score += w[y]
+                    val = old[yp] + score
+                    if idx is None or val > bst:
+                        bst = val
+                        idx = yp
+                        bst_psi = score
+                if idx is not None:
+                    cur[y] = bst
+                    back[t][y] = (idx, bst_psi)
+            if not cur:
+                # every tagging in the beam violates the constraints.
+                return self.tag_viterbi(sentence, candidates)
+        
+        ends = [y for y in sorted(cur) if constraints is None or constraints.last[y]]
+        if not ends:
+            return self.tag_viterbi(sentence, candidates)
+        bst = ends[0]
+        for y in ends[1:]:
+            if cur[y] > cur[bst]:
+                bst = y
+        sc = cur[bst]
+        tag = [u""]*T
+        psc = [0.0]*T
+        decode = self._tagset.decode
+        for t in reversed(range(T)):
+            yp, psc[t] = back[t][bst]
+            tag[t] = decode(bst)
+            bst = yp
+        
+        return tag, psc, sc
+    
+    def tag_nbest(self, sentence, n=5, candidates=None):
+        """
+        Returns the n best taggings of sentence, the best first, as a list
+        of (tags, tag scores, sequence score) triples. The first one is the
+        tagging given by tag_viterbi. There are less than n taggings if
+        constraints or candidates do not allow as many.
+        
+        This is an exact decoding where every label of every token keeps
+        its n best partial taggings, it is about n times slower than
+        tag_viterbi. As for tag_viterbi, the computation is delegated to the
+        current backend.
+        """
+        if len(sentence) == 0:
+            return [([], [], 0.0)]
+        if self._backend == u"numpy":
+            return self._tag_nbest_numpy(sentence, n, candidates)
+        return self._tag_nbest_python(sentence, n, candidates)
+    
+    def _tag_nbest_python(self, sentence, n, candidates=None):
+        T = len(sentence)
+        constraints = self._constraints
+        states = self._states(candidates, T)
+        psi = self._psi_python(sentence, states)
+        # ties are broken as in tag_viterbi: lowest labels first.
+        key = lambda entry: (-entry[0], entry[1], entry[2])
+        
+        # paths[t][y] are the (score, previous label, rank of the previous
+        # partial tagging) triples of the n best partial taggings ending
+        # with label y at t, the best first.
+        paths = [{} for _t in range(T)]
+        for y in states[0]:
+            if constraints is None or constraints.first[y]:
+                paths[0][y] = [(psi[0][0][y], 0, 0)]
+        for t in range(1, T):
+            psi_t = psi[t]
+            previous = sorted(paths[t-1].items())
+            for y in states[t]:
+                entries = []
+                for yp, partials in previous:
+                    if constraints is not None and not constraints.transitions[yp][y]:
+                        continue
+                    score = psi_t[yp][y]
+                    entries.extend((partial[0] + score, yp, rank) for rank, partial in enumerate(partials))
+                if entries:
+                    paths[t][y] = heapq.nsmallest(n, entries, key=key)
+        
+        ends = [(partials[rank][0], y, rank) for y, partials in sorted(paths[-1].items()) if constraints is None or constraints.last[y] for rank in range(len(partials))]
+        decode = self._tagset.decode
+        results = []
+        for sc, y, rank in heapq.nsmallest(n, ends, key=key):
+            tag = [u""]*T
+            psc = [0.0]*T
+            for t in reversed(range(T)):
+                _, yp, previous_rank = paths[t][y][rank]
+                tag[t] = decode(y)
+                psc[t] = psi[t][yp][y]
+                y, rank = yp, previous_rank
+            results.append((tag, psc, sc))
+        
+        return results
+    
+    def _tag_nbest_numpy(self, sentence, n, candidates=None):
+        T = len(sentence)
+        psi = self._psi_numpy(sentence)
+        Y = psi.shape[2]
+        masks = (self._state_masks(candidates, T) if candidates is not None else None)
+        
+        # scores[yp, k] is the score of the k-th best partial tagging ending
+        # with yp, back[t, y, k] is yp*n+k for the partial tagging it extends.
+        # Sorts are stable so that ties are broken as in the python backend.
+        scores = numpy.full((Y, n), float("-inf"))
+        scores[:, 0] = psi[0, 0]
+        if self._constraints is not None:
+            transitions, first, last = self._constraints.masks()
+            scores[:, 0] += first
+        if masks is not None:
+            scores[:, 0] += masks[0]
+        back = numpy.zeros((T, Y, n), dtype=numpy.int64)
+        columns = numpy.arange(Y)
+        for t in range(1, T):
+            val = scores[:, :, None] + psi[t][:, None, :]
+            if self._constraints is not None:
+                val += transitions[:, None, :]
+            if masks is not None:
+                val += masks[t]
+            val = val.reshape((Y*n, Y))
+            order = numpy.argsort(-val, axis=0, kind="mergesort")[:n]
+            back[t] = order.T
+            scores = val[order, columns].T
+        
+        if self._constraints is not None:
+            scores = scores + last[:, None]
+        scores = scores.ravel()
+        decode = self._tagset.decode
+        results = []
+        for index in numpy.argsort(-scores, kind="mergesort")[:n].tolist():
+            sc = float(scores[index])
+            if sc == float("-inf"):
+                break
+            y, rank = divmod(index, n)
+            tag = [u""]*T
+            psc = [0.0]*T
+            for t in reversed(range(T)):
+                yp, previous_rank = (divmod(int(back[t, y, rank]), n) if t != 0 else (0, 0))
+                tag[t] = decode(y)
+                psc[t] = float(psi[t, yp, y])
+                y, rank = yp, previous_rank
+            results.append((tag, psc, sc))
+        
+        return results
+    
+    def forward_backward(self, sentence, candidates=None):
+        """
+        Runs the forward-backward algorithm on sentence in log space.
+        Returns the (psi, alpha, beta, log_z) quadruple where psi is the
+        T*Y*Y score cube of sentence, alpha[t][y] (resp. beta[t][y]) the log
+        of the summed scores of all partial taggings ending (resp. starting)
+        with label y at token t and log_z the log of the summed scores of
+        all taggings. Only the taggings allowed by constraints and
+        candidates are summed.
+        
+        The computation is delegated to the current backend, the numpy one
+        returns numpy arrays, the python one nested lists.
+        """
+        if self._backend == u"numpy":
+            return self._forward_backward_numpy(sentence, candidates)
+        return self._forward_backward_python(sentence, candidates)
+    
+    def _forward_backward_python(self, sentence, candidates=None):
+        Y = len(self._tagset)
+        T = len(sentence)
+        lowest = float("-inf")
+        states = self._states(candidates, T)
+        psi = self._psi_python(sentence, states)
+        constraints = self._constraints
+        if constraints is not None:
+            allowed = constraints.transitions
+        else:
+            allowed = [[True]*Y for _y in range(Y)]
+        
+        alpha = [[lowest]*Y for _t in range(T)]
+        beta = [[lowest]*Y for _t in range(T)]
+        if T == 0:
+            return psi, alpha, beta, 0.0
+        for y in states[0]:
+            if constraints is None or constraints.first[y]:
+                alpha[0][y] = psi[0][0][y]
+        for t in range(1, T):
+            for y in states[t]:
+                alpha[t][y] = _logsumexp([alpha[t-1][yp] + psi[t][yp][y] for yp in states[t-1] if allowed[yp][y]])
+        for y in states[T-1]:
+            if constraints is None or constraints.last[y]:
+                beta[T-1][y] = 0.0
+        for t in reversed(range(T-1)):
+            for yp in states[t]:
+                beta[t][yp] = _logsumexp([psi[t+1][yp][y] + beta[t+1][y] for y in states[t+1] if allowed[yp][y]])
+        log_z = _logsumexp([alpha[T-1][y] + beta[T-1][y] for y in states[T-1]])
+        
+        return psi, alpha, beta, log_z
+    
+    def _forward_backward_numpy(self, sentence, candidates=None):
+        T = len(sentence)
+        psi = self._psi_numpy(sentence)
+        Y = len(self._tagset)
+        if T == 0:
+            return psi, numpy.zeros((0, Y)), numpy.zeros((0, Y)), 0.0
+        
+        # forbidden transitions and labels are added to a copy of psi so
+        # that both passes can ignore them.
+        scores = psi.copy()
+        alpha = numpy.empty((T, Y))
+        beta = numpy.empty((T, Y))
+        alpha[0] = psi[0, 0]
+        beta[T-1] = 0.0
+        if self._constraints is not None:
+            transitions, first, last = self._constraints.masks()
+            scores[1:] += transitions
+            alpha[0] += first
+            beta[T-1] += last
+        if candidates is not None:
+            masks = self._state_masks(candidates, T)
+            scores[1:] += masks[1:, None, :]
+            alpha[0] += masks[0]
+            beta[T-1] += masks[T-1]
+        for t in range(1, T):
+            alpha[t] = _logsumexp_numpy(alpha[t-1][:, None] + scores[t], axis=0)
+        for t in reversed(range(T-1)):
+            beta[t] = _logsumexp_numpy(scores[t+1] + beta[t+1][None, :], axis=1)
+        log_z = float(_logsumexp_numpy(alpha[T-1] + beta[T-1], axis=0))
+        
+        return psi, alpha, beta, log_z
+    
+    def marginals(self, sentence, candidates=None):
+        """
+        Returns the T*Y matrix (as lists) of the marginal probabilities of
+        every label at every token of sentence.
+        """
+        psi, alpha, beta, log_z = self.forward_backward(sentence, candidates)
+        if self._backend == u"numpy":
+            return numpy.exp(alpha + beta - log_z).tolist()
+        return [[math.exp(a + b - log_z) for a, b in zip(alpha_t, beta_t)] for alpha_t, beta_t in zip(alpha, beta)]
+    
+    def span_probabilities(self, sentence, tags, spans, candidates=None):
+        """
+        Returns, for every (lb, ub) span of spans, the probability that
+        the tokens from lb (included) to ub (excluded) of sentence are
+        labeled with tags[lb : ub]. A span of length 1 gives the marginal
+        probability of a tag, the span of the whole sentence gives the
+        probability of the whole tagging.
+        """
+        psi, alpha, beta, log_z = self.forward_backward(sentence, candidates)
+        labels = [self._tagset.encode(tag) for tag in tags]
+        probabilities = []
+        for lb, ub in spans:
+            score = float(alpha[lb][labels[lb]])
+            for t in range(lb+1, ub):
+                score += float(psi[t][labels[t-1]][labels[t]])
+            score += float(beta[ub-1][labels[ub-1]])
+            probabilities.append(math.exp(score - log_z))
+        return probabilities
+    
     def write(self, filename, encoding="utf-8"):
-        with codecs.open(filename, "w", "utf-8") as O:
-            O.write("#mdl#2#%i\n" %(len([w for w in self.weights if w !=0.0])))
-            O.write("#rdr#%i/%i/0\n" %(len(self._templates), self._max_col))
+        """
+        Writes the model in Wapiti format. Strings are prefixed with their
+        length in bytes, as Wapiti does. Byte strings (models loaded without
+        an encoding) are written as they are.
+        """
+        def writestr(O, string):
+            if isinstance(string, unicode):
+                string = string.encode(encoding or "utf-8")
+            O.write(b"%i:%s,\n" %(len(string), string))
+        
+        weights = self._dense_weights()
+        if numpy is not None and isinstance(weights, numpy.ndarray):
+            indices = numpy.flatnonzero(weights)
+            nonzero = itertools.izip(indices.tolist(), weights[indices].tolist())
+        else:
+            nonzero = [(index, w) for index, w in enumerate(weights) if w != 0.0]
+            indices = nonzero
+        with open(filename, "wb") as O:
+            O.write(b"#mdl#2#%i\n" %(len(indices)))
+            O.write(b"#rdr#%i/%i/0\n" %(len(self._templates), self._max_col))
             for pattern in self._templates:
-                uni_pattern = unicode(pattern)
-                O.write("%i:%s,\n" %(len(uni_pattern), uni_pattern))
-            O.write(u"#qrk#%i\n" %(len(self._tagset)))
+                writestr(O, unicode(pattern))
+            O.write(b"#qrk#%i\n" %(len(self._tagset)))
             for tag in self.tagset:
-                O.write(u"%i:%s\n" %(len(tag), tag))
+                writestr(O, tag)
             # observations
-            O.write(u"#qrk#%i\n" %(len(self._observations)))
+            O.write(b"#qrk#%i\n" %(len(self._observations)))
             for obs in self._observations:
-                O.write(u"%i:%s\n" %(len(obs), obs))
-            for index, w in enumerate(self.weights):
-                if w != 0.0:
-                    O.write(u"%i=%s\n" %(index, float.hex(w)))
+                writestr(O, obs)
+            for index, w in nonzero:
+                O.write(b"%i=%s\n" %(index, float.hex(float(w))))
     
     def dump(self, filename):
         ntags = len(self.tagset)
@@ -0,0 +1,210 @@
+#-*- coding: utf-8 -*-
+
+"""
+file: observations.py
+
+Description: a compact index of the observations of a CRF model, based on
+64 bits hashes instead of a dictionary of strings.
+
+author: Yoann Dupont
+
+MIT License
+
+Copyright (c) 2018 Yoann Dupont
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import itertools
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# the hash of a string is the polynomial sum(b_i * HASH_BASE ** (n-i-1))
+# modulo 2 ** 64 of its bytes (+1, so that leading bytes count).
+HASH_BASE = 0x100000001b3
+_HASH_MODULUS = 1 << 64
+_HASH_MASK = _HASH_MODULUS - 1
+
+_powers = [1] # HASH_BASE ** i modulo 2 ** 64
+
+def string_hash(string):
+    """
+    Returns the hash of string (the utf-8 bytes of unicode strings, byte
+    strings being hashed as they are) and HASH_BASE to the power of its
+    length, both modulo 2 ** 64. The hash of a concatenation can be
+    computed from those of its parts (see concat_hash), so that the hash
+    of an observation is computed from the hashes of the constant parts
+    of its template and of the values it was instanciated with, without
+    building its string (see CompiledTemplates.hashes).
+    """
+    if isinstance(string, unicode):
+        string = string.encode("utf-8")
+    value = 0
+    for byte in bytearray(string):
+        value = (value * HASH_BASE + byte + 1) & _HASH_MASK
+    return value, pow(HASH_BASE, len(string), _HASH_MODULUS)
+
+def concat_hash(first, second):
+    """
+    Returns the (hash, power) of the concatenation of two strings given
+    their (hash, power) (see string_hash).
+    """
+    return (first[0] * second[1] + second[0]) & _HASH_MASK, (first[1] * second[1]) & _HASH_MASK
+
+def observation_hash(observation):
+    """
+    The 64 bits hash of an observation, as a signed integer. It only
+    depends on the bytes of the observation, it is the same for every
+    interpreter and platform and can be stored.
+    """
+    value = string_hash(observation)[0]
+    return (value - _HASH_MODULUS if value >> 63 else value)
+
+def _power_table(length):
+    while len(_powers) <= length:
+        _powers.append((_powers[-1] * HASH_BASE) & _HASH_MASK)
+    return numpy.array(_powers[: length + 1], dtype=numpy.uint64)
+
+def hash_strings(strings, chunk_size=65536):
+    """
+    Returns the hashes of strings (see observation_hash) as an int64 array,
+    computed chunk_size strings at a time. Requires numpy.
+    """
+    hashes = numpy.zeros(len(strings), dtype=numpy.uint64)
+    for first in range(0, len(strings), chunk_size):
+        encoded = [(s.encode("utf-8") if isinstance(s, unicode) else s) for s in strings[first : first + chunk_size]]
+        lengths = numpy.fromiter(itertools.imap(len, encoded), dtype=numpy.int64, count=len(encoded))
+        total = int(lengths.sum())
+        if total == 0:
+            continue
+        data = numpy.frombuffer(b"".join(encoded), dtype=numpy.uint8).astype(numpy.uint64) + numpy.uint64(1)
+        ends = numpy.cumsum(lengths)
+        # every byte is multiplied by HASH_BASE to the number of bytes after it
+        exponents = numpy.repeat(ends, lengths) - 1 - numpy.arange(total)
+        terms = data * _power_table(int(lengths.max()))[exponents]
+        nonempty = numpy.flatnonzero(lengths)
+        hashes[first + nonempty] = numpy.add.reduceat(terms, (ends - lengths)[nonempty])
+    return hashes.view(numpy.int64)
+
+class HashedObservations(object):
+    """
+    A read-only index of observations, with the same encode/decode interface
+    as sem.coder.Coder.
+
+    Observations are looked up by hash in a sorted int64 array, ids[i] being
+    the id of the observation whose hash is hashes[i]. It takes 12 bytes per
+    observation instead of a dictionary entry and a unicode string.
+    Observation strings are optional: without them, decode returns None and
+    the index cannot be iterated over. If verify is True, the string of
+    every observation found is compared to the one looked up, so that
+    unknown observations colliding with a known one are not mistaken for it.
+
+    Requires numpy.
+    """
+
+    def __init__(self, hashes, ids, strings=None, verify=False):
+        if numpy is None:
+            raise ValueError(u"hashed observations require numpy")
+        if verify and strings is None:
+            raise ValueError(u"observation strings are required to verify hashes")
+        self._hashes = hashes
+        self._ids = ids
+        self._strings = strings
+        self._verify = verify
+
+    @classmethod
+    def from_strings(cls, strings, keep_strings=True, verify=False):
+        """
+        Creates the index of a list of observations, the id of strings[i]
+        being i.
+        """
+        if numpy is None:
+            raise ValueError(u"hashed observations require numpy")
+        hashes = hash_strings(strings)
+        order = numpy.argsort(hashes, kind="mergesort")
+        hashes = hashes[order]
+        if len(hashes) > 1 and (hashes[1:] == hashes[:-1]).any():
+            first = int(numpy.flatnonzero(hashes[1:] == hashes[:-1])[0])
+            raise ValueError(u"hash collision between observations %s and %s" %(strings[order[first]], strings[order[first+1]]))
+        return cls(hashes, order.astype(numpy.int32), (strings if keep_strings else None), verify=verify)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, element):
+        return self.encode(element) != -1
+
+    @property
+    def hashes(self):
+        return self._hashes
+
+    @property
+    def ids(self):
+        return self._ids
+
+    @property
+    def strings(self):
+        return self._strings
+
+    @property
+    def verify(self):
+        return self._verify
+
+    @property
+    def nbytes(self):
+        return self._hashes.nbytes + self._ids.nbytes
+
+    def keys(self):
+        if self._strings is None:
+            raise ValueError(u"observation strings were not kept")
+        return list(self._strings)
+
+    def encode(self, element):
+        return self.encode_many([element])[0]
+
+    def encode_many(self, elements):
+        """
+        Returns the list of the ids of elements, -1 for unknown ones.
+        """
+        ids = self.encode_hashes(hash_strings(elements))
+        if self._verify:
+            ids = [(i if i == -1 or self._strings[i] == element else -1) for i, element in itertools.izip(ids, elements)]
+        return ids
+
+    def encode_hashes(self, hashes):
+        """
+        Returns the list of the ids of the observations whose hashes are
+        given (see observation_hash), -1 for unknown ones. Hashes are not
+        verified against strings.
+        """
+        if len(self._hashes) == 0 or len(hashes) == 0:
+            return [-1] * len(hashes)
+        positions = numpy.minimum(numpy.searchsorted(self._hashes, hashes), len(self._hashes)-1)
+        return numpy.where(self._hashes[positions] == hashes, self._ids[positions], -1).tolist()
+
+    def decode(self, integer):
+        if self._strings is None or not 0 <= integer < len(self._ids):
+            return None
+        return self._strings[integer]
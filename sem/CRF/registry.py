@@ -0,0 +1,188 @@
+#-*- coding: utf-8 -*-
+
+"""
+file: registry.py
+
+Description: a process-wide registry of loaded CRF models, so that
+annotators using the same model share a single copy of it.
+
+author: Yoann Dupont
+
+MIT License
+
+Copyright (c) 2018 Yoann Dupont
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import collections
+import os.path
+import threading
+
+from sem.CRF.model import Model
+
+def resident_size(model):
+    """
+    The number of bytes used by the weights, offsets and observation index
+    of a model, including the numpy copy of its weights if it was made.
+    """
+    size = model.nbytes
+    if model._np_weights is not None:
+        size += model._np_weights.nbytes
+    observations = model.observations
+    if hasattr(observations, "nbytes"):
+        size += observations.nbytes
+    return size
+
+class _Entry(object):
+    def __init__(self, model):
+        self.model = model
+        self.users = 0
+
+class ModelRegistry(object):
+    """
+    Shares loaded models per (path, modification time, encoding, weight
+    type). acquire returns the shared model and counts its users, release
+    tells that a user is done with it.
+
+    Shared models must not be modified: users that need their own
+    constraints or backend should work on a view (see Model.view).
+    When a model file changes, the next acquire loads it again, the old
+    model being dropped once it has no users left.
+    Unused models are kept for later use, the least recently used ones
+    being evicted when the models in the registry take more than budget
+    bytes (None for no limit). Models in use are never evicted.
+    """
+
+    def __init__(self, budget=None):
+        self._budget = budget
+        self._entries = collections.OrderedDict() # least recently used first
+        self._keys = {} # id(model) -> key
+        self._lock = threading.RLock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    @property
+    def budget(self):
+        return self._budget
+
+    @budget.setter
+    def budget(self, budget):
+        with self._lock:
+            self._budget = (int(budget) if budget is not None else None)
+            self._evict()
+
+    def acquire(self, filename, encoding="utf-8", dtype=u"float64"):
+        """
+        Returns the shared model in filename, loading it if needed (see
+        Model.load), and counts one more user.
+        """
+        path = os.path.abspath(filename)
+        key = (path, os.path.getmtime(path), encoding, dtype)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self._misses += 1
+                for stale in [k for k in self._entries if k[0] == path and k[2:] == key[2:] and self._entries[k].users == 0]:
+                    self._remove(stale)
+                    self._invalidations += 1
+                model = Model.load(path, encoding=encoding, dtype=dtype)
+                entry = _Entry(model)
+                self._keys[id(model)] = key
+            else:
+                self._hits += 1
+            entry.users += 1
+            self._entries[key] = entry
+            self._evict()
+            return entry.model
+
+    def release(self, model):
+        """
+        Counts one less user of a model returned by acquire.
+        """
+        with self._lock:
+            key = self._keys.get(id(model))
+            if key is None:
+                raise ValueError(u"model not in registry")
+            entry = self._entries[key]
+            if entry.users <= 0:
+                raise ValueError(u"model released more times than acquired")
+            entry.users -= 1
+            if entry.users == 0 and self._is_stale(key):
+                self._remove(key)
+                self._invalidations += 1
+            self._evict()
+
+    def clear(self):
+        """
+        Removes the models that are not in use.
+        """
+        with self._lock:
+            for key in [k for k, entry in self._entries.items() if entry.users == 0]:
+                self._remove(key)
+
+    def stats(self):
+        """
+        Returns the number of hits, misses, evictions and invalidations
+        (models dropped because their file changed), the number of models
+        (in use or not) and the resident size of all models, in bytes.
+        """
+        with self._lock:
+            return {
+                u"hits": self._hits,
+                u"misses": self._misses,
+                u"evictions": self._evictions,
+                u"invalidations": self._invalidations,
+                u"models": len(self._entries),
+                u"in_use": sum(1 for entry in self._entries.values() if entry.users > 0),
+                u"resident": sum(resident_size(entry.model) for entry in self._entries.values()),
+                u"budget": self._budget
+            }
+
+    def _is_stale(self, key):
+        try:
+            return os.path.getmtime(key[0]) != key[1]
+        except OSError:
+            return True
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        del self._keys[id(entry.model)]
+
+    def _evict(self):
+        if self._budget is None:
+            return
+        # sizes are computed every time: views may add numpy weights later
+        resident = sum(resident_size(entry.model) for entry in self._entries.values())
+        for key in [k for k, entry in self._entries.items() if entry.users == 0]:
+            if resident <= self._budget:
+                break
+            resident -= resident_size(self._entries[key].model)
+            self._remove(key)
+            self._evictions += 1
+
+_registry = ModelRegistry()
+
+def registry():
+    """
+    Returns the registry shared by the whole process.
+    """
+    return _registry
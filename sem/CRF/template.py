@@ -28,7 +28,16 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import codecs
 import re
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from sem.CRF.observations import string_hash
 
 UNICODE_LOWERS = u"a-zµßàáâãäåæçèéêëìíîïðñòóôõöøùúûüýþÿāăąćĉċčďđēĕėęěĝğġģĥħĩīĭįıĳĵķĸĺļľŀłńņňŉŋōŏőœŕŗřśŝşšţťŧũūŭůűųŵŷźżžſƀƃƅƈƌƍƒƕƙƚƛƞơƣƥƨƪƫƭưƴƶƹƺƽƾƿǆǉǌǎǐǒǔǖǘǚǜǝǟǡǣǥǧǩǫǭǯǰǳǵǹǻǽǿȁȃȅȇȉȋȍȏȑȓȕȗșțȝȟȡȣȥȧȩȫȭȯȱȳȴȵȶȸȹȼȿɀɂɇɉɋɍɏɐɑɒɓɔɕɖɗɘəɚɛɜɝɞɟɠɡɢɣɤɥɦɧɨɩɪɫɬɭɮɯɰɱɲɳɴɵɶɷɸɹɺɻɼɽɾɿʀʁʂʃʄʅʆʇʈʉʊʋʌʍʎʏʐʑʒʓʕʖʗʘʙʚʛʜʝʞʟʠʡʢʣʤʥʦʧʨʩʪʫʬʭʮʯͻͼͽΐάέήίΰαβγδεζηθικλμνξοπρςστυφχψωϊϋόύώϐϑϕϖϗϙϛϝϟϡϣϥϧϩϫϭϯϰϱϲϳϵϸϻϼабвгдежзийклмнопрстуфхцчшщъыьэюяѐёђѓєѕіїјљњћќѝўџѡѣѥѧѩѫѭѯѱѳѵѷѹѻѽѿҁҋҍҏґғҕҗҙқҝҟҡңҥҧҩҫҭүұҳҵҷҹһҽҿӂӄӆӈӊӌӎӏӑӓӕӗәӛӝӟӡӣӥӧөӫӭӯӱӳӵӷӹӻӽӿԁԃԅԇԉԋԍԏԑԓԛԝաբգդեզէըթժիլխծկհձղճմյնշոչպջռսվտրցւփքօֆևᴀᴁᴂᴃᴄᴅᴆᴇᴈᴉᴊᴋᴌᴍᴎᴏᴐᴑᴒᴓᴔᴕᴖᴗᴘᴙᴚᴛᴜᴝᴞᴟᴠᴡᴢᴣᴤᴥᴦᴧᴨᴩᴪᴫᵫᵬᵭᵮᵯᵰᵱᵲᵳᵴᵵᵶᵷᵹᵺᵻᵼᵽᵾᵿᶀᶁᶂᶃᶄᶅᶆᶇᶈᶉᶊᶋᶌᶍᶎᶏᶐᶑᶒᶓᶔᶕᶖᶗᶘᶙᶚḁḃḅḇḉḋḍḏḑḓḕḗḙḛḝḟḡḣḥḧḩḫḭḯḱḳḵḷḹḻḽḿṁṃṅṇṉṋṍṏṑṓṕṗṙṛṝṟṡṣṥṧṩṫṭṯṱṳṵṷṹṻṽṿẁẃẅẇẉẋẍẏẑẓẕẗẘẙẚẛạảấầẩẫậắằẳẵặẹẻẽếềểễệỉịọỏốồổỗộớờởỡợụủứừửữựỳỵỷỹἀἁἂἃἄἅἆἇἐἑἒἓἔἕἠἡἢἣἤἥἦἧἰἱἲἳἴἵἶἷὀὁὂὃὄὅὐὑὒὓὔὕὖὗὠὡὢὣὤὥὦὧὰάὲέὴήὶίὸόὺύὼώᾀᾁᾂᾃᾄᾅᾆᾇᾐᾑᾒᾓᾔᾕᾖᾗᾠᾡᾢᾣᾤᾥᾦᾧᾰᾱᾲᾳᾴᾶᾷιῂῃῄῆῇῐῑῒΐῖῗῠῡῢΰῤῥῦῧῲῳῴῶῷℓⅎↄⱡⱥⱦⱨⱪⱬⱱⱳⱴⱶⱷ"
 UNICODE_UPPERS = u"A-ZÀÁÂÃÄÅÆÇÈÉÊËÌÍÎÏÐÑÒÓÔÕÖØÙÚÛÜÝÞĀĂĄĆĈĊČĎĐĒĔĖĘĚĜĞĠĢĤĦĨĪĬĮİĲĴĶĹĻĽĿŁŃŅŇŊŌŎŐŒŔŖŘŚŜŞŠŢŤŦŨŪŬŮŰŲŴŶŸŹŻŽƁƂƄƆƇƉƊƋƎƏƐƑƓƔƖƗƘƜƝƟƠƢƤƦƧƩƬƮƯƱƲƳƵƷƸƼǄǇǊǍǏǑǓǕǗǙǛǞǠǢǤǦǨǪǬǮǱǴǶǷǸǺǼǾȀȂȄȆȈȊȌȎȐȒȔȖȘȚȜȞȠȢȤȦȨȪȬȮȰȲȺȻȽȾɁɃɄɅɆɈɊɌɎΆΈΉΊΌΎΏΑΒΓΔΕΖΗΘΙΚΛΜΝΞΟΠΡΣΤΥΦΧΨΩΪΫϏϒϓϔϘϚϜϞϠϢϤϦϨϪϬϮϴϷϹϺϽϾϿЀЁЂЃЄЅІЇЈЉЊЋЌЍЎЏАБВГДЕЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯѠѢѤѦѨѪѬѮѰѲѴѶѸѺѼѾҀҊҌҎҐҒҔҖҘҚҜҞҠҢҤҦҨҪҬҮҰҲҴҶҸҺҼҾӀӁӃӅӇӉӋӍӐӒӔӖӘӚӜӞӠӢӤӦӨӪӬӮӰӲӴӶӸӺӼӾԀԂԄԆԈԊԌԎԐԒԚԜԱԲԳԴԵԶԷԸԹԺԻԼԽԾԿՀՁՂՃՄՅՆՇՈՉՊՋՌՍՎՏՐՑՒՓՔՕՖᎠᎡᎢᎣᎤᎥᎦᎧᎨᎩᎪᎫᎬᎭᎮᎯᎰᎱᎲᎳᎴᎵᎶᎷᎸᎹᎺᎻᎼᎽᎾᎿᏀᏁᏂᏃᏄᏅᏆᏇᏈᏉᏊᏋᏌᏍᏎᏏᏐᏑᏒᏓᏔᏕᏖᏗᏘᏙᏚᏛᏜᏝᏞᏟᏠᏡᏢᏣᏤᏥᏦᏧᏨᏩᏪᏫᏬᏭᏮᏯᏰᏱᏲᏳᏴᏵḀḂḄḆḈḊḌḎḐḒḔḖḘḚḜḞḠḢḤḦḨḪḬḮḰḲḴḶḸḺḼḾṀṂṄṆṈṊṌṎṐṒṔṖṘṚṜṞṠṢṤṦṨṪṬṮṰṲṴṶṸṺṼṾẀẂẄẆẈẊẌẎẐẒẔẞẠẢẤẦẨẪẬẮẰẲẴẶẸẺẼẾỀỂỄỆỈỊỌỎỐỒỔỖỘỚỜỞỠỢỤỦỨỪỬỮỰỲỴỶỸἈἉἊἋἌἍἎἏἘἙἚἛἜἝἨἩἪἫἬἭἮἯἸἹἺἻἼἽἾἿὈὉὊὋὌὍὙὛὝὟὨὩὪὫὬὭὮὯᾸᾹᾺΆῈΈῊΉῘῙῚΊῨῩῪΎῬῸΌῺΏⱠⱢⱣⱤⱧⱩⱫⱭⱲⱵＡＢＣＤＥＦＧＨＩＪＫＬＭＮＯＰＱＲＳＴＵＶＷＸＹＺ𐐀𐐁𐐂𐐃𐐄𐐅𐐆𐐇𐐈𐐉𐐊𐐋𐐌𐐍𐐎𐐏𐐐𐐑𐐒𐐓𐐔𐐕𐐖𐐗𐐘𐐙𐐚𐐛𐐜𐐝𐐞𐐟𐐠𐐡𐐢𐐣𐐤𐐥𐐦𐐧"
@@ -37,11 +46,28 @@ UNICODE_PUNCTS = u"-֊־᠆‒–—―⸗〜〰゠︱﹣－_︳︴﹍﹎﹏＿\
 UNICODE_ALPHAS = UNICODE_LOWERS + UNICODE_UPPERS
 UNICODE_ALPHANUMS = UNICODE_ALPHAS + UNICODE_DIGITS
 
+# values of cells outside of the sentence, the same as Wapiti's
+BEFORE_SENTENCE = (u"_x-1", u"_x-2", u"_x-3", u"_x-4", u"_x-#")
+AFTER_SENTENCE = (u"_x+1", u"_x+2", u"_x+3", u"_x+4", u"_x+#")
+
+_ASCII_LOWER = dict((ord(c), ord(c.lower())) for c in u"ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+
+def lower_ascii(string):
+    """
+    Lowercases ASCII letters only, as Wapiti does for uppercase commands
+    (%X, %T and %M).
+    """
+    return unicode(string).translate(_ASCII_LOWER)
+
 class Pattern(object):
     def __init__(self, case_insensitive=False, *args):
         self._case_insensitive = case_insensitive
         pass
     
+    @property
+    def case_insensitive(self):
+        return self._case_insensitive
+    
     def instanciate(self, matrix, index):
         raise RuntimeError("undefined")
 
@@ -63,35 +89,42 @@ class ConstantPattern(Pattern):
         return self._value
 
 class IdentityPattern(Pattern):
-    __pattern = re.compile(u"%x\\[(-?[0-9]+),([0-9]+)\\]")
+    __pattern = re.compile(u"%x\\[(-?[0-9]+),([0-9]+)\\]", re.I)
     
     def __init__(self, x, y, case_insensitive=False, column=None, *args):
+        super(IdentityPattern, self).__init__(case_insensitive)
         self._x = x
         self._y = y
         self._column = column
     
     def __str__(self):
-        return '%%x[%i,%i]' %(self.x, self.y)
+        return '%%%s[%i,%i]' %(self.command, self.x, self.y)
     
     def __unicode__(self):
-        return u'%%x[%i,%i]' %(self.x, self.y)
+        return u'%%%s[%i,%i]' %(self.command, self.x, self.y)
     
-    def instanciate(self, matrix, index):
+    @property
+    def command(self):
+        return (u"X" if self._case_insensitive else u"x")
+    
+    def cell(self, matrix, index):
+        """
+        The value of the cell this pattern refers to, or a special value if
+        it is outside of the sentence.
+        """
         x = index + self.x
         if x < 0:
-            if x > -5:
-                return "_x%+d" %x
-            else:
-                return "_x-#"
+            return BEFORE_SENTENCE[min(-x - 1, 4)]
         if x >= len(matrix):
-            diff = x - len(matrix) + 1
-            if diff < 5:
-                return "_x%+d" %diff
-            else:
-                return u"_x+#"
+            return AFTER_SENTENCE[min(x - len(matrix), 4)]
         
         return unicode(matrix[x][self.y])
     
+    def instanciate(self, matrix, index):
+        if self._case_insensitive:
+            return lower_ascii(self.cell(matrix, index))
+        return self.cell(matrix, index)
+    
     @property
     def x(self):
         return self._x
@@ -126,7 +159,7 @@ class RegexPattern(IdentityPattern):
              }
     
     def __init__(self, x, y, pattern, case_insensitive=False, *args):
-        super(RegexPattern, self).__init__(x, y, *args)
+        super(RegexPattern, self).__init__(x, y, case_insensitive=case_insensitive, *args)
         self._pattern = pattern
         for key, value in RegexPattern.__sub.items():
             self._pattern = self._pattern.replace(key, value)
@@ -148,16 +181,20 @@ class TestPattern(RegexPattern):
         p = self._pattern.pattern[:]
         for x,y in RegexPattern.sub().items():
             p = p.replace(y, x)
-        return u'%%t[%i,%i,"%s"]' %(self.x, self.y, p)
+        return u'%%%s[%i,%i,"%s"]' %(self.command, self.x, self.y, p)
     
     def __unicode__(self):
         p = self._pattern.pattern[:]
         for x,y in RegexPattern.sub().items():
             p = p.replace(y, x)
-        return u'%%t[%i,%i,"%s"]' %(self.x, self.y, p)
+        return u'%%%s[%i,%i,"%s"]' %(self.command, self.x, self.y, p)
+    
+    @property
+    def command(self):
+        return (u"T" if self._case_insensitive else u"t")
     
     def instanciate(self, matrix, index, case_insensitive=False):
-        cell = super(TestPattern, self).instanciate(matrix, index)
+        cell = self.cell(matrix, index)
         
         return unicode(self._pattern.search(cell) is not None).lower()
     
@@ -174,21 +211,26 @@ class MatchPattern(RegexPattern):
         p = self._pattern.pattern[:]
         for x,y in RegexPattern.sub().items():
             p = p.replace(y, x)
-        return u'%%m[%i,%i,"%s"]' %(self.x, self.y, p)
+        return u'%%%s[%i,%i,"%s"]' %(self.command, self.x, self.y, p)
     
     def __unicode__(self):
         p = self._pattern.pattern[:]
         for x,y in RegexPattern.sub().items():
             p = p.replace(y, x)
-        return u'%%m[%i,%i,"%s"]' %(self.x, self.y, p)
+        return u'%%%s[%i,%i,"%s"]' %(self.command, self.x, self.y, p)
+    
+    @property
+    def command(self):
+        return (u"M" if self._case_insensitive else u"m")
     
     def instanciate(self, matrix, index, case_insensitive=False):
-        cell = super(MatchPattern, self).instanciate(matrix, index)
+        cell = self.cell(matrix, index)
         
         cell = self._pattern.search(cell)
         if cell is None:
-            return ""
-        
+            return u""
+        if self._case_insensitive:
+            return lower_ascii(cell.group())
         return cell.group()
     
     @classmethod
@@ -200,14 +242,19 @@ class MatchPattern(RegexPattern):
 class ListPattern(Pattern):
     __pattern = re.compile(r'%[xtm]\[\s*-?[0-9]+,-?[0-9]+(,".+?")?\]', re.I)
     
-    def __init__(self, patterns):
+    def __init__(self, patterns, source=None):
         self._patterns = patterns[:]
         self._instanciators = [pattern.instanciate for pattern in self._patterns]
+        self._source = source # the string the patterns were read from, if any
     
     def __str__(self):
+        if self._source is not None:
+            return self._source.encode("utf-8")
         return ''.join([str(p) for p in self._patterns])
     
     def __unicode__(self):
+        if self._source is not None:
+            return self._source
         return u''.join([unicode(p) for p in self._patterns])
     
     @property
@@ -230,14 +277,244 @@ class ListPattern(Pattern):
             patterns.append(ConstantPattern(string))
         elif string[prev:]:
             patterns.append(ConstantPattern(string[prev : ]))
-        return ListPattern(patterns)
+        return ListPattern(patterns, source=string)
 
 def pattern_factory(string):
     low = string.lower()
-    if string.startswith("%x"):
+    if low.startswith("%x"):
         return IdentityPattern.from_string(string, case_insensitive=string[1].isupper(), column=None)
-    elif string.startswith("%t"):
+    elif low.startswith("%t"):
         return TestPattern.from_string(string, case_insensitive=string[1].isupper(), column=None)
-    elif string.startswith("%m"):
+    elif low.startswith("%m"):
         return MatchPattern.from_string(string, case_insensitive=string[1].isupper(), column=None)
     return ConstantPattern(string)
+
+def read_patterns(filename, encoding="utf-8"):
+    """
+    Reads the templates of a Wapiti pattern file: one template per line,
+    "#" starting a comment, empty lines being ignored.
+    """
+    templates = []
+    with codecs.open(filename, "rU", encoding) as input_stream:
+        for line in input_stream:
+            line = line.split(u"#", 1)[0].rstrip()
+            if line:
+                templates.append(ListPattern.from_string(line[0].lower() + line[1:]))
+    return templates
+
+class CompiledTemplates(object):
+    """
+    A list of templates compiled into a plan that produces, in one pass over
+    a sentence, the observations of every template at every token.
+    
+    The columns used by templates are read once per sentence and padded with
+    the values of out of sentence cells, so that a %x item is a slice of its
+    column. The results of %t and %m items are cached for every cell value
+    (at most cache_size values per item).
+    Templates are expected to only contain the patterns defined in this
+    module, other patterns are instanciated token by token.
+    The hashes of observations (see sem.CRF.observations) can also be
+    computed from the hashes of the constant parts of templates and of
+    cell values, without building observation strings. Constants and cell
+    values are hashed once (at most cache_size values), the results of %t
+    and %m items are computed once for every cell, and the hashes of all the
+    templates of a sentence are combined at once with numpy.
+    """
+    
+    def __init__(self, templates, cache_size=100000):
+        self._templates = templates[:]
+        self._cache_size = cache_size
+        self._columns = set()
+        self._padding = 0
+        self._plans = []
+        self._hash_plans = []
+        self._hash_lock = threading.Lock()
+        self._kinds = []
+        for template in self._templates:
+            formats = []
+            items = []
+            steps = [] # item index, None for constants, and constant value
+            for pattern in template.patterns:
+                if type(pattern) == ConstantPattern:
+                    formats.append(pattern.value.replace(u"%", u"%%"))
+                    if steps and steps[-1][0] is None:
+                        steps[-1] = (None, steps[-1][1] + pattern.value)
+                    else:
+                        steps.append((None, pattern.value))
+                elif type(pattern) in (IdentityPattern, TestPattern, MatchPattern):
+                    formats.append(u"%s")
+                    regex = (pattern._pattern if type(pattern) != IdentityPattern else None)
+                    items.append((pattern.x, pattern.y, pattern.case_insensitive, regex, type(pattern) == TestPattern, {}))
+                    steps.append((len(items)-1, None))
+                    self._columns.add(pattern.y)
+                    self._padding = max(self._padding, abs(pattern.x))
+                else:
+                    formats.append(u"%s")
+                    items.append(pattern)
+                    steps.append((len(items)-1, None))
+            self._plans.append((u"".join(formats), items))
+            self._hash_plans.append(steps)
+            # the kind of observation ("u", "b" or "*") if it does not depend on the sentence
+            self._kinds.append(formats[0][0] if formats and formats[0] and not formats[0].startswith(u"%") else None)
+        self._clear_hashes()
+    
+    @property
+    def templates(self):
+        return self._templates
+    
+    @property
+    def kinds(self):
+        return self._kinds
+    
+    def _columns_of(self, sentence):
+        """
+        Returns the padded columns used by templates.
+        """
+        before = [BEFORE_SENTENCE[min(self._padding - i - 1, 4)] for i in range(self._padding)]
+        after = [AFTER_SENTENCE[min(i, 4)] for i in range(self._padding)]
+        return dict((y, before + [unicode(token[y]) for token in sentence] + after) for y in self._columns)
+    
+    def _search(self, cells, regex, is_test, case_insensitive, cache):
+        values = []
+        for cell in cells:
+            value = cache.get(cell)
+            if value is None:
+                match = regex.search(cell)
+                if is_test:
+                    value = (u"true" if match is not None else u"false")
+                else:
+                    value = (match.group() if match is not None else u"")
+                    if case_insensitive:
+                        value = lower_ascii(value)
+                if len(cache) >= self._cache_size:
+                    cache.clear()
+                cache[cell] = value
+            values.append(value)
+        return values
+    
+    def instanciate(self, sentence):
+        """
+        Returns the observations of sentence: the k-th element is the list
+        of the observations of the k-th template for every token.
+        """
+        T = len(sentence)
+        columns = self._columns_of(sentence)
+        lowered = {}
+        pad = self._padding
+        observations = []
+        for fmt, items in self._plans:
+            values = []
+            for item in items:
+                if isinstance(item, Pattern):
+                    values.append([item.instanciate(sentence, t) for t in range(T)])
+                    continue
+                x, y, case_insensitive, regex, is_test, cache = item
+                if regex is not None:
+                    values.append(self._search(columns[y][pad+x : pad+x+T], regex, is_test, case_insensitive, cache))
+                elif case_insensitive:
+                    if y not in lowered:
+                        lowered[y] = [lower_ascii(cell) for cell in columns[y]]
+                    values.append(lowered[y][pad+x : pad+x+T])
+                else:
+                    values.append(columns[y][pad+x : pad+x+T])
+            if not values:
+                observations.append([fmt % ()] * T)
+            elif len(values) == 1:
+                observations.append([fmt % value for value in values[0]])
+            else:
+                observations.append([fmt % value for value in zip(*values)])
+        return observations
+    
+    def _clear_hashes(self):
+        self._hash_ids = {} # value -> id
+        self._hash_values = [] # id -> value
+        self._hash_maps = {} # transformation -> id of the transformed value by cell id, -1 if unknown
+        if numpy is None:
+            return
+        self._hash_pool = numpy.zeros((1024, 2), dtype=numpy.uint64) # id -> (hash, power)
+        # ids of step j of template k, items are filled for each sentence
+        # and missing steps are empty strings, which do not change hashes.
+        n_steps = max([len(steps) for steps in self._hash_plans] or [0])
+        self._hash_steps = numpy.empty((n_steps, len(self._hash_plans)), dtype=numpy.intp)
+        self._hash_steps.fill(self._value_ids([u""])[0])
+        self._hash_items = []
+        for k, (steps, (fmt, items)) in enumerate(zip(self._hash_plans, self._plans)):
+            for j, (index, constant) in enumerate(steps):
+                if index is None:
+                    self._hash_steps[j, k] = self._value_ids([constant])[0]
+                else:
+                    self._hash_items.append((j, k, items[index]))
+    
+    def _value_ids(self, values):
+        """
+        Returns the ids of values in the pool of hashed values, as an array.
+        """
+        ids = self._hash_ids
+        result = []
+        for value in values:
+            i = ids.get(value)
+            if i is None:
+                i = len(self._hash_values)
+                if i == len(self._hash_pool):
+                    self._hash_pool = numpy.concatenate([self._hash_pool, numpy.zeros_like(self._hash_pool)])
+                self._hash_pool[i] = string_hash(value)
+                self._hash_values.append(value)
+                ids[value] = i
+            result.append(i)
+        return numpy.array(result, dtype=numpy.intp)
+    
+    def _transformed_ids(self, key, function, cell_ids):
+        """
+        Returns the ids of function(cell) for the cells whose ids are
+        given, function being called once per cell (see _value_ids).
+        """
+        mapping = self._hash_maps.get(key)
+        if mapping is None or len(mapping) < len(self._hash_values):
+            grown = numpy.empty(len(self._hash_pool), dtype=numpy.intp)
+            grown.fill(-1)
+            if mapping is not None:
+                grown[: len(mapping)] = mapping
+            mapping = self._hash_maps[key] = grown
+        result = mapping[cell_ids]
+        if (result < 0).any():
+            missing = numpy.unique(cell_ids[result < 0])
+            mapping[missing] = self._value_ids([function(self._hash_values[i]) for i in missing.tolist()])
+            result = mapping[cell_ids]
+        return result
+    
+    def hashes(self, sentence):
+        """
+        Returns the hashes of the observations of sentence as an int64
+        array: the k-th row holds the hashes of the observations of the k-th
+        template for every token (see instanciate and
+        sem.CRF.observations.observation_hash). Requires numpy.
+        """
+        with self._hash_lock:
+            if len(self._hash_values) >= self._cache_size:
+                self._clear_hashes()
+            T = len(sentence)
+            column_ids = dict((y, self._value_ids(cells)) for y, cells in self._columns_of(sentence).items())
+            pad = self._padding
+            ids = numpy.repeat(self._hash_steps[:, :, numpy.newaxis], T, axis=2)
+            transformed = {} # padded columns of transformed cells
+            for j, k, item in self._hash_items:
+                if isinstance(item, Pattern):
+                    ids[j, k] = self._value_ids([item.instanciate(sentence, t) for t in range(T)])
+                    continue
+                x, y, case_insensitive, regex, is_test, cache = item
+                key = (y, regex, is_test, case_insensitive)
+                column = transformed.get(key)
+                if column is None:
+                    column = column_ids[y]
+                    if regex is not None:
+                        column = self._transformed_ids(key[1:], lambda cell: self._search([cell], regex, is_test, case_insensitive, cache)[0], column)
+                    elif case_insensitive:
+                        column = self._transformed_ids(None, lower_ascii, column)
+                    transformed[key] = column
+                ids[j, k] = column[pad+x : pad+x+T]
+            pairs = self._hash_pool[ids]
+            current = pairs[0, :, :, 0].copy() if len(pairs) else numpy.zeros((len(self._plans), T), dtype=numpy.uint64)
+            for step in pairs[1:]:
+                current *= step[:, :, 1]
+                current += step[:, :, 0]
+            return current.view(numpy.int64)
@@ -0,0 +1,368 @@
+#-*- coding: utf-8 -*-
+
+"""
+file: trainer.py
+
+Description: a CRF trainer written with numpy, which gives models in the
+layout of sem.CRF.model.Model, so that they can be written in Wapiti
+format. Training does not require the Wapiti binary.
+
+author: Yoann Dupont
+
+MIT License
+
+Copyright (c) 2018 Yoann Dupont
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import ctypes
+import itertools
+import logging
+import multiprocessing
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from sem.coder import Coder
+from sem.logger import default_handler
+from sem.CRF.model import Model, offset_buffer, _logsumexp_numpy
+from sem.CRF.template import CompiledTemplates
+from sem.misc import shard
+
+trainer_logger = logging.getLogger("sem.CRF.trainer")
+trainer_logger.addHandler(default_handler)
+
+def _sum_at(indices, values, size):
+    """
+    Returns the array of size sums of the values at each index.
+    """
+    return numpy.bincount(indices, weights=values, minlength=size).astype(numpy.float64, copy=False)
+
+class _Bucket(object):
+    """
+    Sentences of similar lengths whose features are indexed once, so that
+    their scores and gradient are computed at once for every weight
+    vector. Features are stored as the positions (sentence * length + token)
+    where they occur and the index of their offset in the unique offsets of
+    the bucket.
+    """
+    def __init__(self, sentences, Y):
+        self.B = len(sentences)
+        self.T = max(len(gold) for gold, _, _ in sentences)
+        self.lengths = numpy.array([len(gold) for gold, _, _ in sentences], dtype=numpy.int64)
+        self.gold = numpy.zeros((self.B, self.T), dtype=numpy.int64)
+        u_pos, u_off, b_pos, b_off = [], [], [], []
+        for b, (gold, unigrams, bigrams) in enumerate(sentences):
+            self.gold[b, : len(gold)] = gold
+            u_pos.append(unigrams[0] + b * self.T)
+            u_off.append(unigrams[1])
+            b_pos.append(bigrams[0] + b * self.T)
+            b_off.append(bigrams[1])
+        self.u_pos = numpy.concatenate(u_pos)
+        self.u_uniq, self.u_inv = numpy.unique(numpy.concatenate(u_off), return_inverse=True)
+        self.b_pos = numpy.concatenate(b_pos)
+        self.b_uniq, self.b_inv = numpy.unique(numpy.concatenate(b_off), return_inverse=True)
+        self.mask = numpy.arange(self.T)[None, :] < self.lengths[:, None]
+        self.valid = numpy.nonzero(self.mask)
+
+    def objective(self, weights, gradient, Y):
+        """
+        Returns the negative log-likelihood of the sentences and adds its
+        gradient to gradient.
+        """
+        B, T = self.B, self.T
+        span = numpy.arange(Y)
+        span2 = numpy.arange(Y * Y)
+        u_weights = weights[self.u_uniq[:, None] + span][self.u_inv]
+        U = _sum_at((self.u_pos[:, None] * Y + span).ravel(), u_weights.ravel(), B * T * Y).reshape((B, T, Y))
+        b_weights = weights[self.b_uniq[:, None] + span2][self.b_inv]
+        psi = _sum_at((self.b_pos[:, None] * Y * Y + span2).ravel(), b_weights.ravel(), B * T * Y * Y).reshape((B, T, Y, Y))
+        bs, ts = self.valid
+        gold = self.gold[bs, ts]
+        inner = (ts > 0)
+        score = U[bs, ts, gold].sum() + psi[bs[inner], ts[inner], self.gold[bs[inner], ts[inner] - 1], gold[inner]].sum()
+        psi += U[:, :, None, :]
+
+        # forward-backward, padded tokens keep the values of the last token
+        alpha = numpy.empty((B, T, Y))
+        beta = numpy.zeros((B, T, Y))
+        alpha[:, 0] = U[:, 0]
+        for t in range(1, T):
+            alpha[:, t] = numpy.where((t < self.lengths)[:, None], _logsumexp_numpy(alpha[:, t-1, :, None] + psi[:, t], axis=1), alpha[:, t-1])
+        for t in reversed(range(T-1)):
+            beta[:, t] = numpy.where((t < self.lengths - 1)[:, None], _logsumexp_numpy(psi[:, t+1] + beta[:, t+1, None, :], axis=2), 0.0)
+        log_z = _logsumexp_numpy(alpha[:, T-1], axis=1)
+
+        unigrams = numpy.exp(alpha + beta - log_z[:, None, None]) * self.mask[:, :, None]
+        unigrams[bs, ts, gold] -= 1.0
+        bigrams = numpy.zeros((B, T, Y, Y))
+        if T > 1:
+            bigrams[:, 1:] = numpy.exp(alpha[:, :-1, :, None] + psi[:, 1:] + beta[:, 1:, None, :] - log_z[:, None, None, None]) * self.mask[:, 1:, None, None]
+        bigrams[bs[inner], ts[inner], self.gold[bs[inner], ts[inner] - 1], gold[inner]] -= 1.0
+
+        unigrams = unigrams.reshape((B * T, Y))[self.u_pos]
+        gradient[self.u_uniq[:, None] + span] += _sum_at((self.u_inv[:, None] * Y + span).ravel(), unigrams.ravel(), len(self.u_uniq) * Y).reshape((-1, Y))
+        bigrams = bigrams.reshape((B * T, Y * Y))[self.b_pos]
+        gradient[self.b_uniq[:, None] + span2] += _sum_at((self.b_inv[:, None] * Y * Y + span2).ravel(), bigrams.ravel(), len(self.b_uniq) * Y * Y).reshape((-1, Y * Y))
+
+        return float(log_z.sum() - score)
+
+def _shard_objective(buckets, weights, Y):
+    gradient = numpy.zeros(len(weights))
+    value = 0.0
+    for bucket in buckets:
+        value += bucket.objective(weights, gradient, Y)
+    return value, gradient
+
+_worker = {}
+
+def _init_worker(shards, weights, Y):
+    _worker[u"shards"] = shards
+    _worker[u"weights"] = numpy.frombuffer(weights)
+    _worker[u"Y"] = Y
+
+def _worker_objective(index):
+    return _shard_objective(_worker[u"shards"][index], _worker[u"weights"], _worker[u"Y"])
+
+def _pseudo_gradient(x, g, rho1):
+    """
+    The pseudo-gradient of OWL-QN: the gradient of the l1 penalized
+    objective, its smallest subgradient where x is 0.
+    """
+    if rho1 == 0.0:
+        return g
+    pg = g + rho1 * numpy.sign(x)
+    zero = (x == 0.0)
+    right = g[zero] + rho1
+    left = g[zero] - rho1
+    pg[zero] = numpy.where(right < 0.0, right, numpy.where(left > 0.0, left, 0.0))
+    return pg
+
+def lbfgs(objective, x, rho1=0.0, maxiter=0, history=5, window=5, epsilon=1e-5, max_linesearch=20, logger=None):
+    """
+    Minimizes objective(x) + rho1 * |x|_1 with L-BFGS, using OWL-QN when
+    rho1 is not 0. objective returns the value and the gradient of the
+    smooth part of the function at x.
+    Stops after maxiter iterations (0 for no limit) or when the objective
+    decreased by less than epsilon (relatively) over the last window
+    iterations. Returns the minimizer found.
+    """
+    logger = logger or trainer_logger
+    value, g = objective(x)
+    value += rho1 * numpy.abs(x).sum()
+    values = [value]
+    s_list = []
+    y_list = []
+    iteration = 0
+    while maxiter <= 0 or iteration < maxiter:
+        iteration += 1
+        start = time.time()
+        pg = _pseudo_gradient(x, g, rho1)
+        if not pg.any():
+            break
+
+        # two-loop recursion
+        d = -pg
+        alphas = []
+        for s, y, rho in reversed(zip(s_list, y_list, [1.0 / numpy.dot(y, s) for s, y in zip(s_list, y_list)])):
+            a = rho * numpy.dot(s, d)
+            d -= a * y
+            alphas.append((a, s, y, rho))
+        if s_list:
+            d *= numpy.dot(s_list[-1], y_list[-1]) / numpy.dot(y_list[-1], y_list[-1])
+        for a, s, y, rho in reversed(alphas):
+            d += (a - rho * numpy.dot(y, d)) * s
+        if rho1 != 0.0:
+            d[d * pg >= 0.0] = 0.0
+        if numpy.dot(d, pg) >= 0.0: # not a descent direction, starting over
+            s_list, y_list = [], []
+            d = -pg
+
+        # backtracking line search, projected on the orthant of x
+        orthant = numpy.where(x != 0.0, numpy.sign(x), -numpy.sign(pg))
+        step = (1.0 / numpy.sqrt(numpy.dot(d, d)) if not s_list else 1.0)
+        for _ in range(max_linesearch):
+            x_new = x + step * d
+            if rho1 != 0.0:
+                x_new[numpy.sign(x_new) != orthant] = 0.0
+            value_new, g_new = objective(x_new)
+            value_new += rho1 * numpy.abs(x_new).sum()
+            if value_new <= value + 1e-4 * numpy.dot(pg, x_new - x):
+                break
+            step *= 0.5
+        else:
+            logger.warn(u"line search failed at iteration %i, stopping" %iteration)
+            break
+
+        s = x_new - x
+        y = g_new - g
+        if numpy.dot(s, y) > 0.0:
+            s_list.append(s)
+            y_list.append(y)
+            if len(s_list) > history:
+                del s_list[0], y_list[0]
+        x, g, value = x_new, g_new, value_new
+        values.append(value)
+        logger.info(u"iteration %i: objective %.3f, active features %i, time %.2fs" %(iteration, value, numpy.count_nonzero(x), time.time() - start))
+        if len(values) > window and (values[-window-1] - value) / max(abs(value), 1e-30) < epsilon:
+            break
+    return x
+
+def make_buckets(indexed, batch_size=64, bucket_width=8, Y=1):
+    """
+    Groups indexed sentences in buckets of at most batch_size sentences
+    whose lengths are at most bucket_width apart.
+    """
+    buckets = []
+    current = []
+    for sentence in sorted(indexed, key=lambda item: len(item[0])):
+        if current and (len(current) >= batch_size or len(sentence[0]) - len(current[0][0]) >= bucket_width):
+            buckets.append(_Bucket(current, Y))
+            current = []
+        current.append(sentence)
+    if current:
+        buckets.append(_Bucket(current, Y))
+    return buckets
+
+def index_corpus(sentences, templates):
+    """
+    Computes the observations of every sentence (see train) once and
+    returns the labels (a Coder), the list of observations, the offsets of
+    their unigram and bigram weights (-1 if they have none), the number of
+    weights and the indexed sentences. An indexed sentence is made of its
+    labels and of the (token, offset) arrays of its unigram and bigram
+    features. Offsets are assigned as Wapiti does when reading a model.
+    """
+    compiled = CompiledTemplates(templates)
+    labels = Coder()
+    observations = {}
+    observation_list = []
+    raw = []
+    for sentence in sentences:
+        if not sentence:
+            continue
+        tokens = [token[:-1] for token in sentence]
+        gold = []
+        for token in sentence:
+            labels.add(token[-1])
+            gold.append(labels.encode(token[-1]))
+        positions = []
+        ids = []
+        for instances in compiled.instanciate(tokens):
+            for t, observation in enumerate(instances):
+                index = observations.get(observation)
+                if index is None:
+                    index = observations[observation] = len(observation_list)
+                    observation_list.append(observation)
+                positions.append(t)
+                ids.append(index)
+        raw.append((gold, numpy.array(positions, dtype=numpy.int64), numpy.array(ids, dtype=numpy.int64)))
+    if not raw:
+        raise ValueError(u"no sentence to train on")
+
+    Y = len(labels)
+    uoff = numpy.empty(len(observation_list), dtype=numpy.int64)
+    boff = numpy.empty(len(observation_list), dtype=numpy.int64)
+    size = 0
+    for index, observation in enumerate(observation_list):
+        kind = observation[:1]
+        if kind not in (u"u", u"b", u"*"):
+            raise ValueError(u"invalid observation: %s (templates must start with u, b or *)" %observation)
+        uoff[index] = (size if kind in u"u*" else -1)
+        size += (Y if kind in u"u*" else 0)
+        boff[index] = (size if kind in u"b*" else -1)
+        size += (Y * Y if kind in u"b*" else 0)
+
+    indexed = []
+    for gold, positions, ids in raw:
+        u = uoff[ids]
+        b = boff[ids]
+        keep_u = (u != -1)
+        keep_b = (b != -1) & (positions > 0)
+        indexed.append((gold, (positions[keep_u], u[keep_u]), (positions[keep_b], b[keep_b])))
+    return labels, observation_list, uoff, boff, size, indexed
+
+def train(sentences, templates, rho1=0.5, rho2=0.0001, maxiter=0, jobs=1, history=5, window=5, epsilon=1e-5, batch_size=64, bucket_width=8, compact=False, logger=None):
+    """
+    Trains a linear-chain CRF on sentences and returns it as a Model.
+    
+    A sentence is a list of tokens, a token being the list of its columns,
+    the last one being its label. templates are the templates of the model
+    (sem.CRF.template.ListPattern, see read_patterns), their observations
+    are computed once for the whole corpus.
+    
+    Weights are optimized with L-BFGS (OWL-QN) under an elastic-net
+    penalty: rho1 * |w|_1 + rho2 / 2 * |w|^2, the defaults being those of
+    Wapiti. The gradient of the likelihood is computed by jobs processes,
+    each one handling a shard of the sentences. See lbfgs for the other
+    arguments. If compact is True, observations whose weights are all 0
+    are removed (see Model.prune).
+    Requires numpy.
+    """
+    if numpy is None:
+        raise RuntimeError(u"training CRF models requires numpy")
+    logger = logger or trainer_logger
+    start = time.time()
+    labels, observations, uoff, boff, size, indexed = index_corpus(sentences, templates)
+    Y = len(labels)
+    jobs = max(1, min(int(jobs), len(indexed)))
+    shards = [make_buckets(part, batch_size=batch_size, bucket_width=bucket_width, Y=Y) for part in shard(indexed, jobs)]
+    del indexed
+    logger.info(u"%i labels, %i observations, %i features, indexed in %.2fs" %(Y, len(observations), size, time.time() - start))
+
+    buffer = multiprocessing.RawArray(ctypes.c_double, size)
+    weights = numpy.frombuffer(buffer)
+    pool = (multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(shards, buffer, Y)) if jobs > 1 else None)
+    def objective(x):
+        weights[:] = x
+        if pool is None:
+            value, gradient = _shard_objective(shards[0], weights, Y)
+        else:
+            value = 0.0
+            gradient = numpy.zeros(size)
+            for shard_value, shard_gradient in pool.map(_worker_objective, range(len(shards))):
+                value += shard_value
+                gradient += shard_gradient
+        value += rho2 / 2.0 * numpy.dot(x, x)
+        gradient += rho2 * x
+        return value, gradient
+    try:
+        x = lbfgs(objective, numpy.zeros(size), rho1=rho1, maxiter=maxiter, history=history, window=window, epsilon=epsilon, logger=logger)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    model = Model()
+    model._tagset = labels
+    model._templates = list(templates)
+    model._observations = Coder.fromlist(observations)
+    model._uoff = offset_buffer(uoff)
+    model._boff = offset_buffer(boff)
+    model._weights = x
+    model._max_col = max([pattern.y for template in templates for pattern in template.patterns if hasattr(pattern, "y")] or [0])
+    if compact:
+        model.prune(0.0)
+    logger.info(u"trained in %.2fs" %(time.time() - start))
+    return model
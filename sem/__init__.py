@@ -42,6 +42,7 @@ SEM_HOME = dirname(abspath(__file__)).decode(sys.getfilesystemencoding())
 SEM_DATA_DIR = join(expanduser(u"~"), u"sem_data")
 SEM_RESOURCE_DIR = join(SEM_DATA_DIR, u"resources")
 SEM_EXT_DIR = join(SEM_DATA_DIR, u"ext")
+SEM_CACHE_DIR = (os.environ["SEM_CACHE_DIR"].decode(sys.getfilesystemencoding()) if "SEM_CACHE_DIR" in os.environ else join(SEM_DATA_DIR, u"cache"))
 SEM_HOMEPAGE = u"http://www.lattice.cnrs.fr/sites/itellier/SEM.html"
 argument_parser = argparse.ArgumentParser()
 argument_subparsers = argument_parser.add_subparsers()
@@ -31,9 +31,34 @@ SOFTWARE.
 """
 
 class Annotator(object):
+    # same as sem.modules.sem_module.SEMModule.barrier and document_scope,
+    # they are those of the annotate module using the annotator.
+    barrier = True
+    document_scope = True
+    
     def __init__(self, field, location, encoding="utf-8", *args, **kwargs):
         self._field = field
         self._location = location
 
     def process_document(self, document, *args, **kwargs):
         raise NotImplementedError("process_document not implemented for root type Tagger")
+    
+    def begin_document(self, document, *args, **kwargs):
+        """
+        Called before the first sentences of document are annotated.
+        Returns the state of the annotation of document (None by default),
+        which is given to process_sentences and end_document.
+        """
+        return None
+    
+    def process_sentences(self, document, sentences, state, *args, **kwargs):
+        """
+        Annotates some sentences of document, in the order of the document.
+        """
+        raise NotImplementedError("process_sentences not implemented for %s" %self.__class__.__name__)
+    
+    def end_document(self, document, state, *args, **kwargs):
+        """
+        Called once every sentence of document was annotated.
+        """
+        pass
@@ -36,37 +36,227 @@ except ImportError:
     from xml.etree import ElementTree as ET
 
 import logging
+import multiprocessing
+import os.path
 
 from . import Annotator as RootAnnotator
 from sem.logger import default_handler
-from sem.CRF.model import Model as WapitiModel
+from sem.CRF.registry import registry
+from sem.CRF.cache import DecodeCache
+from sem.CRF.lexicon import Lexicon
 
-from sem.misc import check_model_available
+from sem.misc import check_model_available, str2bool, shard
 
 wapiti_logger = logging.getLogger("sem.annotators.wapiti")
 wapiti_logger.addHandler(default_handler)
 wapiti_logger.setLevel("INFO")
 
+# annotators decoding shards in a process pool. Worker processes are forked
+# once the annotator is registered, so that they inherit it (and its model)
+# instead of receiving it for every shard.
+_sharded = {}
+
+def _decode_shard(arguments):
+    key, sentences, candidates = arguments
+    return _sharded[key].decode(sentences, candidates)
+
 class Annotator(RootAnnotator):
-    def __init__(self, field, location, input_encoding=None, *args, **kwargs):
+    barrier = False # sentences are tagged independently
+    
+    def __init__(self, field, location, input_encoding=None, weight_type=u"float64", transitions=None, lexicon=None, lexicon_field=u"word", decoder=u"viterbi", beam_size=8, nbest=None, confidence=False, shards=1, min_shard_size=100, extract=True, decode_cache_size=None, decode_cache_bytes=None, *args, **kwargs):
+        """
+        transitions constrains label transitions when tagging: "scheme" to
+        derive them from the labels (BIO, BIOES or POS "_" continuation),
+        a scheme name or a whitelist file (see sem.CRF.constraints). By
+        default, every transition is allowed.
+        
+        lexicon is a directory with one file of forms per label (such as
+        resources/dictionaries/fr/lefff), tokens whose lexicon_field is
+        found in it may only take the labels it lists (see
+        sem.CRF.lexicon).
+        
+        decoder is either "viterbi" (exact) or "beam", where only the
+        beam_size best labels of every token are kept: it is faster for
+        large tagsets but may be less accurate. If nbest is given, the
+        nbest best taggings of every sentence are computed, the first one
+        is used for the annotation and all of them are stored, along with
+        their scores, in the "<annotation name>.nbest" metadata of the
+        document.
+        
+        If confidence is True, the probability of every tag is computed
+        with the forward-backward algorithm and stored in its confidence
+        attribute. The lowest one is stored in the "<annotation
+        name>.confidence" metadata of the document, which allows to send
+        the least reliable documents to manual review.
+        
+        If shards is more than 1, the sentences of a document are split in
+        at most shards contiguous shards of at least min_shard_size
+        sentences, decoded in parallel by a pool of processes.
+        
+        The model is shared with the other annotators using it (see
+        sem.CRF.registry) until close is called. If only location.tar.gz
+        exists, it is extracted in the cache (see
+        sem.misc.check_model_available) unless extract is False, in which
+        case the model is read directly from the archive.
+        
+        If decode_cache_size or decode_cache_bytes is given, Viterbi
+        results are kept in a cache of at most decode_cache_size sentences
+        and decode_cache_bytes bytes (see sem.CRF.cache), so that sentences
+        repeated across documents are decoded only once. Both can be set
+        for the whole pipeline in the options of the master file:
+        <cache decode-cache-size="10000" decode-cache-bytes="50000000" />
+        Hit rates are logged at debug level.
+        """
         super(Annotator, self).__init__(field, location, input_encoding=input_encoding, *args, **kwargs)
         
-        check_model_available(self._location, logger=wapiti_logger)
+        self._shared_model = None
+        self._pool = None
+        extract = (str2bool(extract) if isinstance(extract, basestring) else bool(extract))
+        if not extract and not os.path.exists(self._location) and os.path.exists(self._location + u".tar.gz"):
+            location = self._location + u".tar.gz"
+        else:
+            location = check_model_available(self._location, logger=wapiti_logger)
         
-        self._model = WapitiModel.from_wapiti_model(self._location, encoding=input_encoding)
+        self._registry = registry() # still needed when released at exit
+        self._shared_model = self._registry.acquire(location, encoding=input_encoding, dtype=weight_type)
+        self._model = self._shared_model.view()
+        if transitions is not None:
+            self._model.constrain(transitions)
+        if decode_cache_size is not None or decode_cache_bytes is not None:
+            self._model.decode_cache = DecodeCache(max_entries=decode_cache_size, max_bytes=decode_cache_bytes)
+        self._lexicon = (Lexicon.from_directory(lexicon, encoding=input_encoding or "utf-8") if lexicon is not None else None)
+        self._lexicon_field = lexicon_field
+        if decoder not in (u"viterbi", u"beam"):
+            raise ValueError(u"unknown decoder: %s (available: viterbi, beam)" %decoder)
+        self._decoder = decoder
+        self._beam_size = int(beam_size)
+        self._nbest = (int(nbest) if nbest is not None else None)
+        self._confidence = (str2bool(confidence) if isinstance(confidence, basestring) else bool(confidence))
+        self._shards = int(shards)
+        self._min_shard_size = int(min_shard_size)
+    
+    @property
+    def document_scope(self):
+        # n-best taggings and the lowest confidence are document metadata
+        return self._nbest is not None or self._confidence
+    
+    def __del__(self):
+        self.close()
+    
+    def close(self):
+        """
+        Releases the model and stops the processes decoding shards.
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+            _sharded.pop(id(self), None)
+        if self._shared_model is not None:
+            self._registry.release(self._shared_model)
+            self._shared_model = None
+    
+    def decode(self, sentences, candidates):
+        """
+        Returns the tags of every sentence and, if nbest is set, their
+        alternative taggings along with their scores (None otherwise).
+        """
+        if self._nbest is not None:
+            nbest = [self._model.tag_nbest(sentence, self._nbest, sentence_candidates) for sentence, sentence_candidates in zip(sentences, candidates)]
+            tags = [alternatives[0][0][:] for alternatives in nbest]
+            return tags, [[(tagging, score) for tagging, _, score in alternatives] for alternatives in nbest]
+        if self._decoder == u"beam":
+            return [self._model.tag_beam(sentence, self._beam_size, sentence_candidates)[0][:] for sentence, sentence_candidates in zip(sentences, candidates)], None
+        return [tagging[:] for tagging, _, _ in self._model.tag_batch(sentences, candidates=candidates)], None
+    
+    def decode_sharded(self, sentences, candidates):
+        """
+        Same as decode, shards being decoded in parallel. Results are
+        merged back in order.
+        """
+        parts = shard(sentences, self._shards, self._min_shard_size)
+        if len(parts) == 1:
+            return self.decode(sentences, candidates)
+        if self._pool is None:
+            _sharded[id(self)] = self
+            self._pool = multiprocessing.Pool(self._shards)
+        parts = zip(parts, shard(candidates, self._shards, self._min_shard_size))
+        results = self._pool.map(_decode_shard, [(id(self), part, part_candidates) for part, part_candidates in parts])
+        tags = [tagging for part_tags, _ in results for tagging in part_tags]
+        if self._nbest is None:
+            return tags, None
+        return tags, [alternatives for _, part_nbest in results for alternatives in part_nbest]
 
     def process_document(self, document, annotation_name=None, annotation_fields=None, *args, **kwargs):
-        if annotation_fields is None:
-            fields = document.corpus.fields
-        else:
-            fields = annotation_fields
-        
-        if annotation_name is None:
-            annotation_name = unicode(self._field)
+        state = self.begin_document(document, annotation_name=annotation_name, annotation_fields=annotation_fields)
+        self.process_sentences(document, document.corpus.sentences, state)
+        self.end_document(document, state)
+    
+    def begin_document(self, document, annotation_name=None, annotation_fields=None, *args, **kwargs):
+        state = {
+            u"name": (annotation_name if annotation_name is not None else unicode(self._field)),
+            u"fields": list(annotation_fields if annotation_fields is not None else document.corpus.fields),
+            u"tags": [],
+            u"nbest": [],
+            u"sentences": [],
+            u"candidates": []
+        }
+        # added now so that next modules know it
+        if not document.corpus.has_key(self._field):
+            document.corpus.fields.append(self._field)
+        return state
+    
+    def process_sentences(self, document, sentences, state, *args, **kwargs):
+        fields = state[u"fields"]
+        matrices = [[[token[field] for field in fields] for token in sentence] for sentence in sentences]
+        candidates = [None] * len(matrices)
+        if self._lexicon is not None:
+            candidates = [self._lexicon.sentence_candidates([token[self._lexicon_field] for token in sentence], continuations=True) for sentence in sentences]
+        tags, nbest = self.decode_sharded(matrices, candidates)
+        for sentence, sentence_tags in zip(sentences, tags):
+            for token, tag in zip(sentence, sentence_tags):
+                token[self._field] = tag
+        state[u"tags"].extend(tags)
+        if nbest is not None:
+            state[u"nbest"].extend(nbest)
+        if self._confidence:
+            state[u"sentences"].extend(matrices)
+            state[u"candidates"].extend(candidates)
+    
+    def end_document(self, document, state, *args, **kwargs):
+        annotation_name = state[u"name"]
+        if self._nbest is not None:
+            document.add_metadata(u"%s.nbest" %annotation_name, state[u"nbest"])
         
-        tags = []
-        for sequence in document.corpus:
-            tagging, _, _ = self._model.tag_viterbi(document.corpus.to_matrix(sequence))
-            tags.append(tagging[:])
+        if state[u"tags"]:
+            document.add_annotation_from_tags(state[u"tags"], self._field, annotation_name)
+            if self._confidence:
+                self.add_confidences(document, annotation_name, state[u"sentences"], state[u"candidates"])
+        if self._model.decode_cache is not None:
+            stats = self._model.decode_cache.stats()
+            wapiti_logger.debug(u"decode cache: %i hits, %i misses (%.1f%%), %i entries, %i bytes" %(stats[u"hits"], stats[u"misses"], 100.0 * stats[u"hit_rate"], stats[u"entries"], stats[u"bytes"]))
+    
+    def add_confidences(self, document, annotation_name, sentences, candidates):
+        """
+        Sets the confidence of every tag of the annotation, which is the
+        probability that its tokens have the labels found in the corpus.
+        """
+        annotation = document.annotation(annotation_name)
+        starts = [0]
+        for sentence in sentences:
+            starts.append(starts[-1] + len(sentence))
+        tags = [[] for _ in sentences]
+        nth = 0
+        for tag in annotation:
+            while tag.lb >= starts[nth+1]:
+                nth += 1
+            tags[nth].append(tag)
         
-        document.add_annotation_from_tags(tags, self._field, annotation_name)
+        for nth, sentence in enumerate(sentences):
+            if not tags[nth]:
+                continue
+            labels = [token[self._field] for token in document.corpus.sentences[nth]]
+            spans = [(tag.lb - starts[nth], tag.ub - starts[nth]) for tag in tags[nth]]
+            for tag, probability in zip(tags[nth], self._model.span_probabilities(sentence, labels, spans, candidates[nth])):
+                tag.confidence = probability
+        if len(annotation) > 0:
+            document.add_metadata(u"%s.confidence" %annotation_name, min(tag.confidence for tag in annotation))
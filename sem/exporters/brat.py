@@ -39,19 +39,32 @@ from sem.exporters.exporter import Exporter as DefaultExporter
 
 class Exporter(DefaultExporter):
     __ext = "ann"
+    incremental = True
     
     def __init__(self, *args, **kwargs):
         pass
     
     def document_to_unicode(self, document, couples, **kwargs):
-        lowers = dict([(x.lower(), y) for (x,y) in couples.items()])
-        if "ner" not in lowers:
+        return u"\n".join(self._entities(document, couples))
+    
+    def chunk_to_unicode(self, document, couples, context, **kwargs):
+        # identifiers and offsets follow those of the previous parts
+        parts = self._entities(document, couples, first_id=context.get(u"entities", 0) + 1, offset=context[u"offset"])
+        if not parts:
             return u""
+        separator = (u"\n" if context.get(u"entities") else u"")
+        context[u"entities"] = context.get(u"entities", 0) + len(parts)
+        return separator + u"\n".join(parts)
+    
+    def _entities(self, document, couples, first_id=1, offset=0):
+        lowers = dict([(x.lower(), y) for (x,y) in couples.items()])
+        if "ner" not in lowers or document.annotation(lowers["ner"]) is None:
+            return []
         content = document.content
         parts = []
-        for id, annotation in enumerate(document.annotation(lowers["ner"]).get_reference_annotations(), 1):
-            parts.append(u"T%i\t%s %i %i\t%s" %(id, annotation.value, annotation.lb, annotation.ub, content[annotation.lb : annotation.ub].replace(u"\r",u"").replace(u"\n",u" ")))
-        return u"\n".join(parts)
+        for id, annotation in enumerate(document.annotation(lowers["ner"]).get_reference_annotations(), first_id):
+            parts.append(u"T%i\t%s %i %i\t%s" %(id, annotation.value, annotation.lb + offset, annotation.ub + offset, content[annotation.lb : annotation.ub].replace(u"\r",u"").replace(u"\n",u" ")))
+        return parts
     
     def corpus_to_unicode(self, corpus, couples, **kwargs):
         raise NotImplementedError("corpus_to_unicode not implemented for TEI exporter.")
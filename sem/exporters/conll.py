@@ -34,6 +34,7 @@ from sem.exporters.exporter import Exporter as DefaultExporter
 
 class Exporter(DefaultExporter):
     __ext = "conll"
+    incremental = True
     
     def __init__(self, *args, **kwargs):
         pass
@@ -63,6 +64,14 @@ class Exporter(DefaultExporter):
             
             return document.corpus.unicode(fields)
     
+    def chunk_to_unicode(self, document, couples, context, **kwargs):
+        data = self.document_to_unicode(document, couples, **kwargs)
+        if not data:
+            return u""
+        separator = (u"\n" if context.get(u"written") else u"") # the empty line between sentences
+        context[u"written"] = True
+        return separator + data
+    
     def corpus_to_unicode(self, corpus, couples, **kwargs):
         values = couples.values()
         return u"\n\n".join([u"\n".join([u"\t".join([fields for i,fields in enumerate(token) if i in values]) for token in sentence]) for sentence in corpus])
@@ -35,6 +35,8 @@ import os.path
 
 class Exporter(object):
     __ext = None
+    # whether documents can be written by parts, see chunk_to_unicode
+    incremental = False
     
     def __init__(self, *args, **kwargs):
         pass
@@ -115,6 +117,28 @@ class Exporter(object):
         else:
             output.write(self.document_to_unicode(document, couples, **kwargs))
     
+    def chunk_to_unicode(self, document, couples, context, **kwargs):
+        """
+        returns a unicode representation of document, a part of a bigger
+        document, for the exporters that can write documents by parts. The
+        representations of every part, one after the other, make the
+        representation of the whole document.
+        
+        Parameters
+        ----------
+            document : Document
+                the part of the document to export
+            couples : dict (string -> string)
+                the "entry name" <=> "entry index" that allows to
+                retrieve information to export.
+                ex: couples = {u"chunking":u"C", u"NER":u"N"}
+            context : dict
+                the same for every part of a document. context["offset"]
+                is the number of characters before the current part, the
+                exporter may keep its own values from one part to the next.
+        """
+        raise NotImplementedError("chunk_to_unicode not implemented for class %s" %self.__class__.__name__)
+    
     def document_to_data(self, document, couples, **kwargs):
         """
         creates a new variable representing the document in the given
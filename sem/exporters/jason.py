@@ -75,5 +75,8 @@ class Exporter(DefaultExporter):
             if reference:
                 json_dict[u"annotations"][annotation.name][u"reference"] = reference
             json_dict[u"annotations"][annotation.name]["annotations"] = [{u"v":tag.value, u"s":tag.lb, u"l":len(tag)} for tag in annotation]
+            for tag, data in zip(annotation, json_dict[u"annotations"][annotation.name]["annotations"]):
+                if tag.confidence is not None:
+                    data[u"c"] = tag.confidence
         
         return json_dict
@@ -35,6 +35,7 @@ from sem.storage.annotation import tag_annotation_from_sentence as get_pos, chun
 
 class Exporter(DefaultExporter):
     __ext = "txt"
+    incremental = True
     
     def __init__(self, *args, **kwargs):
         pass
@@ -42,6 +43,13 @@ class Exporter(DefaultExporter):
     def document_to_unicode(self, document, couples, **kwargs):
         return self.corpus_to_unicode(document.corpus, couples, **kwargs)
     
+    def chunk_to_unicode(self, document, couples, context, **kwargs):
+        if len(document.corpus) == 0:
+            return u""
+        separator = (u"\n" if context.get(u"written") else u"")
+        context[u"written"] = True
+        return separator + self.document_to_unicode(document, couples, **kwargs)
+    
     def corpus_to_unicode(self, corpus, couples, **kwargs):
         lower  = {}
         for field in couples:
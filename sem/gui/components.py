@@ -53,6 +53,9 @@ import logging
 
 import sem
 import sem.wapiti, sem.exporters.conll
+import sem.CRF.trainer
+from sem.CRF.template import read_patterns
+from sem.IO.columnIO import Reader
 import sem.importers
 from sem.storage import Holder, Document, SEMCorpus
 from sem.modules.tagger import load_master, main as tagger
@@ -409,7 +412,14 @@ class SEMTkWapitiTrain(ttk.Frame):
             O.write(u"number of processors\t%s\n" %nprocs)
             O.write(u"compact\t%s\n" %compact)
         
-        sem.wapiti.train(train_file, pattern=pattern_file, output=model_file, algorithm=alg, rho1=l1, rho2=l2, nthreads=nprocs, compact=compact)
+        if os.path.exists(sem.wapiti.command_name()):
+            sem.wapiti.train(train_file, pattern=pattern_file, output=model_file, algorithm=alg, rho1=l1, rho2=l2, nthreads=nprocs, compact=compact)
+        else:
+            if alg != u"l-bfgs":
+                self.wapiti_train_logger.warn(u"Wapiti not found, training with l-bfgs instead of %s" %alg)
+            sentences = [sentence[:] for sentence in Reader(train_file, "utf-8")]
+            model = sem.CRF.trainer.train(sentences, read_patterns(pattern_file), rho1=l1, rho2=l2, jobs=nprocs, compact=compact, logger=self.wapiti_train_logger)
+            model.write(model_file)
         
         self.wapiti_train_logger.info("files are located in: " + output_dir)
         tkMessageBox.showinfo("training SEM", "Everything went ok! files are located in: " + output_dir)
@@ -258,6 +258,6 @@ def json_data(data):
     
     for annotation_name in data.get(u"annotations", {}):
         d = data[u"annotations"][annotation_name]
-        annotations = [Tag(lb=annotation[u"s"], ub=0, length=annotation[u"l"], value=annotation[u"v"]) for annotation in d[u"annotations"]]
+        annotations = [Tag(lb=annotation[u"s"], ub=0, length=annotation[u"l"], value=annotation[u"v"], confidence=annotation.get(u"c", None)) for annotation in d[u"annotations"]]
         annotation = Annotation(annotation_name, reference=document.segmentation(d[u"reference"]), annotations=annotations)
         document.add_annotation(annotation)
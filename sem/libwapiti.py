@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+"""
+file: libwapiti.py
+
+Description: an in-process binding to Wapiti, through the shared library
+built by setup.py from the bundled sources of Wapiti and ext/libwapiti.c.
+Models are loaded once and sentences are labeled in memory, without
+starting a process or writing them as text.
+
+The library is optional: available() tells whether it could be loaded,
+sem.wapiti falls back to running Wapiti as a separate process otherwise.
+
+author: Yoann Dupont
+
+MIT License
+
+Copyright (c) 2018 Yoann Dupont
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import ctypes
+import os.path
+import threading
+
+from sem import SEM_EXT_DIR, ON_WINDOWS
+
+__library_name = os.path.join(SEM_EXT_DIR, "wapiti", ("libwapiti.dll" if ON_WINDOWS else "libwapiti.so"))
+__library = None
+__library_lock = threading.Lock()
+
+def library_name():
+    """
+    returns the file name of the Wapiti library.
+    """
+    return __library_name
+
+def _library():
+    """
+    Returns the Wapiti library, loaded the first time, or None if it is
+    not available.
+    """
+    global __library
+    with __library_lock:
+        if __library is None:
+            try:
+                library = ctypes.CDLL(library_name())
+            except OSError:
+                __library = False
+            else:
+                library.sem_wapiti_load.argtypes = [ctypes.c_char_p]
+                library.sem_wapiti_load.restype = ctypes.c_void_p
+                library.sem_wapiti_save.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+                library.sem_wapiti_save.restype = ctypes.c_int
+                library.sem_wapiti_free.argtypes = [ctypes.c_void_p]
+                library.sem_wapiti_free.restype = None
+                library.sem_wapiti_nlabels.argtypes = [ctypes.c_void_p]
+                library.sem_wapiti_nlabels.restype = ctypes.c_uint32
+                library.sem_wapiti_label_name.argtypes = [ctypes.c_void_p, ctypes.c_uint32]
+                library.sem_wapiti_label_name.restype = ctypes.c_char_p
+                library.sem_wapiti_label.argtypes = [ctypes.c_void_p, ctypes.c_uint32, ctypes.POINTER(ctypes.c_uint32), ctypes.POINTER(ctypes.c_char_p), ctypes.POINTER(ctypes.c_uint32)]
+                library.sem_wapiti_label.restype = ctypes.c_int
+                library.sem_wapiti_train.argtypes = [ctypes.c_uint32, ctypes.POINTER(ctypes.c_uint32), ctypes.POINTER(ctypes.c_char_p), ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_uint32, ctypes.c_double, ctypes.c_double, ctypes.c_uint32, ctypes.c_int]
+                library.sem_wapiti_train.restype = ctypes.c_void_p
+                __library = library
+        return __library or None
+
+def available():
+    """
+    Tells whether the Wapiti library is available.
+    """
+    return _library() is not None
+
+def _sequences(sentences, encoding):
+    """
+    Returns the number of lines of every sentence and all their lines as
+    C arrays. A sentence is a list of tokens, a token being either a line
+    or the list of its columns.
+    """
+    lens = []
+    lines = []
+    for sentence in sentences:
+        lens.append(len(sentence))
+        for token in sentence:
+            if not isinstance(token, basestring):
+                token = u"\t".join(token)
+            if isinstance(token, unicode):
+                token = token.encode(encoding)
+            lines.append(token)
+    return (ctypes.c_uint32 * len(lens))(*lens), (ctypes.c_char_p * len(lines))(*lines)
+
+class Model(object):
+    """
+    A Wapiti model loaded in memory. The library releases the GIL while
+    labeling, so a model can label sentences from many threads at once.
+    """
+
+    def __init__(self, handle, encoding="utf-8"):
+        self._handle = handle
+        self._encoding = encoding
+        self._library = _library() # still needed when freeing at exit
+        self._labels = [self._library.sem_wapiti_label_name(handle, i).decode(encoding) for i in range(self._library.sem_wapiti_nlabels(handle))]
+
+    def __del__(self):
+        self.close()
+
+    @property
+    def labels(self):
+        return self._labels
+
+    def close(self):
+        if self._handle is not None:
+            self._library.sem_wapiti_free(self._handle)
+            self._handle = None
+
+    def save(self, filename):
+        """
+        Writes the model in Wapiti format.
+        """
+        if self._library.sem_wapiti_save(self._handle, filename.encode("utf-8") if isinstance(filename, unicode) else filename) != 0:
+            raise IOError("could not write Wapiti model: %s" %filename)
+
+    def label(self, sentences):
+        """
+        Labels sentences with Viterbi and returns the list of their labels.
+        A sentence is a list of tokens, a token being either a line
+        (columns separated by tabulations) or the list of its columns.
+        """
+        sentences = list(sentences)
+        lens, lines = _sequences(sentences, self._encoding)
+        out = (ctypes.c_uint32 * len(lines))()
+        if self._library.sem_wapiti_label(self._handle, len(lens), lens, lines, out) != 0:
+            raise RuntimeError("Wapiti could not label sentences, see the error output for details")
+        labels = []
+        position = 0
+        for sentence in sentences:
+            labels.append([self._labels[i] for i in out[position : position + len(sentence)]])
+            position += len(sentence)
+        return labels
+
+def load_model(filename, encoding="utf-8"):
+    """
+    Loads a Wapiti model, raises a RuntimeError if the library is not
+    available.
+    """
+    library = _library()
+    if library is None:
+        raise RuntimeError("the Wapiti library is not available: %s" %library_name())
+    handle = library.sem_wapiti_load(filename.encode("utf-8") if isinstance(filename, unicode) else filename)
+    if not handle:
+        raise IOError("could not load Wapiti model: %s" %filename)
+    return Model(handle, encoding=encoding)
+
+_models = {}
+_models_lock = threading.Lock()
+
+def get_model(filename, encoding="utf-8"):
+    """
+    Returns the model in filename, which is loaded the first time. Models
+    are shared, so that it is loaded only once per process.
+    """
+    key = (os.path.abspath(filename), encoding)
+    with _models_lock:
+        if key not in _models:
+            _models[key] = load_model(filename, encoding=encoding)
+        return _models[key]
+
+def train(sentences, pattern=None, model_type="crf", algorithm="l-bfgs", maxiter=0, rho1=0.5, rho2=0.0001, nthreads=1, compact=False, encoding="utf-8"):
+    """
+    Trains a Wapiti model on labeled sentences, the label being the last
+    column of every token. The defaults are those of Wapiti, a maxiter of
+    0 meaning no limit. Returns the trained Model.
+    """
+    library = _library()
+    if library is None:
+        raise RuntimeError("the Wapiti library is not available: %s" %library_name())
+    lens, lines = _sequences(sentences, encoding)
+    if isinstance(pattern, unicode):
+        pattern = pattern.encode("utf-8")
+    handle = library.sem_wapiti_train(len(lens), lens, lines, pattern, str(model_type), str(algorithm), int(maxiter), float(rho1), float(rho2), int(nthreads), int(bool(compact)))
+    if not handle:
+        raise RuntimeError("Wapiti could not train a model, see the error output for details")
+    return Model(handle, encoding=encoding)
@@ -30,9 +30,21 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import contextlib
+import hashlib
 import re
+import os
 import os.path
+import shutil
 import tarfile
+import tempfile
+
+try:
+    import fcntl
+except ImportError: # Windows: concurrent extractions are not serialized
+    fcntl = None
+
+import sem
 
 def ranges_to_set(ranges, length, include_zero=False):
     """
@@ -101,15 +113,100 @@ def is_relative_path(s):
     tmp = s.replace(u"\\", u"/")
     return tmp.startswith(u"../") or tmp.startswith(u"~/") or tmp.startswith(u"./")
 
-def check_model_available(model, logger=None):
-    if not os.path.exists(model):
-        if os.path.exists(model + ".tar.gz"):
-            if logger is not None:
-                logger.info("Model not extracted, extracting %s" %(os.path.normpath(model + ".tar.gz")))
-            with tarfile.open(model + ".tar.gz", "r:gz") as tar:
-                tar.extractall(os.path.dirname(model))
-        else:
+def file_digest(filename, block_size=1<<20):
+    """
+    Returns the SHA-1 hex digest of the content of filename.
+    """
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as input_stream:
+        for block in iter(lambda: input_stream.read(block_size), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+@contextlib.contextmanager
+def file_lock(filename):
+    """
+    Holds an exclusive lock on filename (created if needed) for the
+    duration of the with block, waiting for other processes holding it.
+    """
+    with open(filename, "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+def extract_archive(archive, cache_dir=None, logger=None):
+    """
+    Extracts a tar.gz archive in the cache (sem.SEM_CACHE_DIR by default)
+    and returns the directory of its content, named after the digest of
+    the archive so that a modified archive is extracted again.
+    The archive is extracted in a temporary directory that is then renamed,
+    a lock file making concurrent processes wait for the first one instead
+    of extracting the same archive at the same time.
+    """
+    cache_dir = cache_dir or sem.SEM_CACHE_DIR
+    target = os.path.join(cache_dir, file_digest(archive))
+    if os.path.isdir(target):
+        return target
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError: # created by another process in the meantime
+            if not os.path.isdir(cache_dir):
+                raise
+    with file_lock(target + ".lock"):
+        if os.path.isdir(target):
+            return target
+        if logger is not None:
+            logger.info("extracting %s in %s" %(os.path.normpath(archive), target))
+        tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(target) + ".", dir=cache_dir)
+        try:
+            with tarfile.open(archive, "r:gz") as tar:
+                for member in tar.getmembers():
+                    name = os.path.normpath(member.name)
+                    if os.path.isabs(name) or name.startswith(os.pardir):
+                        raise IOError("unsafe path in archive %s: %s" %(archive, member.name))
+                tar.extractall(tmp_dir)
+            os.rename(tmp_dir, target)
+        except:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+    return target
+
+def check_model_available(model, logger=None, cache_dir=None):
+    """
+    Returns the file name to load model from. If model does not exist or
+    is older than model.tar.gz, the archive is extracted in the cache (see
+    extract_archive) and the extracted model is returned, nothing being
+    written next to the archive.
+    """
+    archive = model + ".tar.gz"
+    if not os.path.exists(archive):
+        if not os.path.exists(model):
             raise IOError("Cannot find model file: %s" %model)
+        return model
+    if os.path.exists(model) and os.path.getmtime(model) >= os.path.getmtime(archive):
+        return model
+    extracted = os.path.join(extract_archive(archive, cache_dir=cache_dir, logger=logger), os.path.basename(model))
+    if not os.path.exists(extracted):
+        raise IOError("Cannot find model file %s in %s" %(os.path.basename(model), archive))
+    return extracted
+
+def read_archived_model(model):
+    """
+    Returns the content of model from model.tar.gz without extracting it,
+    as a string. The archive is read as a stream, only the model is kept.
+    """
+    archive = model + ".tar.gz"
+    name = os.path.basename(model)
+    with tarfile.open(archive, "r|gz") as tar:
+        for member in tar:
+            if member.isfile() and os.path.normpath(member.name) == name:
+                return tar.extractfile(member).read()
+    raise IOError("Cannot find model file %s in %s" %(name, archive))
 
 def strip_html(html, keep_offsets=False):
     hs = re.compile(u"<h[1][^>]*?>.+?</h[0-9]>", re.M + re.U + re.DOTALL)
@@ -167,6 +264,22 @@ def str2bool(s):
         raise ValueError(u'Cannot convert to boolean: "%s"' %s)
     return res
 
+def shard(sequence, count, min_size=1):
+    """
+    Splits sequence in at most count contiguous shards of at least min_size
+    elements (a single shard if sequence is too short), the sizes of shards
+    differing by at most one. Concatenating shards gives sequence back.
+    """
+    count = max(1, min(int(count), len(sequence) // max(int(min_size), 1)))
+    size, rest = divmod(len(sequence), count)
+    result = []
+    start = 0
+    for nth in range(count):
+        end = start + size + (1 if nth < rest else 0)
+        result.append(sequence[start : end])
+        start = end
+    return result
+
 def longest_common_substring(a, b, casesensitive=True, lastchance=False):
     """
     A backtrack algorithm to find the best suited match between a long and
@@ -65,11 +65,30 @@ class SEMModule(RootModule):
         
         self._annotator = sem.annotators.get_annotator(annotator)(field, *args, **kwargs)
     
+    @property
+    def barrier(self):
+        return self._annotator.barrier
+    
+    @property
+    def document_scope(self):
+        return self._annotator.document_scope
+    
     def process_document(self, document, **kwargs):
         start = time.time()
         self._annotator.process_document(document)
         laps = time.time() - start
         tagging_logger.info(u'done in %s' %timedelta(seconds=laps))
+    
+    def begin_document(self, document, **kwargs):
+        return (time.time(), self._annotator.begin_document(document))
+    
+    def process_sentences(self, document, sentences, state, **kwargs):
+        self._annotator.process_sentences(document, sentences, state[1])
+    
+    def end_document(self, document, state, **kwargs):
+        self._annotator.end_document(document, state[1])
+        laps = time.time() - state[0]
+        tagging_logger.info(u'done in %s' %timedelta(seconds=laps))
 
 def main(args):
     """
@@ -63,6 +63,66 @@ def compile_chunks(sentence, column=-1):
     return entity_chunks
 
 
+def chunk_counts(sentences, reference_column=-2, tagging_column=-1):
+    """
+    Returns the number of correct, reference (gold) and tagged (guess)
+    chunks for every label, the "" label holding the total counts.
+    """
+    counts = {}
+    for sentence in sentences:
+        reference = compile_chunks(sentence, column=reference_column)
+        tagging = compile_chunks(sentence, column=tagging_column)
+        ok = reference & tagging
+        silence = reference - ok
+        noise = tagging - ok
+        for e in ok:
+            label = e[0]
+            if label not in counts:
+                counts[label] = {"ok":0.0, "gold":0.0, "guess":0.0}
+            counts[label]["ok"] += 1.0
+            counts[label]["gold"] += 1.0
+            counts[label]["guess"] += 1.0
+        for e in silence:
+            label = e[0]
+            if label not in counts:
+                counts[label] = {"ok":0.0, "gold":0.0, "guess":0.0}
+            counts[label]["gold"] += 1.0
+        for e in noise:
+            label = e[0]
+            if label not in counts:
+                counts[label] = {"ok":0.0, "gold":0.0, "guess":0.0}
+            counts[label]["guess"] += 1.0
+    counts[""] = {"ok":0.0, "gold":0.0, "guess":0.0}
+    for label in counts:
+        if label == "": continue
+        counts[""]["ok"] += counts[label]["ok"]
+        counts[""]["gold"] += counts[label]["gold"]
+        counts[""]["guess"] += counts[label]["guess"]
+    return counts
+
+
+def fscores(counts):
+    """
+    Returns the precision, recall and f-measure (in percents) of every
+    label in counts (see chunk_counts).
+    """
+    prf = {}
+    for label in counts:
+        lbl_c = counts[label]
+        ok = lbl_c["ok"]
+        gold = lbl_c["gold"]
+        guess = lbl_c["guess"]
+        
+        prf[label] = {"p":0.0, "r":0.0, "f":0.0}
+        if guess != 0.0:
+            prf[label]["p"] = 100.0 * ok / guess
+        if gold != 0.0:
+            prf[label]["r"] = 100.0 * ok / gold
+        if prf[label]["p"] + prf[label]["r"] != 0.0:
+            prf[label]["f"] = 2.0 * ((prf[label]["p"] * prf[label]["r"]) / (prf[label]["p"] + prf[label]["r"]))
+    return prf
+
+
 def float2spreadsheet(f):
     """
     For spreadsheets, dots should be replaced by commas.
@@ -80,37 +140,8 @@ def main(args):
     input_format = args.input_format
     
     counts = {}
-    prf = {}
     if input_format == "conll":
-        for p in Reader(infile, ienc):
-            reference = compile_chunks(p, column=reference_column)
-            tagging = compile_chunks(p, column=tagging_column)
-            ok = reference & tagging
-            silence = reference - ok
-            noise = tagging - ok
-            for e in ok:
-                label = e[0]
-                if label not in counts:
-                    counts[label] = {"ok":0.0, "gold":0.0, "guess":0.0}
-                counts[label]["ok"] += 1.0
-                counts[label]["gold"] += 1.0
-                counts[label]["guess"] += 1.0
-            for e in silence:
-                label = e[0]
-                if label not in counts:
-                    counts[label] = {"ok":0.0, "gold":0.0, "guess":0.0}
-                counts[label]["gold"] += 1.0
-            for e in noise:
-                label = e[0]
-                if label not in counts:
-                    counts[label] = {"ok":0.0, "gold":0.0, "guess":0.0}
-                counts[label]["guess"] += 1.0
-        counts[""] = {"ok":0.0, "gold":0.0, "guess":0.0}
-        for label in counts:
-            if label == "": continue
-            counts[""]["ok"] += counts[label]["ok"]
-            counts[""]["gold"] += counts[label]["gold"]
-            counts[""]["guess"] += counts[label]["guess"]
+        counts = chunk_counts(Reader(infile, ienc), reference_column=reference_column, tagging_column=tagging_column)
     elif input_format == "brat":
         tagging_document = sem.importers.brat_file(infile)
         reference_document = sem.importers.brat_file(args.reference_file)
@@ -222,19 +253,7 @@ def main(args):
     else:
         raise RuntimeError("format not handled")
     
-    for label in counts:
-        lbl_c = counts[label]
-        ok = lbl_c["ok"]
-        gold = lbl_c["gold"]
-        guess = lbl_c["guess"]
-        
-        prf[label] = {"p":0.0, "r":0.0, "f":0.0}
-        if guess != 0.0:
-            prf[label]["p"] = 100.0 * ok / guess
-        if gold != 0.0:
-            prf[label]["r"] = 100.0 * ok / gold
-        if prf[label]["p"] + prf[label]["r"] != 0.0:
-            prf[label]["f"] = 2.0 * ((prf[label]["p"] * prf[label]["r"]) / (prf[label]["p"] + prf[label]["r"]))
+    prf = fscores(counts)
     
     print "entity\tprecision\trecall\tf-measure"
     entities = set(prf.keys())
@@ -45,6 +45,12 @@ clean_info_logger = logging.getLogger("sem.clean_info")
 clean_info_logger.addHandler(default_handler)
 
 class SEMModule(RootModule):
+    # the fields removed may still be used by previous modules once they
+    # processed every sentence (eg: wapiti_label creating its annotation),
+    # so it waits for them. Parts of documents can be cleaned independently.
+    barrier = True
+    document_scope = False
+    
     def __init__(self, to_keep, log_level="WARNING", log_file=None, **kwargs):
         super(SEMModule, self).__init__(log_level=log_level, log_file=log_file, **kwargs)
         
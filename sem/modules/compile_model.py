@@ -0,0 +1,116 @@
+#-*- coding:utf-8 -*-
+
+"""
+file: compile_model.py
+
+author: Yoann Dupont
+
+MIT License
+
+Copyright (c) 2018 Yoann Dupont
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import logging, time, os.path
+
+from datetime import timedelta
+
+from sem.CRF.model  import Model
+from sem.CRF.binary import is_binary_model
+from sem.logger     import default_handler, file_handler
+
+compile_model_logger = logging.getLogger("sem.compile_model")
+compile_model_logger.addHandler(default_handler)
+
+def compile_model(infile, outfile, to_text=False, weight_type=u"float64", encoding=None, log_level=logging.WARNING, log_file=None):
+    """
+    Converts a CRF model from Wapiti format to SEM binary format, or back to
+    Wapiti format if to_text is True. The input format is guessed.
+    
+    Parameters
+    ----------
+    infile : str
+        the model to convert, in Wapiti or binary format.
+    outfile : str
+        the converted model.
+    to_text : bool
+        if True, write a Wapiti model instead of a binary one.
+    weight_type : str
+        the type of weights in binary models ("float64" or "float32").
+    encoding : str
+        the encoding of Wapiti models. If None, strings are kept as bytes,
+        as annotators do: models whose observations are not valid in any
+        encoding (eg: cut in the middle of a character) are kept as they are.
+    log_level : str or int
+        the logging level.
+    log_file : str
+        if not None, the file to log to (does not remove command-line
+        logging).
+    """
+    
+    start = time.time()
+    
+    if log_file is not None:
+        compile_model_logger.addHandler(file_handler(log_file))
+    compile_model_logger.setLevel(log_level)
+    
+    compile_model_logger.info(u'loading "%s"', infile)
+    model = Model.load(infile, encoding=encoding, dtype=weight_type)
+    if to_text:
+        compile_model_logger.info(u'writing Wapiti model "%s"', outfile)
+        model.write(outfile, encoding=encoding)
+    else:
+        if is_binary_model(infile):
+            model.compact(weight_type)
+        compile_model_logger.info(u'writing binary model "%s"', outfile)
+        model.write_binary(outfile)
+    
+    laps = time.time() - start
+    compile_model_logger.info("done in %s", timedelta(seconds=laps))
+
+def main(args):
+    compile_model(args.infile, args.outfile,
+                  to_text=args.to_text,
+                  weight_type=args.weight_type,
+                  encoding=args.enc,
+                  log_level=args.log_level, log_file=args.log_file)
+
+
+
+import sem
+
+_subparsers = sem.argument_subparsers
+
+parser = _subparsers.add_parser(os.path.splitext(os.path.basename(__file__))[0], description="Converts a Wapiti model to SEM binary format, which loads much faster, or a binary model back to Wapiti format.")
+
+parser.add_argument("infile",
+                    help="The input model (Wapiti or binary format)")
+parser.add_argument("outfile",
+                    help="The output model")
+parser.add_argument("-t", "--to-text", dest="to_text", action="store_true",
+                    help="Write the output model in Wapiti format")
+parser.add_argument("-w", "--weight-type", dest="weight_type", choices=("float64", "float32"), default="float64",
+                    help="The type of weights in binary models (default: %(default)s)")
+parser.add_argument("--encoding", dest="enc",
+                    help="Encoding of Wapiti models (default: strings are kept as bytes, as annotators do)")
+parser.add_argument("-l", "--log", dest="log_level", choices=("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"), default="WARNING",
+                    help="Increase log level (default: %(default)s)")
+parser.add_argument("--log-file", dest="log_file",
+                    help="The name of the log file")
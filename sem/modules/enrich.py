@@ -48,6 +48,9 @@ enrich_logger = logging.getLogger("sem.%s" %os.path.basename(__file__).split("."
 enrich_logger.addHandler(default_handler)
 
 class SEMModule(RootModule):
+    barrier = False # features are computed sentence by sentence
+    document_scope = False
+    
     def __init__(self, informations, mode=u"label", log_level="WARNING", log_file=None, **kwargs):
         super(SEMModule, self).__init__(log_level=log_level, log_file=log_file, **kwargs)
         
@@ -95,6 +98,20 @@ class SEMModule(RootModule):
         
         start = time.time()
         
+        self.begin_document(document)
+        
+        informations = self._informations
+        nth = 0
+        for i, sentence in enumerate(informations.enrich(document.corpus)):
+            nth += 1
+            if (0 == nth % 1000):
+                enrich_logger.debug('%i sentences enriched' %nth)
+        enrich_logger.debug('%i sentences enriched' %nth)
+        
+        laps = time.time() - start
+        enrich_logger.info("done in %s" %timedelta(seconds=laps))
+    
+    def begin_document(self, document, **kwargs):
         if self._log_file is not None:
             enrich_logger.addHandler(file_handler(self._log_file))
         enrich_logger.setLevel(self._log_level)
@@ -109,15 +126,10 @@ class SEMModule(RootModule):
         
         new_fields = [feature.name for feature in informations.features if feature.display]
         document.corpus.fields += new_fields
-        nth = 0
-        for i, sentence in enumerate(informations.enrich(document.corpus)):
-            nth += 1
-            if (0 == nth % 1000):
-                enrich_logger.debug('%i sentences enriched' %nth)
-        enrich_logger.debug('%i sentences enriched' %nth)
-        
-        laps = time.time() - start
-        enrich_logger.info("done in %s" %timedelta(seconds=laps))
+    
+    def process_sentences(self, document, sentences, state, **kwargs):
+        for sentence in self._informations.enrich(sentences):
+            pass
 
 def main(args):
     """
@@ -46,10 +46,11 @@ import time
 import os.path
 import platform
 import logging
+import multiprocessing
 
 import sem
-from sem.modules.tagger import load_master, main as tagger
-from sem.storage import Holder, SEMCorpus
+from sem.modules.tagger import load_master, tag_files
+from sem.storage import SEMCorpus
 from sem.gui.components import SemTkMasterSelector, SemTkLangSelector, SemTkFileSelector, SemTkExportSelector, SEMTkWapitiTrain
 from sem.logger import default_handler
 
@@ -129,7 +130,7 @@ class SemTkMainWindow(ttk.Frame):
         try:
             export_format = self.export_format_selector.export_format()
             pipeline, workflow_options, exporter, couples = load_master(masterfile, force_format=export_format)
-            args = Holder(**{"output_directory":output_dir, "pipeline":pipeline, "options":workflow_options, "exporter":exporter, "couples":couples})
+            documents = []
             for current_file in current_files:
                 corpus = None
                 try:
@@ -137,16 +138,20 @@ class SemTkMainWindow(ttk.Frame):
                 except:
                     pass
                 if corpus is not None:
-                    for doc in corpus:
-                        args.infile = doc
-                        tagger(args)
+                    documents.extend(corpus)
                 else:
-                    args.infile = current_file
-                    tagger(args)
+                    documents.append(current_file)
+            # the pipeline is loaded once, documents are tagged by as many
+            # processes as there are CPUs.
+            report = tag_files(documents, pipeline, workflow_options, exporter, couples, output_directory=output_dir, jobs=min(len(documents), multiprocessing.cpu_count()))
         except Exception,e:
             tkMessageBox.showerror("launching SEM", "Error: " + e.message)
             raise
             return
+        if report[u"failed"]:
+            failed = u", ".join(getattr(document, "name", document) for document in report[u"failed"])
+            tkMessageBox.showerror("launching SEM", "Could not process: " + failed + " (see the log for details), other files are located in: " + output_dir)
+            return
         gui_logger.info("files are located in: " + output_dir)
         tkMessageBox.showinfo("launching SEM", "Everything went ok! files are located in: " + output_dir)
         return
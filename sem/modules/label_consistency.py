@@ -351,6 +351,9 @@ class OverridingLabelConsistencyFeature(LabelConsistencyFeature):
 
 
 class SEMModule(RootModule):
+    barrier = True # entities are counted over the whole document
+    document_scope = True
+    
     def __init__(self, field, log_level="WARNING", log_file=None, token_field="word", label_consistency="overriding", **kwargs):
         super(SEMModule, self).__init__(log_level=log_level, log_file=log_file, **kwargs)
         self._field = field
@@ -0,0 +1,183 @@
+#-*- coding:utf-8 -*-
+
+"""
+file: optimize_model.py
+
+author: Yoann Dupont
+
+MIT License
+
+Copyright (c) 2018 Yoann Dupont
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import logging, time, os.path
+
+from datetime import timedelta
+
+from sem.CRF.model   import Model
+from sem.IO.columnIO import Reader
+from sem.logger      import default_handler, file_handler
+
+optimize_model_logger = logging.getLogger("sem.optimize_model")
+optimize_model_logger.addHandler(default_handler)
+
+def tag_changes(reference, model, sentences):
+    """
+    Returns the number of tokens and the number of sentences whose tags
+    differ between reference and model.
+    """
+    n_tokens = 0
+    n_sentences = 0
+    for (expected, _, _), (tags, _, _) in zip(reference.tag_batch(sentences), model.tag_batch(sentences)):
+        changed = sum(1 for tag1, tag2 in zip(expected, tags) if tag1 != tag2)
+        n_tokens += changed
+        n_sentences += (1 if changed else 0)
+    return n_tokens, n_sentences
+
+def optimize_model(infile, outfile, threshold=None, quantization=None, block_size=32, held_out=None, to_text=False, encoding="utf-8", log_level=logging.WARNING, log_file=None):
+    """
+    Makes a CRF model smaller by removing the observations whose weights are
+    all under a threshold and by quantizing its weights. The optimized model
+    is written in binary format (or Wapiti format if to_text is True, which
+    cannot keep quantized weights).
+    
+    Parameters
+    ----------
+    infile : str
+        the model to optimize, in Wapiti or binary format.
+    outfile : str
+        the optimized model.
+    threshold : float
+        if not None, observations whose weights are all lower than or equal
+        to threshold in absolute value are removed.
+    quantization : str
+        if not None, the type to quantize weights to ("float16" or "int8").
+    block_size : int
+        the number of weights sharing a scale in int8 quantization.
+    held_out : str
+        if not None, a CoNLL file used to measure how many tags are changed
+        by the optimization.
+    to_text : bool
+        if True, write a Wapiti model instead of a binary one.
+    encoding : str
+        the encoding of Wapiti models and of the held out file.
+    log_level : str or int
+        the logging level.
+    log_file : str
+        if not None, the file to log to (does not remove command-line
+        logging).
+    
+    Returns
+    -------
+    report : dict
+        the number of observations and bytes of weights and offsets before
+        and after optimization. If held_out is given, the number of tokens
+        and sentences in held_out and the number of those that were tagged
+        differently.
+    """
+    
+    start = time.time()
+    
+    if log_file is not None:
+        optimize_model_logger.addHandler(file_handler(log_file))
+    optimize_model_logger.setLevel(log_level)
+    
+    optimize_model_logger.info(u'loading "%s"', infile)
+    model = Model.load(infile, encoding=encoding)
+    report = {"observations": [len(model.observations)], "bytes": [model.nbytes]}
+    reference = None
+    if held_out is not None:
+        reference = Model.load(infile, encoding=encoding)
+    
+    if threshold is not None:
+        n_removed = model.prune(threshold)
+        optimize_model_logger.info(u"removed %i observations out of %i", n_removed, report["observations"][0])
+    if quantization is not None:
+        optimize_model_logger.info(u"quantizing weights to %s", quantization)
+        model.quantize(quantization, block_size=block_size)
+    report["observations"].append(len(model.observations))
+    report["bytes"].append(model.nbytes)
+    
+    if held_out is not None:
+        optimize_model_logger.info(u'tagging "%s"', held_out)
+        sentences = [sentence[:] for sentence in Reader(held_out, encoding)]
+        report["tokens"] = sum(len(sentence) for sentence in sentences)
+        report["sentences"] = len(sentences)
+        report["changed_tokens"], report["changed_sentences"] = tag_changes(reference, model, sentences)
+    
+    if to_text:
+        if quantization == u"int8":
+            optimize_model_logger.warn(u"Wapiti models cannot hold quantized weights, writing dequantized weights")
+        optimize_model_logger.info(u'writing Wapiti model "%s"', outfile)
+        model.write(outfile, encoding=encoding)
+    else:
+        optimize_model_logger.info(u'writing binary model "%s"', outfile)
+        model.write_binary(outfile)
+    
+    laps = time.time() - start
+    optimize_model_logger.info("done in %s", timedelta(seconds=laps))
+    
+    return report
+
+def main(args):
+    report = optimize_model(args.infile, args.outfile,
+                            threshold=args.threshold,
+                            quantization=args.quantization,
+                            block_size=args.block_size,
+                            held_out=args.held_out,
+                            to_text=args.to_text,
+                            encoding=args.enc,
+                            log_level=args.log_level, log_file=args.log_file)
+    
+    print "observations\t%i\t%i" %tuple(report["observations"])
+    print "bytes\t%i\t%i" %tuple(report["bytes"])
+    if "tokens" in report:
+        print "changed tokens\t%i/%i\t%.2f%%" %(report["changed_tokens"], report["tokens"], 100.0 * report["changed_tokens"] / max(report["tokens"], 1))
+        print "changed sentences\t%i/%i\t%.2f%%" %(report["changed_sentences"], report["sentences"], 100.0 * report["changed_sentences"] / max(report["sentences"], 1))
+
+
+
+import sem
+
+_subparsers = sem.argument_subparsers
+
+parser = _subparsers.add_parser(os.path.splitext(os.path.basename(__file__))[0], description="Makes a CRF model smaller by pruning observations and quantizing weights. Optionally reports how many tags are changed on held out data.")
+
+parser.add_argument("infile",
+                    help="The input model (Wapiti or binary format)")
+parser.add_argument("outfile",
+                    help="The output model (binary format)")
+parser.add_argument("-p", "--prune", dest="threshold", type=float,
+                    help="Remove observations whose weights are all under this value in absolute value")
+parser.add_argument("-q", "--quantize", dest="quantization", choices=("float16", "int8"),
+                    help="Quantize weights to the given type (requires numpy)")
+parser.add_argument("-b", "--block-size", dest="block_size", type=int, default=32,
+                    help="The number of weights sharing a scale in int8 quantization (default: %(default)s)")
+parser.add_argument("--held-out", dest="held_out",
+                    help="A CoNLL file to measure the changes in tagging on")
+parser.add_argument("-t", "--to-text", dest="to_text", action="store_true",
+                    help="Write the output model in Wapiti format")
+parser.add_argument("--encoding", dest="enc", default="UTF-8",
+                    help="Encoding of Wapiti models and held out data (default: %(default)s)")
+parser.add_argument("-l", "--log", dest="log_level", choices=("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"), default="WARNING",
+                    help="Increase log level (default: %(default)s)")
+parser.add_argument("--log-file", dest="log_file",
+                    help="The name of the log file")
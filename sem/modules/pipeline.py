@@ -28,8 +28,25 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import collections
+import cPickle
+import logging
+import multiprocessing
+import os
+import Queue
+import signal
+import sys
+import threading
+import traceback
+
+from sem import ON_WINDOWS
+from sem.logger import default_handler
+
 from .sem_module import SEMModule
 
+pipeline_logger = logging.getLogger("sem.pipeline")
+pipeline_logger.addHandler(default_handler)
+
 class Pipeline(SEMModule):
     def __init__(self, pipes, log_level="WARNING", log_file=None, **kwargs):
         super(Pipeline, self).__init__(log_level=log_level, log_file=log_file, **kwargs)
@@ -80,3 +97,422 @@ class Pipeline(SEMModule):
                     arguments[key] = value
             pipes.append(Class(**arguments))
         pipeline = sem.modules.pipeline.Pipeline(pipes)
+
+class StagedPipeline(Pipeline):
+    """
+    A pipeline in which every pipe runs in its own thread: sentences go from
+    a pipe to the next in batches of batch_size sentences, through queues of
+    at most queue_size batches, so that pipes process different parts of a
+    document at once. For example, sentences just enriched are labeled by
+    Wapiti, which does not hold the GIL, while the next ones are enriched.
+    
+    A barrier pipe (see SEMModule.barrier) waits for the previous pipes to
+    be done with a document, the next pipes start once it is done in turn.
+    """
+    
+    def __init__(self, pipes, batch_size=100, queue_size=4, log_level="WARNING", log_file=None, **kwargs):
+        super(StagedPipeline, self).__init__(pipes, log_level=log_level, log_file=log_file, **kwargs)
+        
+        self._batch_size = int(batch_size)
+        self._queue_size = int(queue_size)
+    
+    def process_document(self, document, **kwargs):
+        queues = [Queue.Queue(self._queue_size) for i in range(len(self._pipes) + 1)]
+        failed = threading.Event()
+        errors = []
+        threads = []
+        for i, pipe in enumerate(self._pipes):
+            thread = threading.Thread(target=self._run_stage, args=(pipe, document, queues[i], queues[i+1], failed, errors, kwargs))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        # fed from its own thread, the last queue being read meanwhile
+        feeder = threading.Thread(target=self._feed, args=(document, queues[0], failed))
+        feeder.daemon = True
+        feeder.start()
+        threads.append(feeder)
+        try:
+            while queues[-1].get() is not None:
+                pass
+        finally:
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+    
+    def _feed(self, document, queue, failed):
+        """
+        Sends the batches of document to queue, then None.
+        """
+        try:
+            for batch in self._batches(document):
+                if failed.is_set():
+                    break
+                queue.put(batch)
+        finally:
+            queue.put(None)
+    
+    def _batches(self, document):
+        sentences = (document.corpus.sentences if document.corpus is not None else [])
+        for i in range(0, len(sentences), self._batch_size):
+            yield sentences[i : i + self._batch_size]
+    
+    def _run_stage(self, pipe, document, input_queue, output_queue, failed, errors, kwargs):
+        """
+        Runs pipe on the batches of input_queue, which ends with None, and
+        sends them to output_queue. After an error in any stage, batches
+        are only read so that no stage blocks, the end is still sent.
+        """
+        started = False
+        state = None
+        batch = None
+        try:
+            batch = input_queue.get()
+            while batch is not None:
+                if not (pipe.barrier or failed.is_set()):
+                    if not started:
+                        state = pipe.begin_document(document, **kwargs)
+                        started = True
+                    pipe.process_sentences(document, batch, state, **kwargs)
+                    output_queue.put(batch)
+                batch = input_queue.get()
+            if not failed.is_set():
+                if pipe.barrier:
+                    pipe.process_document(document, **kwargs)
+                    for sentences in self._batches(document):
+                        output_queue.put(sentences)
+                else:
+                    if not started:
+                        state = pipe.begin_document(document, **kwargs)
+                    pipe.end_document(document, state, **kwargs)
+        except Exception:
+            errors.append(sys.exc_info())
+            failed.set()
+            while batch is not None:
+                batch = input_queue.get()
+        finally:
+            output_queue.put(None)
+
+def process(pipeline, document):
+    """
+    The default function of a ParallelPipeline: processes document and
+    returns it.
+    """
+    pipeline.process_document(document)
+    return document
+
+def _run(function, pipeline, item):
+    """
+    Returns the result of function on item and None, or None and the
+    traceback of the error raised.
+    """
+    try:
+        return function(pipeline, item), None
+    except Exception:
+        return None, traceback.format_exc().decode("utf-8", "replace")
+
+def _worker_loop(pipeline, function, tasks, results):
+    """
+    The loop of a ParallelPipeline worker: processes the tasks it is sent
+    until it gets None. Results are pickled here, so that one that cannot
+    be pickled is reported as an error of its task.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # the parent process handles interruptions
+    pid = os.getpid()
+    for index, item in iter(tasks.get, None):
+        outcome = _run(function, pipeline, item)
+        try:
+            payload = cPickle.dumps(outcome, cPickle.HIGHEST_PROTOCOL)
+        except Exception:
+            payload = cPickle.dumps((None, traceback.format_exc().decode("utf-8", "replace")), cPickle.HIGHEST_PROTOCOL)
+        results.put((pid, index, payload))
+    results.put((pid, None, None))
+
+class _Worker(object):
+    def __init__(self, pipeline, function, results):
+        self.tasks = multiprocessing.Queue()
+        self.outstanding = [] # indices of the tasks sent and not done
+        self.assigned = 0
+        self.retired = False
+        self.process = multiprocessing.Process(target=_worker_loop, args=(pipeline, function, self.tasks, results))
+        self.process.daemon = True
+        self.process.start()
+    
+    @property
+    def pid(self):
+        return self.process.pid
+    
+    def submit(self, index, item):
+        self.outstanding.append(index)
+        self.assigned += 1
+        self.tasks.put((index, item))
+    
+    def retire(self):
+        self.retired = True
+        self.tasks.put(None)
+    
+    def join(self):
+        self.process.join()
+        self.tasks.close()
+    
+    def terminate(self):
+        if self.process.is_alive():
+            self.process.terminate()
+        self.join()
+
+class ParallelPipeline(object):
+    """
+    Processes documents with a pipeline in jobs processes at once. Workers
+    are forked once the pipeline is loaded, so that its resources (models,
+    dictionaries...) are shared copy-on-write instead of loaded again.
+    
+    function(pipeline, item) is called on every item in a worker (see
+    process), its result being sent back to the calling process: items and
+    results have to be picklable.
+    At most queue_size items (2 per worker by default) are sent and not yet
+    returned, so that items are read as they are needed. Results are
+    returned in the order of items if ordered is True, as soon as they are
+    done otherwise.
+    A worker is replaced by a new one after max_documents items (None for
+    no limit), which contains the memory growth of long runs. A worker that
+    dies is replaced as well, the items it had are reported as errors.
+    
+    Where processes cannot be forked (Windows) or if jobs is 1, items are
+    processed in the calling process.
+    
+    Items that do not come at once (eg: requests of a server) are given
+    to send whenever the pipeline is ready, their results are collected
+    with receive. They are not to be mixed with imap.
+    """
+    
+    def __init__(self, pipeline, jobs=None, function=process, ordered=True, queue_size=None, max_documents=None):
+        self._pipeline = pipeline
+        self._jobs = max(1, int(jobs or multiprocessing.cpu_count()))
+        self._function = function
+        self._ordered = ordered
+        self._queue_size = max(self._jobs, int(queue_size or 2 * self._jobs))
+        self._max_documents = (int(max_documents) if max_documents else None)
+        self._workers = {} # pid -> _Worker
+        self._results = None
+        self._recycled = 0
+        self._sent = {} # index -> item, sent and not received yet
+        self._next_index = 0
+        self._finished = [] # results of items processed in the calling process
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    @property
+    def pipeline(self):
+        return self._pipeline
+    
+    @property
+    def jobs(self):
+        return self._jobs
+    
+    @property
+    def parallel(self):
+        return self._jobs > 1 and not ON_WINDOWS
+    
+    @property
+    def recycled(self):
+        """
+        The number of workers replaced after max_documents items.
+        """
+        return self._recycled
+    
+    @property
+    def pending(self):
+        """
+        The number of items sent and not received yet.
+        """
+        return len(self._sent)
+    
+    @property
+    def ready(self):
+        """
+        Whether an item can be sent now.
+        """
+        if not self.parallel:
+            return True
+        return len(self._sent) < self._queue_size and self._available_worker() is not None
+    
+    def start(self):
+        """
+        Starts the workers now instead of when the first item comes, eg:
+        before the calling process starts threads.
+        """
+        if self.parallel:
+            self._available_worker()
+    
+    def send(self, item):
+        """
+        Sends item to a worker, which the pipeline has to be ready for, and
+        returns its index. Where items are processed in the calling process,
+        item is processed now.
+        """
+        index = self._next_index
+        self._next_index += 1
+        if not self.parallel:
+            result, error = _run(self._function, self._pipeline, item)
+            self._finished.append((index, item, result, error))
+            return index
+        worker = self._available_worker()
+        if worker is None or len(self._sent) >= self._queue_size:
+            raise RuntimeError(u"no worker available")
+        self._sent[index] = item
+        worker.submit(index, item)
+        if worker.assigned == self._max_documents:
+            worker.retire()
+            self._recycled += 1
+            pipeline_logger.debug(u"recycling worker %i after %i documents" %(worker.pid, worker.assigned))
+        return index
+    
+    def receive(self, timeout=0.5):
+        """
+        Returns (index, item, result, error) for the items sent that are
+        done, waiting at most timeout seconds for the first one (see
+        imap).
+        """
+        if not self.parallel:
+            finished, self._finished = self._finished, []
+            return finished
+        if self._results is None:
+            return []
+        # also waiting when nothing was sent, for retired workers to stop
+        return [(index, self._sent.pop(index), result, error) for index, result, error in self._receive(timeout)]
+    
+    def imap(self, items):
+        """
+        Yields (item, result, error) for every item of items, error being
+        None or the traceback of the error raised by function on item, in
+        which case result is None.
+        """
+        if not self.parallel:
+            for item in items:
+                result, error = _run(self._function, self._pipeline, item)
+                yield item, result, error
+            return
+        
+        items = iter(items)
+        order = collections.deque() # indices sent, in the order of items
+        done = {} # index -> (item, result, error), waiting for previous ones
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and self.ready:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    index = self.send(item)
+                    if self._ordered:
+                        order.append(index)
+                if exhausted and not self._sent:
+                    return
+                for index, item, result, error in self.receive():
+                    if self._ordered:
+                        done[index] = (item, result, error)
+                    else:
+                        yield (item, result, error)
+                while order and order[0] in done:
+                    yield done.pop(order.popleft())
+        finally:
+            if self._sent:
+                # stopped before the end: workers still have tasks whose
+                # results would be mistaken for the next ones.
+                self.close()
+    
+    def map(self, items):
+        """
+        Returns the results of every item, raises a RuntimeError at the
+        first error.
+        """
+        results = []
+        for item, result, error in self.imap(items):
+            if error is not None:
+                raise RuntimeError(u"could not process %s:\n%s" %(getattr(item, "name", item), error))
+            results.append(result)
+        return results
+    
+    def close(self):
+        """
+        Stops the workers, new ones are started when needed.
+        """
+        for worker in self._workers.values():
+            worker.terminate()
+        self._workers.clear()
+        self._sent.clear()
+        if self._results is not None:
+            self._results.close()
+            self._results = None
+    
+    def _available_worker(self):
+        if self._results is None:
+            self._results = multiprocessing.Queue()
+        # retired workers are replaced once they stopped, not to have more
+        # than jobs processes at once.
+        while len(self._workers) < self._jobs:
+            worker = _Worker(self._pipeline, self._function, self._results)
+            self._workers[worker.pid] = worker
+        candidates = [worker for worker in self._workers.values() if not worker.retired and len(worker.outstanding) < 2]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda worker: len(worker.outstanding))
+    
+    def _receive(self, timeout=0.5):
+        """
+        Waits for messages from workers and returns the results received
+        as (index, result, error), which may be none (eg: a worker stopped).
+        """
+        try:
+            message = self._results.get(timeout=timeout)
+        except Queue.Empty:
+            return self._check_workers()
+        finished = self._handle(message)
+        while True: # getting all messages already there
+            try:
+                message = self._results.get_nowait()
+            except Queue.Empty:
+                break
+            finished.extend(self._handle(message))
+        return finished
+    
+    def _handle(self, message):
+        pid, index, payload = message
+        worker = self._workers.get(pid)
+        if worker is None: # a stopped worker
+            return []
+        if index is None: # the worker stops after being retired
+            # not terminated: it may still hold the lock of the queue.
+            worker.join()
+            del self._workers[pid]
+            return []
+        worker.outstanding.remove(index)
+        result, error = cPickle.loads(payload)
+        return [(index, result, error)]
+    
+    def _check_workers(self):
+        finished = []
+        for pid, worker in self._workers.items():
+            if worker.process.is_alive():
+                continue
+            # what the worker sent before exiting may still be in the queue
+            while True:
+                try:
+                    message = self._results.get_nowait()
+                except Queue.Empty:
+                    break
+                finished.extend(self._handle(message))
+            if pid not in self._workers:
+                continue
+            error = u"worker %i exited with code %s" %(pid, worker.process.exitcode)
+            pipeline_logger.error(error)
+            finished.extend((index, None, error) for index in worker.outstanding)
+            worker.terminate()
+            del self._workers[pid]
+        return finished
@@ -50,6 +50,9 @@ segmentation_logger = logging.getLogger("sem.segmentation")
 segmentation_logger.addHandler(default_handler)
 
 class SEMModule(RootModule):
+    barrier = True # sentences do not exist before segmentation
+    document_scope = False # paragraphs are segmented independently
+    
     def __init__(self, tokeniser, log_level="WARNING", log_file=None, **kwargs):
         super(SEMModule, self).__init__(log_level=log_level, log_file=log_file, **kwargs)
         
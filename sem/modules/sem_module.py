@@ -32,6 +32,21 @@ import logging
 from sem.storage.holder import Holder
 
 class SEMModule(Holder):
+    # The two flags below describe different things, a module may need to
+    # wait for a document to be complete without needing all of its content.
+    #
+    # barrier: whether the module processes a document only once the
+    # previous modules are done with all of it (see process_document).
+    # Modules that can process sentences as they come set it to False and
+    # implement begin_document, process_sentences and end_document, which
+    # sem.modules.pipeline.StagedPipeline calls from its own thread.
+    barrier = True
+    # document_scope: whether the results of the module on a document differ
+    # from its results on parts of it made of whole paragraphs, put back
+    # together. The streaming mode of the tagger (sem.modules.tagger.tag_stream)
+    # reads documents by parts and keeps them in memory only for such modules.
+    document_scope = True
+    
     def __init__(self, log_level="WARNING", log_file=None, **kwargs):
         super(SEMModule, self).__init__(**kwargs)
         
@@ -40,3 +55,23 @@ class SEMModule(Holder):
     
     def process_document(self, document, **kwargs):
         raise NotImplementedError("process_document not implemented for root type " + self.__class__)
+    
+    def begin_document(self, document, **kwargs):
+        """
+        Called before the first sentences of document are processed.
+        Returns the state of the processing of document (None by default),
+        which is given to process_sentences and end_document.
+        """
+        return None
+    
+    def process_sentences(self, document, sentences, state, **kwargs):
+        """
+        Processes some sentences of document, in the order of the document.
+        """
+        raise NotImplementedError("process_sentences not implemented for %s" %self.__class__.__name__)
+    
+    def end_document(self, document, state, **kwargs):
+        """
+        Called once every sentence of document was processed.
+        """
+        pass
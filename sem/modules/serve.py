@@ -0,0 +1,496 @@
+#-*- coding: utf-8 -*-
+
+"""
+file: serve.py
+
+Description: a server that loads pipelines once and annotates the
+documents it is sent over HTTP, on a TCP or a Unix socket.
+
+author: Yoann Dupont
+
+MIT License
+
+Copyright (c) 2018 Yoann Dupont
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import BaseHTTPServer
+import cgi
+import collections
+import functools
+import json
+import logging
+import mimetypes
+import os
+import Queue
+import signal
+import SocketServer
+import stat
+import sys
+import threading
+import time
+import urlparse
+
+import sem
+import sem.exporters
+
+from sem.logger import default_handler
+from sem.storage import Document
+from sem.modules.pipeline import ParallelPipeline
+from sem.modules.tagger import load_master, get_section
+
+sem_serve_logger = logging.getLogger("sem.serve")
+sem_serve_logger.addHandler(default_handler)
+
+def annotate(pipeline, request, options, couples):
+    """
+    Annotates the text of request, a (content, name, export format)
+    tuple, and returns it in the export format. This is what workers do.
+    """
+    content, name, export_format = request
+    opts = get_section(options, "file")
+    opts.update(get_section(options, "encoding"))
+    document = Document(name, content=content.replace(u"\r", u""), **opts)
+    pipeline.process_document(document)
+    exporter = sem.exporters.get_exporter(export_format)(**couples)
+    return exporter.document_to_unicode(document, couples)
+
+class AnnotationTimeout(RuntimeError):
+    pass
+
+class _Job(object):
+    def __init__(self, request):
+        self.request = request
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.cancelled = False
+
+class Annotator(object):
+    """
+    The pipeline of a master file, whose documents are annotated by jobs
+    workers forked once it is loaded (see ParallelPipeline). Documents
+    wait in a queue, those that come within batch_delay seconds of the
+    first one (at most batch_size) are sent to the workers together.
+    Documents are sent as long as workers can take them, the results of
+    those sent before being collected meanwhile.
+    Workers call function(pipeline, request, options, couples) on every
+    document (see annotate).
+    """
+
+    def __init__(self, master, name=None, jobs=None, batch_size=16, batch_delay=0.005, max_documents=None, function=annotate):
+        self._name = name or os.path.splitext(os.path.basename(master))[0]
+        pipeline, self._options, exporter, self._couples = load_master(master)
+        self._batch_size = max(1, int(batch_size))
+        self._batch_delay = max(0.0, float(batch_delay))
+        self._pool = ParallelPipeline(pipeline, jobs=jobs, function=functools.partial(function, options=self._options, couples=self._couples), ordered=False, max_documents=max_documents)
+        self._pool.start()
+        self._queue = Queue.Queue()
+        self._waiting = collections.deque() # jobs out of the queue, not sent yet
+        self._lock = threading.Lock()
+        self._counts = collections.Counter()
+        self._thread = threading.Thread(target=self._dispatch, name=u"sem-serve-%s" %self._name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def export_format(self):
+        """
+        The export format of the master file, None if it has none.
+        """
+        return self._couples.get("format")
+
+    def submit(self, content, name=u"document", export_format=None):
+        """
+        Queues a document to annotate and returns its job, whose done
+        event is set once its result (or error) is known.
+        """
+        job = _Job((content, name, export_format or self.export_format))
+        self._queue.put(job)
+        return job
+
+    def annotate(self, content, name=u"document", export_format=None, timeout=None):
+        """
+        Returns content annotated and exported in export_format (that of
+        the master file by default). Raises an AnnotationTimeout if it is
+        not done in timeout seconds and a RuntimeError if it failed.
+        A document that timed out is not annotated if it is still queued.
+        """
+        job = self.submit(content, name=name, export_format=export_format)
+        if not job.done.wait(timeout):
+            job.cancelled = True
+            self._count(u"timeouts")
+            raise AnnotationTimeout(u"%s: not annotated after %s seconds" %(name, timeout))
+        if job.error is not None:
+            raise RuntimeError(job.error)
+        return job.result
+
+    def health(self):
+        with self._lock:
+            counts = dict(self._counts)
+        return {
+            u"name": self._name,
+            u"alive": self._thread.is_alive(),
+            u"jobs": self._pool.jobs,
+            u"parallel": self._pool.parallel,
+            u"recycled": self._pool.recycled,
+            u"queued": self._queue.qsize() + len(self._waiting),
+            u"batches": counts.get(u"batches", 0),
+            u"documents": counts.get(u"documents", 0),
+            u"failed": counts.get(u"failed", 0),
+            u"timeouts": counts.get(u"timeouts", 0)
+        }
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._pool.close()
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self._counts[key] += n
+
+    def _next_batch(self, block=True):
+        """
+        Waits for a job (if block is True), then for the next ones until
+        the batch is full or batch_delay is over. Returns None once the
+        annotator is closed, an empty batch if there is no job to wait for.
+        """
+        try:
+            job = self._queue.get(block)
+        except Queue.Empty:
+            return []
+        if job is None:
+            return None
+        batch = [job]
+        deadline = time.time() + self._batch_delay
+        while len(batch) < self._batch_size:
+            try:
+                job = self._queue.get(timeout=max(0.0, deadline - time.time()))
+            except Queue.Empty:
+                break
+            if job is None:
+                self._queue.put(None) # stopping after this batch
+                break
+            batch.append(job)
+        return batch
+
+    def _dispatch(self):
+        jobs = {} # index -> job sent to the workers
+        closed = False
+        while not closed or jobs or self._waiting:
+            if not (closed or self._waiting):
+                batch = self._next_batch(block=not jobs)
+                if batch is None:
+                    closed = True
+                elif batch:
+                    self._count(u"batches")
+                    self._waiting.extend(batch)
+            try:
+                while self._waiting and self._pool.ready:
+                    if not self._waiting[0].cancelled:
+                        jobs[self._pool.send(self._waiting[0].request)] = self._waiting[0]
+                    self._waiting.popleft()
+                if not (jobs or self._waiting):
+                    continue
+                # new jobs are looked for shortly unless workers are busy
+                timeout = (0.5 if closed or self._waiting else max(self._batch_delay, 0.001))
+                for index, request, result, error in self._pool.receive(timeout):
+                    job = jobs.pop(index)
+                    job.result, job.error = result, error
+                    self._count(u"documents")
+                    if error is not None:
+                        self._count(u"failed")
+                        sem_serve_logger.error(u"could not annotate %s:\n%s" %(request[1], error))
+                    job.done.set()
+            except Exception as exception:
+                # the pool could not be used (eg: a worker could not be
+                # forked), the next jobs will try again.
+                sem_serve_logger.exception(u"annotation failed")
+                self._pool.close()
+                failed = jobs.values() + list(self._waiting)
+                jobs.clear()
+                self._waiting.clear()
+                for job in failed:
+                    job.error = u"%s: %s" %(exception.__class__.__name__, exception)
+                    job.done.set()
+                self._count(u"failed", len(failed))
+
+class ServiceError(Exception):
+    def __init__(self, status, message):
+        super(ServiceError, self).__init__(message)
+        self.status = status
+
+class Service(object):
+    """
+    What the server does: dispatching documents to annotators, at most
+    max_requests at once, and waiting timeout seconds at most for each.
+    """
+
+    def __init__(self, annotators, timeout=30.0, max_requests=32):
+        self._annotators = collections.OrderedDict((annotator.name, annotator) for annotator in annotators)
+        self._timeout = float(timeout)
+        self._max_requests = int(max_requests)
+        self._slots = threading.BoundedSemaphore(self._max_requests)
+        self._lock = threading.Lock()
+        self._active = 0
+        self._rejected = 0
+        self._start = time.time()
+
+    @property
+    def annotators(self):
+        return self._annotators.values()
+
+    def annotate(self, content, pipeline=None, export_format=None, name=None, timeout=None):
+        """
+        Returns content annotated by pipeline (which is optional if there
+        is only one) and its MIME type. Raises a ServiceError with the HTTP
+        status to send back if it could not be done.
+        """
+        if not self._slots.acquire(False):
+            with self._lock:
+                self._rejected += 1
+            raise ServiceError(503, u"too many requests, at most %i at once" %self._max_requests)
+        with self._lock:
+            self._active += 1
+        try:
+            if pipeline is None:
+                if len(self._annotators) != 1:
+                    raise ServiceError(400, u"pipeline not given, available: %s" %u", ".join(self._annotators))
+                annotator = self._annotators.values()[0]
+            elif pipeline in self._annotators:
+                annotator = self._annotators[pipeline]
+            else:
+                raise ServiceError(404, u"unknown pipeline: %s" %pipeline)
+            export_format = export_format or annotator.export_format
+            if export_format is None:
+                raise ServiceError(400, u"export format not given")
+            try:
+                Exporter = sem.exporters.get_exporter(export_format)
+            except (ImportError, AttributeError):
+                raise ServiceError(400, u"unknown export format: %s" %export_format)
+            try:
+                timeout = (min(float(timeout), self._timeout) if timeout is not None else self._timeout)
+            except ValueError:
+                raise ServiceError(400, u"invalid timeout: %s" %timeout)
+
+            try:
+                output = annotator.annotate(content, name=name or u"document", export_format=export_format, timeout=timeout)
+            except AnnotationTimeout as exception:
+                raise ServiceError(504, unicode(exception))
+            except RuntimeError as exception:
+                raise ServiceError(500, unicode(exception).strip().splitlines()[-1])
+            return output, (mimetypes.guess_type(u"document.%s" %Exporter.extension())[0] or u"text/plain")
+        finally:
+            with self._lock:
+                self._active -= 1
+            self._slots.release()
+
+    def health(self):
+        pipelines = [annotator.health() for annotator in self._annotators.values()]
+        with self._lock:
+            active, rejected = self._active, self._rejected
+        return {
+            u"status": (u"ok" if all(pipeline[u"alive"] for pipeline in pipelines) else u"error"),
+            u"version": sem.version(),
+            u"uptime": time.time() - self._start,
+            u"active": active,
+            u"max_requests": self._max_requests,
+            u"rejected": rejected,
+            u"pipelines": pipelines
+        }
+
+    def close(self):
+        for annotator in self._annotators.values():
+            annotator.close()
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    GET /health returns the state of the service in JSON.
+    POST /annotate returns the document in the body (plain text, UTF-8
+    unless another charset is given), annotated. The pipeline, the export
+    format, the name of the document and the timeout may be given in the
+    query string. Errors are sent as {"error": message} in JSON.
+    """
+
+    server_version = "SEM/%s" %sem.version()
+
+    def do_GET(self):
+        path = urlparse.urlsplit(self.path).path
+        if path != "/health":
+            self._send_json(404, {u"error": u"not found: %s" %path})
+            return
+        health = self.server.service.health()
+        self._send_json((200 if health[u"status"] == u"ok" else 503), health)
+
+    def do_POST(self):
+        url = urlparse.urlsplit(self.path)
+        if url.path != "/annotate":
+            self._send_json(404, {u"error": u"not found: %s" %url.path})
+            return
+        query = dict(urlparse.parse_qsl(url.query))
+        try:
+            length = int(self.headers.getheader("content-length"))
+        except (TypeError, ValueError):
+            self._send_json(411, {u"error": u"content length required"})
+            return
+        body = self.rfile.read(length)
+        _, params = cgi.parse_header(self.headers.getheader("content-type", "text/plain"))
+        try:
+            content = body.decode(params.get("charset", "utf-8"))
+        except (LookupError, UnicodeDecodeError) as exception:
+            self._send_json(400, {u"error": u"could not decode document: %s" %exception})
+            return
+
+        try:
+            output, mime_type = self.server.service.annotate(content, pipeline=query.get("pipeline"), export_format=query.get("format"), name=(query["name"].decode("utf-8") if "name" in query else None), timeout=query.get("timeout"))
+        except ServiceError as exception:
+            self._send_json(exception.status, {u"error": unicode(exception)})
+        except Exception as exception:
+            sem_serve_logger.exception(u"could not handle request")
+            self._send_json(500, {u"error": u"%s: %s" %(exception.__class__.__name__, exception)})
+        else:
+            self._send(200, output.encode("utf-8"), "%s; charset=utf-8" %mime_type)
+
+    def log_message(self, format, *args):
+        # client addresses are not used, they are empty on Unix sockets.
+        sem_serve_logger.debug(format %args)
+
+    def _send_json(self, status, data):
+        self._send(status, json.dumps(data), "application/json")
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if status == 503:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(body)
+
+class HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        self.service = service
+        BaseHTTPServer.HTTPServer.__init__(self, address, RequestHandler)
+
+class UnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, service):
+        self.service = service
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path) # left by a server that did not stop properly
+        SocketServer.UnixStreamServer.__init__(self, path, RequestHandler)
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+def main(args):
+    """
+    Loads the pipelines of the master files and serves them until
+    interrupted.
+
+    Parameters
+    ----------
+    master : list of str
+        the master files, the name of a pipeline being that of its master
+        file without extension.
+    host, port : str, int
+        the address to listen to, only the local host by default.
+    unix_socket : str
+        the Unix socket to listen to instead.
+    jobs : int
+        the number of processes annotating documents for each pipeline.
+    timeout : float
+        the number of seconds to wait for a document to be annotated.
+    max_requests : int
+        the number of documents annotated at once, others are refused.
+    """
+    sem_serve_logger.setLevel(getattr(args, "log_level", "INFO"))
+
+    names = [os.path.splitext(os.path.basename(master))[0] for master in args.master]
+    duplicates = set(name for name in names if names.count(name) > 1)
+    if duplicates:
+        raise ValueError(u"pipelines with the same name: %s" %u", ".join(sorted(duplicates)))
+
+    annotators = []
+    try:
+        for master in args.master:
+            sem_serve_logger.info(u"loading %s" %master)
+            annotators.append(Annotator(master, jobs=args.jobs, batch_size=args.batch_size, batch_delay=args.batch_delay, max_documents=args.max_documents))
+        service = Service(annotators, timeout=args.timeout, max_requests=args.max_requests)
+        if args.unix_socket:
+            server = UnixHTTPServer(args.unix_socket, service)
+        else:
+            server = HTTPServer((args.host, args.port), service)
+    except:
+        for annotator in annotators:
+            annotator.close()
+        raise
+
+    # stopping properly, so that workers stop as well.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    sem_serve_logger.info(u"serving %s on %s" %(u", ".join(names), (args.unix_socket or u"http://%s:%i" %server.server_address[:2])))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        sem_serve_logger.info(u"stopped")
+
+
+import sem
+
+_subparsers = sem.argument_subparsers
+
+parser = _subparsers.add_parser(os.path.splitext(os.path.basename(__file__))[0], description="Loads pipelines once and annotates the documents sent over HTTP.")
+
+parser.add_argument("master", nargs="+",
+                    help="The master configuration files of the pipelines to serve.")
+parser.add_argument("--host", default="127.0.0.1",
+                    help='The address to listen to (default: "%(default)s").')
+parser.add_argument("-p", "--port", type=int, default=8080,
+                    help="The port to listen to (default: %(default)s).")
+parser.add_argument("--unix-socket", dest="unix_socket",
+                    help="The Unix socket to listen to instead of a port.")
+parser.add_argument("-j", "--jobs", type=int,
+                    help="The number of processes annotating documents for each pipeline (default: the number of CPUs).")
+parser.add_argument("--max-documents", dest="max_documents", type=int,
+                    help="Replace a process after it annotated that many documents, to contain memory growth (default: never).")
+parser.add_argument("--batch-size", dest="batch_size", type=int, default=16,
+                    help="The maximum number of documents sent to the processes at once (default: %(default)s).")
+parser.add_argument("--batch-delay", dest="batch_delay", type=float, default=0.005,
+                    help="The number of seconds to wait for other documents to send with the first one (default: %(default)s).")
+parser.add_argument("-t", "--timeout", type=float, default=30.0,
+                    help="The number of seconds to wait for a document to be annotated (default: %(default)s).")
+parser.add_argument("--max-requests", dest="max_requests", type=int, default=32,
+                    help="The maximum number of documents being annotated at once, others are refused (default: %(default)s).")
+parser.add_argument("-l", "--log", dest="log_level", choices=("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"), default="INFO",
+                    help="Increase log level (default: %(default)s)")
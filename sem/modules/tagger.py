@@ -31,9 +31,11 @@ SOFTWARE.
 """
 
 import codecs
+import glob
 import logging
 import os
 import shutil
+import sys
 import ConfigParser
 
 try:
@@ -49,11 +51,12 @@ import os.path
 
 import sem
 
-from sem.logger import logging_format, default_handler
+from sem.logger import logging_format, default_handler, file_handler
 from sem.storage import Document
 
 from sem.modules import get_module
 import sem.modules.pipeline
+from sem.modules.pipeline import ParallelPipeline, StagedPipeline
 import sem.modules.export
 import sem.exporters
 import sem.exporters.conll
@@ -139,6 +142,228 @@ def load_master(master, force_format="default"):
     
     return pipeline, options, exporter, couples
 
+def expand_inputs(inputs, manifest=None, recursive=False):
+    """
+    Returns the list of files to process. inputs are files, directories
+    (whose files are processed, recursively if recursive is True) or glob
+    patterns. manifest is a file listing one input per line, "-" to read
+    them from the standard input.
+    """
+    if manifest is not None:
+        stream = (sys.stdin if manifest == u"-" else codecs.open(manifest, "rU", "utf-8"))
+        inputs = list(inputs) + [line.strip() for line in stream if line.strip()]
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            if recursive:
+                for root, dirnames, filenames in os.walk(item):
+                    dirnames.sort()
+                    paths.extend(os.path.join(root, filename) for filename in sorted(filenames))
+            else:
+                paths.extend(os.path.join(item, filename) for filename in sorted(os.listdir(item)) if os.path.isfile(os.path.join(item, filename)))
+        elif os.path.exists(item):
+            paths.append(item)
+        else:
+            matches = sorted(glob.glob(item))
+            if not matches:
+                sem_tagger_logger.warn(u"no file matching %s" %item)
+            paths.extend(matches)
+    return paths
+
+def tag_file(infile, pipeline, options, exporter, couples, output_directory=u"."):
+    """
+    Reads infile (a file name or a Document), passes it through the
+    pipeline and exports it in output_directory. Returns the document.
+    """
+    ienc = get_option(options, "encoding", "input_encoding", "utf-8")
+    
+    if isinstance(infile, Document):
+        sem_tagger_logger.info("Reading %s" %(infile.name))
+        document = infile
+    else:
+        sem_tagger_logger.info("Reading %s" %(infile))
+        file_format = get_option(options, "file", "format", "guess")
+        opts = get_section(options, "file")
+        opts.update(get_section(options, "encoding"))
+        if file_format == "text":
+            document = Document(os.path.basename(infile), content=codecs.open(infile, "rU", ienc).read().replace(u"\r", u""), **opts)
+        elif file_format == "conll":
+            opts["fields"] = opts["fields"].split(u",")
+            opts["taggings"] = [tagging for tagging in opts.get("taggings", u"").split(u",") if tagging]
+            opts["chunkings"] = [chunking for chunking in opts.get("chunkings", u"").split(u",") if chunking]
+            document = Document.from_conll(infile, **opts)
+        elif file_format == "guess":
+            document = sem.importers.load(infile, logger=sem_tagger_logger, **opts)
+        else:
+            raise ValueError(u"unknown format: %s" %file_format)
+    
+    pipeline.process_document(document)
+    
+    if exporter is not None:
+        export_document(document, options, exporter, couples, output_directory=output_directory)
+    
+    return document
+
+def output_paths(name, exporter, output_directory=u"."):
+    """
+    Returns the file exporter writes a document called name to and the
+    file its content is written to, None if it is not written.
+    """
+    if exporter.extension() == "ann":
+        filename = name
+        if not filename.endswith(".txt"):
+            filename += ".txt"
+        return os.path.join(output_directory, "%s.%s" %(os.path.splitext(name)[0], exporter.extension())), os.path.join(output_directory, filename)
+    return os.path.join(output_directory, "%s.%s" %(name, exporter.extension())), None
+
+def export_document(document, options, exporter, couples, output_directory=u"."):
+    oenc = get_option(options, "encoding", "output_encoding", "utf-8")
+    if "html" in exporter.extension():
+        shutil.copy(os.path.join(sem.SEM_RESOURCE_DIR, "css", "tabs.css"), output_directory)
+        shutil.copy(os.path.join(sem.SEM_RESOURCE_DIR, "css", exporter._lang, get_option(options, "export", "lang_style", "default.css")), output_directory)
+    
+    out_path, content_path = output_paths(document.escaped_name(), exporter, output_directory)
+    if content_path is not None:
+        with codecs.open(content_path, "w", oenc) as O:
+            O.write(document.content)
+    exporter.document_to_file(document, couples, out_path, encoding=oenc)
+
+def read_chunks(stream, chunk_size=1048576):
+    """
+    Yields the text of stream by parts of about chunk_size characters, cut
+    after an empty line so that paragraphs are not split. A paragraph
+    longer than chunk_size is cut after one of its lines.
+    """
+    lines = []
+    size = 0
+    cut = 0 # the number of lines up to the last empty one
+    for line in stream:
+        lines.append(line)
+        size += len(line)
+        if line.strip() == u"":
+            cut = len(lines)
+        if size >= chunk_size:
+            cut = cut or len(lines)
+            yield u"".join(lines[:cut])
+            lines = lines[cut:]
+            size = sum(len(line) for line in lines)
+            cut = 0
+    if lines:
+        yield u"".join(lines)
+
+def is_streamable(infile, options):
+    """
+    Tells whether infile is read as a text file, which can be tagged by
+    parts (see tag_stream).
+    """
+    if isinstance(infile, Document):
+        return False
+    file_format = get_option(options, "file", "format", "guess")
+    if file_format == "text":
+        return True
+    if file_format != "guess" or infile.startswith("http") or (get_option(options, "file", "fields") and get_option(options, "file", "word_field")):
+        return False
+    no_ext, ext = os.path.splitext(infile)
+    return not (ext in (".xml", ".ann") or (ext == ".txt" and os.path.exists(no_ext + ".ann")))
+
+def tag_stream(infile, pipeline, options, exporter, couples, output_directory=u".", chunk_size=1048576):
+    """
+    Tags the text file infile by parts of about chunk_size characters (see
+    read_chunks), so that memory does not grow with the size of the file.
+    Parts go through the modules of the pipeline up to the first one that
+    needs the whole document (see SEMModule.document_scope, barriers of
+    sem.modules.pipeline.StagedPipeline do not), they are put back together
+    for it and the next ones. Parts are written as soon as
+    they are tagged if the exporter can (see Exporter.incremental), the
+    whole document is exported at the end otherwise.
+    Returns the number of tokens tagged.
+    """
+    ienc = get_option(options, "encoding", "input_encoding", "utf-8")
+    oenc = get_option(options, "encoding", "output_encoding", "utf-8")
+    opts = get_section(options, "file")
+    opts.update(get_section(options, "encoding"))
+    
+    pipes = list(pipeline)
+    split = len(pipes)
+    for i, pipe in enumerate(pipes):
+        if pipe.document_scope:
+            split = i
+            break
+    streamed = sem.modules.pipeline.Pipeline(pipes[:split])
+    buffered = sem.modules.pipeline.Pipeline(pipes[split:])
+    incremental = (split == len(pipes) and (exporter is None or exporter.incremental))
+    if not incremental:
+        sem_tagger_logger.info(u"%s is kept in memory for %s" %(infile, (pipes[split].__class__.__module__ if split < len(pipes) else u"export")))
+    
+    sem_tagger_logger.info("Reading %s" %(infile))
+    name = os.path.basename(infile)
+    document = None
+    n_tokens = 0
+    context = {u"offset": 0}
+    outputs = [] # the files written part by part
+    try:
+        if incremental and exporter is not None:
+            out_path, content_path = output_paths(name, exporter, output_directory)
+            outputs = [codecs.open(out_path, "w", oenc)] + ([codecs.open(content_path, "w", oenc)] if content_path is not None else [])
+        with codecs.open(infile, "rU", ienc) as input_stream:
+            for text in read_chunks(input_stream, chunk_size=chunk_size):
+                chunk = Document(name, content=text.replace(u"\r", u""), **opts)
+                if chunk.content.strip():
+                    streamed.process_document(chunk)
+                    n_tokens += sum(len(sentence) for sentence in chunk.corpus.sentences)
+                if not incremental:
+                    if document is None:
+                        document = chunk
+                    else:
+                        document.append(chunk)
+                elif outputs:
+                    if chunk.content.strip():
+                        outputs[0].write(exporter.chunk_to_unicode(chunk, couples, context))
+                    if len(outputs) > 1:
+                        outputs[1].write(chunk.content)
+                context[u"offset"] += len(chunk.content)
+    finally:
+        for output in outputs:
+            output.close()
+    
+    if document is not None:
+        buffered.process_document(document)
+        if exporter is not None:
+            export_document(document, options, exporter, couples, output_directory=output_directory)
+    
+    return n_tokens
+
+def tag_files(infiles, pipeline, options, exporter, couples, output_directory=u".", jobs=1, max_documents=None, stream=False, chunk_size=1048576):
+    """
+    Tags every file of infiles with the same pipeline, in jobs processes
+    at once (see sem.modules.pipeline.ParallelPipeline). A file that cannot
+    be processed is logged and skipped. Returns a report with the number
+    of documents and tokens processed, the files that failed and the time
+    spent.
+    If stream is True, text files are tagged by parts (see tag_stream).
+    """
+    def tag(pipeline, infile):
+        if stream and is_streamable(infile, options):
+            return tag_stream(infile, pipeline, options, exporter, couples, output_directory=output_directory, chunk_size=chunk_size)
+        document = tag_file(infile, pipeline, options, exporter, couples, output_directory=output_directory)
+        return sum(len(sentence) for sentence in document.corpus.sentences)
+    
+    start = time.time()
+    n_documents = 0
+    n_tokens = 0
+    failed = []
+    with ParallelPipeline(pipeline, jobs=jobs, function=tag, ordered=False, max_documents=max_documents) as parallel:
+        for infile, tokens, error in parallel.imap(infiles):
+            if error is not None:
+                sem_tagger_logger.error(u"could not process %s\n%s" %(getattr(infile, "name", infile), error))
+                failed.append(infile)
+                continue
+            n_documents += 1
+            n_tokens += tokens
+    laps = time.time() - start
+    sem_tagger_logger.info(u"%i documents (%i tokens) processed in %s, %i failed: %.2f documents/s, %.1f tokens/s" %(n_documents, n_tokens, timedelta(seconds=laps), len(failed), n_documents / max(laps, 1e-9), n_tokens / max(laps, 1e-9)))
+    return {u"documents": n_documents, u"tokens": n_tokens, u"failed": failed, u"time": laps}
+
 def main(args):
     """
     Return a document after it passed through a pipeline.
@@ -150,6 +375,11 @@ def main(args):
     infile : str
         the input for the upcoming pipe. Its base value is the file to
         treat, it can be either "plain text" or CoNNL-formatted file.
+        It may also be a list of files, directories or glob patterns, in
+        which case they are all processed with the same pipeline (see
+        expand_inputs and tag_files) and a report is returned instead.
+    jobs : int
+        the number of processes tagging files at once in that case.
     directory : str
         the directory where every file will be outputted.
     """
@@ -166,6 +396,13 @@ def main(args):
         force_format = args.force_format
     except AttributeError:
         force_format = "default"
+    manifest = getattr(args, "manifest", None)
+    recursive = getattr(args, "recursive", False)
+    jobs = getattr(args, "jobs", 1)
+    max_documents = getattr(args, "max_documents", None)
+    staged = getattr(args, "staged", False)
+    stream = getattr(args, "stream", False)
+    chunk_size = getattr(args, "chunk_size", 1048576)
     
     try:
         pipeline = args.pipeline
@@ -174,6 +411,8 @@ def main(args):
         couples = args.couples
     except AttributeError:
         pipeline, options, exporter, couples = load_master(args.master, force_format)
+    if staged:
+        pipeline = StagedPipeline(pipeline.pipes)
     
     if get_option(options, "log", "log_file") is not None:
         sem_tagger_logger.addHandler(file_handler(get_option(options, "log", "log_file")))
@@ -182,61 +421,17 @@ def main(args):
     if not os.path.exists(output_directory):
         os.makedirs(output_directory)
     
-    exports = {} # keeping track of already done exports
-    
-    nth = 1
-    ienc = get_option(options, "encoding", "input_encoding", "utf-8")
-    oenc = get_option(options, "encoding", "output_encoding", "utf-8")
-    
-    current_fields = None
-    # the fields at the current state (depends on enrichments and
-    # info cleaning). They will be used for wapiti
-    
-    if isinstance(infile, Document):
-        sem_tagger_logger.info("Reading %s" %(infile.name))
-        document = infile
-    else:
-        sem_tagger_logger.info("Reading %s" %(infile))
-        file_shortname, _ = os.path.splitext(os.path.basename(infile))
-        export_name = os.path.join(output_directory, file_shortname)
-        file_format = get_option(options, "file", "format", "guess")
-        opts = get_section(options, "file")
-        opts.update(get_section(options, "encoding"))
-        if file_format == "text":
-            document = Document(os.path.basename(infile), content=codecs.open(infile, "rU", ienc).read().replace(u"\r", u""), **opts)
-        elif file_format == "conll":
-            opts["fields"] = opts["fields"].split(u",")
-            opts["taggings"] = [tagging for tagging in opts.get("taggings", u"").split(u",") if tagging]
-            opts["chunkings"] = [chunking for chunking in opts.get("chunkings", u"").split(u",") if chunking]
-            document = Document.from_conll(infile, **opts)
-        elif file_format == "guess":
-            document = sem.importers.load(infile, logger=sem_tagger_logger, **opts)
-        else:
-            raise ValueError(u"unknown format: %s" %file_format)
-    
-    pipeline.process_document(document)
-    
-    if exporter is not None:
-        name = document.escaped_name()
-        if "html" in exporter.extension():
-            shutil.copy(os.path.join(sem.SEM_RESOURCE_DIR, "css", "tabs.css"), output_directory)
-            shutil.copy(os.path.join(sem.SEM_RESOURCE_DIR, "css", exporter._lang, get_option(options, "export", "lang_style", "default.css")), output_directory)
-        
-        if exporter.extension() == "ann":
-            out_path = os.path.join(output_directory, "%s.%s" %(os.path.splitext(name)[0], exporter.extension()))
-            filename = name
-            if not filename.endswith(".txt"):
-                filename += ".txt"
-            with codecs.open(os.path.join(output_directory, filename), "w", oenc) as O:
-                O.write(document.content)
-        else:
-            out_path = os.path.join(output_directory, "%s.%s" %(name, exporter.extension()))
-        exporter.document_to_file(document, couples, out_path, encoding=oenc)
+    if isinstance(infile, (list, tuple)) and len(infile) == 1 and manifest is None and os.path.isfile(infile[0]):
+        infile = infile[0]
+    single = isinstance(infile, Document) or (isinstance(infile, basestring) and not (os.path.isdir(infile) or glob.has_magic(infile)))
+    if single and manifest is None and not stream:
+        document = tag_file(infile, pipeline, options, exporter, couples, output_directory=output_directory)
+        laps = time.time() - start
+        sem_tagger_logger.info('done in %s' %(timedelta(seconds=laps)))
+        return document
     
-    laps = time.time() - start
-    sem_tagger_logger.info('done in %s' %(timedelta(seconds=laps)))
-    
-    return document
+    inputs = ([infile] if isinstance(infile, basestring) else list(infile or []))
+    return tag_files(expand_inputs(inputs, manifest=manifest, recursive=recursive), pipeline, options, exporter, couples, output_directory=output_directory, jobs=jobs, max_documents=max_documents, stream=stream, chunk_size=chunk_size)
 
 
 import sem
@@ -247,8 +442,22 @@ parser = _subparsers.add_parser(os.path.splitext(os.path.basename(__file__))[0],
 
 parser.add_argument("master",
                     help="The master configuration file. Defines at least the pipeline and may provide some options.")
-parser.add_argument("infile",
-                    help="The input file for the tagger.")
+parser.add_argument("infile", nargs="*",
+                    help="The input files for the tagger: files, directories or glob patterns. When more than one file is given, the pipeline is loaded once for all of them.")
+parser.add_argument("--manifest",
+                    help='A file listing the inputs to process, one per line ("-" for the standard input).')
+parser.add_argument("-r", "--recursive", action="store_true",
+                    help="Process the files of input directories recursively.")
+parser.add_argument("-j", "--jobs", type=int, default=1,
+                    help="The number of processes tagging files at once, forked once the pipeline is loaded (default: %(default)s).")
+parser.add_argument("--max-documents", dest="max_documents", type=int,
+                    help="Replace a process after it tagged that many files, to contain memory growth (default: never).")
+parser.add_argument("--stream", action="store_true",
+                    help="Read text files by parts, which are tagged and written one after the other, so that memory does not grow with the size of files. Modules that need the whole document still get it.")
+parser.add_argument("--chunk-size", dest="chunk_size", type=int, default=1048576,
+                    help="The number of characters of the parts read in streaming mode (default: %(default)s).")
+parser.add_argument("--staged", action="store_true",
+                    help="Run every module of the pipeline in its own thread, sentences going from one to the next as they are processed.")
 parser.add_argument("-o", "--output-directory", dest="output_directory", default=".",
                     help='The output directory (default: "%(default)s").')
 parser.add_argument("-f", "--force-format", dest="force_format", default="default",
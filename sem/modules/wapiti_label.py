@@ -33,23 +33,43 @@ import logging, codecs, time, os.path
 from datetime import timedelta
 
 from .sem_module import SEMModule as RootModule
+import sem.libwapiti
 import sem.wapiti
 
 #TODO from sem.annotators            import get_annotator
 from sem.storage.document     import Document
 from sem.storage.segmentation import Segmentation
 from sem.logger               import default_handler, file_handler
+from sem.misc                 import str2bool
 
 annotate_logger = logging.getLogger("sem.wapiti_label")
 annotate_logger.addHandler(default_handler)
 
 class SEMModule(RootModule):
-    def __init__(self, model, field, annotation_fields=None, log_level="WARNING", log_file=None, **kwargs):
+    barrier = False # sentences are labeled independently
+    document_scope = False
+    
+    def __init__(self, model, field, annotation_fields=None, workers=1, pooled=True, shards=1, min_shard_size=100, log_level="WARNING", log_file=None, **kwargs):
+        """
+        If the Wapiti library is available (see sem.libwapiti), documents
+        are labeled in process. Otherwise, if pooled is True, documents are
+        labeled by a pool of workers long-lived Wapiti processes (see
+        sem.wapiti.WorkerPool), which loads the model once instead of once
+        per document.
+        
+        If shards is more than 1, the sentences of a document are split in
+        at most shards contiguous shards of at least min_shard_size
+        sentences, labeled in parallel by as many Wapiti processes.
+        """
         super(SEMModule, self).__init__(log_level=log_level, log_file=log_file, **kwargs)
         
         self._model = model
         self._field = field
         self._annotation_fields = annotation_fields
+        self._workers = int(workers)
+        self._pooled = (str2bool(pooled) if isinstance(pooled, basestring) else bool(pooled))
+        self._shards = int(shards)
+        self._min_shard_size = int(min_shard_size)
         
     
     def process_document(self, document, encoding="utf-8", **kwargs):
@@ -80,10 +100,50 @@ class SEMModule(RootModule):
         else:
             annotate_logger.info("annotating document with %s field", self._field)
             
-            sem.wapiti.label_document(document, self._model, self._field, encoding, annotation_name=self._field, annotation_fields=self._annotation_fields)
+            pool = (sem.wapiti.get_pool(self._model, size=self._workers, encoding=encoding) if self._pooled and not sem.libwapiti.available() else None)
+            sem.wapiti.label_document(document, self._model, self._field, encoding, annotation_name=self._field, annotation_fields=self._annotation_fields, pool=pool, shards=self._shards, min_shard_size=self._min_shard_size)
         
         laps = time.time() - start
         annotate_logger.info('in %s' %(timedelta(seconds=laps)))
+    
+    def begin_document(self, document, encoding="utf-8", **kwargs):
+        if self._log_file is not None:
+            annotate_logger.addHandler(file_handler(self._log_file))
+        annotate_logger.setLevel(self._log_level)
+        
+        if self._field in document.corpus.fields:
+            annotate_logger.warn("field %s already exists in document, not annotating", self._field)
+            return None
+        
+        annotate_logger.info("annotating document with %s field", self._field)
+        fields = self._annotation_fields or document.corpus.fields
+        state = {
+            u"start": time.time(),
+            u"format": u"\t".join([u"%%(%s)s" %f for f in fields]),
+            u"label": sem.wapiti.sentence_labeler(self._model, encoding=encoding, pool=(sem.wapiti.get_pool(self._model, size=self._workers, encoding=encoding) if self._pooled and not sem.libwapiti.available() else None)),
+            u"tags": []
+        }
+        # added now so that next modules know it
+        document.corpus.fields.append(self._field)
+        return state
+    
+    def process_sentences(self, document, sentences, state, **kwargs):
+        if state is None:
+            return
+        fmt = state[u"format"]
+        for sentence, labels in zip(sentences, state[u"label"]([[fmt %token for token in sentence] for sentence in sentences])):
+            for token, label in zip(sentence, labels):
+                token[self._field] = label
+            if labels:
+                state[u"tags"].append(labels)
+    
+    def end_document(self, document, state, **kwargs):
+        if state is None:
+            return
+        if state[u"tags"]:
+            document.add_annotation_from_tags(state[u"tags"], self._field, self._field)
+        laps = time.time() - state[u"start"]
+        annotate_logger.info('in %s' %(timedelta(seconds=laps)))
 
 def main(args):
     sem.wapiti.label(args.infile, args.model, args.outfile)
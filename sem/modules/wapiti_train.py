@@ -0,0 +1,266 @@
+#-*- coding:utf-8 -*-
+
+"""
+file: wapiti_train.py
+
+author: Yoann Dupont
+
+MIT License
+
+Copyright (c) 2018 Yoann Dupont
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import codecs, itertools, logging, multiprocessing, time, os
+
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+
+import sem.wapiti
+
+from sem.IO.columnIO               import Reader
+from sem.logger                    import default_handler, file_handler
+from sem.misc                      import file_digest
+from sem.modules.chunking_fscore   import chunk_counts, fscores
+
+wapiti_train_logger = logging.getLogger("sem.wapiti_train")
+wapiti_train_logger.addHandler(default_handler)
+
+def _write_sentences(sentences, filename, encoding):
+    """
+    Writes sentences in CoNLL format. The file is written under a temporary
+    name first, so that an interrupted run never leaves a partial fold.
+    """
+    temporary = filename + ".tmp"
+    with codecs.open(temporary, "w", encoding) as output_stream:
+        for sentence in sentences:
+            for token in sentence:
+                output_stream.write(u"\t".join(token))
+                output_stream.write(u"\n")
+            output_stream.write(u"\n")
+    os.rename(temporary, filename)
+
+def make_folds(infile, k, cache_dir, encoding="utf-8"):
+    """
+    Splits the sentences of infile in k folds, sentence i belonging to fold
+    i mod k. Returns, for every fold, the train file (the other folds), the
+    test file (the fold without its last column) and the labels of the fold.
+
+    Fold files are named after the digest of infile and kept in cache_dir:
+    they are only written if infile changed since the last run.
+    """
+    if k < 2:
+        raise ValueError(u"cross-validation requires at least 2 folds, got %i" %k)
+    sentences = [sentence[:] for sentence in Reader(infile, encoding)]
+    if len(sentences) < k:
+        raise ValueError(u"cannot split %i sentences in %i folds" %(len(sentences), k))
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    prefix = os.path.join(cache_dir, u"%s.%s.k%i" %(os.path.basename(infile), file_digest(infile)[:16], k))
+    folds = []
+    for i in range(k):
+        train_file = u"%s.%i.train" %(prefix, i)
+        test_file = u"%s.%i.test" %(prefix, i)
+        test = sentences[i::k]
+        if os.path.exists(train_file) and os.path.exists(test_file):
+            wapiti_train_logger.debug(u'using cached fold "%s"', train_file)
+        else:
+            wapiti_train_logger.info(u'writing fold %i/%i', i+1, k)
+            _write_sentences([sentence for j, sentence in enumerate(sentences) if j % k != i], train_file, encoding)
+            _write_sentences([[token[:-1] for token in sentence] for sentence in test], test_file, encoding)
+        folds.append((train_file, test_file, [[token[-1] for token in sentence] for sentence in test]))
+    return folds
+
+def configurations(algorithms, rho1s, rho2s):
+    """
+    Returns the grid of (algorithm, rho1, rho2) configurations.
+    """
+    return list(itertools.product(algorithms, rho1s, rho2s))
+
+def _run_job(job):
+    """
+    Trains a model on a fold with a configuration and labels the test part
+    of the fold. Returns the reference and predicted labels of every token.
+    """
+    (algorithm, rho1, rho2), index, (train_file, test_file, reference), pattern, work_dir, nthreads, maxiter, encoding = job
+    name = os.path.join(work_dir, u"%s-%s-%s.fold%i" %(algorithm, rho1, rho2, index))
+    with open(name + u".log", "w") as log:
+        sem.wapiti.train(train_file, pattern=pattern, output=name + u".model", algorithm=algorithm, nthreads=nthreads, maxiter=maxiter, rho1=rho1, rho2=rho2, stderr=log)
+        sem.wapiti.label(test_file, name + u".model", output=name + u".labels", only_labels=True, stderr=log)
+    guessed = [[token[0] for token in sentence] for sentence in Reader(name + u".labels", encoding)]
+    return [[[gold, guess] for gold, guess in zip(gold_sentence, guess_sentence)] for gold_sentence, guess_sentence in zip(reference, guessed)]
+
+def cross_validate(infile, pattern, algorithms=(u"l-bfgs",), rho1s=(0.5,), rho2s=(0.0001,), k=5, work_dir=u"wapiti_train", cache_dir=None, nthreads=1, jobs=None, maxiter=None, encoding="utf-8", log_level=logging.WARNING, log_file=None):
+    """
+    Evaluates every (algorithm, rho1, rho2) configuration of a grid with
+    k-fold cross-validation of Wapiti models on a CoNLL file, the last
+    column of which holds the labels (in BIO format).
+
+    Jobs (a configuration on a fold) run in parallel, each one running
+    Wapiti with nthreads threads. By default, there are as many jobs at
+    the same time as there are CPUs for nthreads threads each.
+
+    Parameters
+    ----------
+    infile : str
+        the CoNLL file to cross-validate on.
+    pattern : str
+        the Wapiti pattern file.
+    algorithms : list of str
+        the Wapiti training algorithms to try.
+    rho1s : list of float
+        the L1 penalties to try.
+    rho2s : list of float
+        the L2 penalties to try.
+    k : int
+        the number of folds.
+    work_dir : str
+        where models, labels and logs of every job are written.
+    cache_dir : str
+        where fold files are kept, work_dir/folds by default.
+    nthreads : int
+        the number of threads of every Wapiti process.
+    jobs : int
+        the maximum number of jobs at the same time.
+    maxiter : int
+        the maximum number of iterations of Wapiti, if not None.
+    encoding : str
+        the encoding of infile.
+    log_level : str or int
+        the logging level.
+    log_file : str
+        if not None, the file to log to (does not remove command-line
+        logging).
+
+    Returns
+    -------
+    report : list of dict
+        the algorithm, rho1, rho2, chunk precision, recall and f-measure
+        (micro-averaged over folds), the f-measure of every fold and the
+        token accuracy of every configuration, the best configuration
+        first.
+    """
+
+    start = time.time()
+
+    if log_file is not None:
+        wapiti_train_logger.addHandler(file_handler(log_file))
+    wapiti_train_logger.setLevel(log_level)
+
+    nthreads = max(1, int(nthreads))
+    if jobs is None:
+        jobs = max(1, multiprocessing.cpu_count() // nthreads)
+    if cache_dir is None:
+        cache_dir = os.path.join(work_dir, u"folds")
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+
+    folds = make_folds(infile, k, cache_dir, encoding=encoding)
+    grid = configurations(algorithms, rho1s, rho2s)
+    job_list = [(configuration, index, fold, pattern, work_dir, nthreads, maxiter, encoding) for configuration in grid for index, fold in enumerate(folds)]
+    wapiti_train_logger.info(u"running %i jobs (%i configurations, %i folds), %i at a time with %i thread(s) each", len(job_list), len(grid), k, jobs, nthreads)
+
+    # jobs are Wapiti processes, threads are enough to wait for them.
+    pool = ThreadPool(jobs)
+    try:
+        results = pool.map(_run_job, job_list, chunksize=1)
+    finally:
+        pool.close()
+
+    report = []
+    for index, (algorithm, rho1, rho2) in enumerate(grid):
+        fold_results = results[index * k : (index + 1) * k]
+        sentences = [sentence for result in fold_results for sentence in result]
+        prf = fscores(chunk_counts(sentences, reference_column=0, tagging_column=1))[u""]
+        tokens = [token for sentence in sentences for token in sentence]
+        report.append({
+            u"algorithm": algorithm, u"rho1": rho1, u"rho2": rho2,
+            u"p": prf[u"p"], u"r": prf[u"r"], u"f": prf[u"f"],
+            u"folds": [fscores(chunk_counts(result, reference_column=0, tagging_column=1))[u""][u"f"] for result in fold_results],
+            u"accuracy": 100.0 * sum(1 for gold, guess in tokens if gold == guess) / max(len(tokens), 1)
+        })
+    report.sort(key=lambda entry: -entry[u"f"])
+
+    laps = time.time() - start
+    wapiti_train_logger.info("done in %s", timedelta(seconds=laps))
+
+    return report
+
+def main(args):
+    report = cross_validate(args.infile, args.pattern,
+                            algorithms=args.algorithms,
+                            rho1s=args.rho1s,
+                            rho2s=args.rho2s,
+                            k=args.folds,
+                            work_dir=args.work_dir,
+                            cache_dir=args.cache_dir,
+                            nthreads=args.nthreads,
+                            jobs=args.jobs,
+                            maxiter=args.maxiter,
+                            encoding=args.enc,
+                            log_level=args.log_level, log_file=args.log_file)
+
+    print "algorithm\trho1\trho2\tprecision\trecall\tf-measure\tfolds\taccuracy"
+    for entry in report:
+        print u"%s\t%s\t%s\t%.2f\t%.2f\t%.2f\t%s\t%.2f" %(entry[u"algorithm"], entry[u"rho1"], entry[u"rho2"], entry[u"p"], entry[u"r"], entry[u"f"], u",".join(u"%.2f" %f for f in entry[u"folds"]), entry[u"accuracy"])
+
+    if args.output is not None:
+        best = report[0]
+        wapiti_train_logger.info(u'training "%s" on the whole file with %s, rho1=%s, rho2=%s', args.output, best[u"algorithm"], best[u"rho1"], best[u"rho2"])
+        sem.wapiti.train(args.infile, pattern=args.pattern, output=args.output, algorithm=best[u"algorithm"], nthreads=args.nthreads, maxiter=args.maxiter, rho1=best[u"rho1"], rho2=best[u"rho2"])
+
+
+
+import sem
+
+_subparsers = sem.argument_subparsers
+
+parser = _subparsers.add_parser(os.path.splitext(os.path.basename(__file__))[0], description="Cross-validates Wapiti models on a grid of training algorithms and L1/L2 penalties, training them in parallel. Reports chunk f-measures for every configuration.")
+
+parser.add_argument("infile",
+                    help="The training file (CoNLL format, labels in the last column)")
+parser.add_argument("pattern",
+                    help="The Wapiti pattern file")
+parser.add_argument("-a", "--algorithms", dest="algorithms", nargs="+", default=[u"l-bfgs"],
+                    help="The training algorithms to try (default: %(default)s)")
+parser.add_argument("-1", "--rho1", dest="rho1s", nargs="+", type=float, default=[0.5],
+                    help="The L1 penalties to try (default: %(default)s)")
+parser.add_argument("-2", "--rho2", dest="rho2s", nargs="+", type=float, default=[0.0001],
+                    help="The L2 penalties to try (default: %(default)s)")
+parser.add_argument("-k", "--folds", dest="folds", type=int, default=5,
+                    help="The number of folds (default: %(default)s)")
+parser.add_argument("-w", "--work-dir", dest="work_dir", default=u"wapiti_train",
+                    help="The directory for models, labels and logs (default: %(default)s)")
+parser.add_argument("--cache-dir", dest="cache_dir",
+                    help="The directory where fold files are kept (default: WORK_DIR/folds)")
+parser.add_argument("-t", "--threads", dest="nthreads", type=int, default=1,
+                    help="The number of threads of every Wapiti process (default: %(default)s)")
+parser.add_argument("-j", "--jobs", dest="jobs", type=int,
+                    help="The maximum number of Wapiti processes at the same time (default: number of CPUs / threads)")
+parser.add_argument("-i", "--maxiter", dest="maxiter", type=int,
+                    help="The maximum number of training iterations")
+parser.add_argument("-o", "--output", dest="output",
+                    help="If given, train the best configuration on the whole file and write the model there")
+parser.add_argument("--encoding", dest="enc", default="UTF-8",
+                    help="Encoding of the input file (default: %(default)s)")
+parser.add_argument("-l", "--log", dest="log_level", choices=("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"), default="WARNING",
+                    help="Increase log level (default: %(default)s)")
+parser.add_argument("--log-file", dest="log_file",
+                    help="The name of the log file")
@@ -79,6 +79,13 @@ class Span(object):
     def ub(self, ub):
         self._ub = max(ub, self._lb)
     
+    def shift(self, offset):
+        """
+        Moves the span by offset.
+        """
+        self._lb += offset
+        self._ub += offset
+    
     def toXML(self):
         return '<span s="%i" l="%s" />' %(self._lb, len(self))
     
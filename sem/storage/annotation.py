@@ -34,11 +34,16 @@ SOFTWARE.
 from sem.span import Span
 
 class Tag(Span):
-    def __init__(self, lb, ub, value, length=-1):
+    def __init__(self, lb, ub, value, length=-1, confidence=None):
+        """
+        confidence is the probability of the tag according to the model
+        that predicted it, None if unknown.
+        """
         super(Tag, self).__init__(lb, ub, length=length)
         self._value = value
         self.levels = value.strip(u".").split(u".")
         self.ids = {}
+        self.confidence = confidence
     
     @property
     def value(self):
@@ -182,7 +182,10 @@ class Document(Holder):
                         value = tag.attrib.get(u"value",tag.attrib[u"v"])
                         if not load_subtypes:
                             value = value.strip(type_separator).split(type_separator)[0]
-                        tags.append(Tag(lb=int(tag.attrib.get("start", tag.attrib["s"])), ub=0, length=int(tag.attrib.get("length", tag.attrib["l"])), value=value))
+                        confidence = tag.attrib.get("confidence", tag.attrib.get("c", None))
+                        if confidence is not None:
+                            confidence = float(confidence)
+                        tags.append(Tag(lb=int(tag.attrib.get("start", tag.attrib["s"])), ub=0, length=int(tag.attrib.get("length", tag.attrib["l"])), value=value, confidence=confidence))
                     reference = annotation.get(u"reference", None)
                     if reference:
                         reference = document.segmentation(reference)
@@ -253,6 +256,58 @@ class Document(Holder):
     def annotation(self, name):
         return self._annotations.get(name, None)
     
+    def append(self, document):
+        """
+        Appends document, which follows this one in the same text (eg: the
+        next chunk of a file read in chunks): its content, segmentations,
+        annotations and corpus are added to this document's, their offsets
+        being shifted accordingly. The spans of document are moved, so it
+        should not be used afterwards.
+        """
+        # the offset of a segmentation or annotation is the length of what
+        # it refers to: characters or another segmentation.
+        def length(reference):
+            if reference is None:
+                return len(self._content or u"")
+            segmentation = self.segmentation(getattr(reference, "name", reference))
+            return (len(segmentation.spans or []) if segmentation is not None else 0)
+        
+        shifts = {}
+        for name, segmentation in document.segmentations.items():
+            shifts[name] = length(segmentation.reference)
+        annotation_shifts = {}
+        for name, annotation in document.annotations.items():
+            annotation_shifts[name] = length(annotation.reference)
+        
+        for name, segmentation in document.segmentations.items():
+            for span in segmentation.spans or []:
+                span.shift(shifts[name])
+            current = self.segmentation(name)
+            if current is None:
+                reference = segmentation.reference
+                if reference is not None:
+                    reference = self.segmentation(getattr(reference, "name", reference))
+                self.add_segmentation(Segmentation(name, reference=reference, spans=list(segmentation.spans or [])))
+            else:
+                current.spans.extend(segmentation.spans or [])
+        for name, annotation in document.annotations.items():
+            for tag in annotation:
+                tag.shift(annotation_shifts[name])
+            current = self.annotation(name)
+            if current is None:
+                reference = annotation.reference
+                if reference is not None:
+                    reference = self.segmentation(getattr(reference, "name", reference))
+                self.add_annotation(Annotation(name, reference=reference, annotations=list(annotation)))
+            else:
+                current.annotations.extend(annotation)
+        
+        self._content = (self._content or u"") + (document.content or u"")
+        if len(self._corpus.fields) == 0:
+            self._corpus.fields = document.corpus.fields[:]
+        for sentence in document.corpus.sentences:
+            self._corpus.append_sentence(sentence)
+    
     def add_metadata(self, key, value):
         self._metadatas[key] = value
     
@@ -269,6 +324,8 @@ class Document(Holder):
         depth += 1
         f.write(u'%s<metadata' %(depth*indent*" "))
         for metakey, metavalue in sorted(self._metadatas.items()):
+            if isinstance(metavalue, (list, tuple, dict)): # structured metadata (n-best taggings, ...) is not written
+                continue
             f.write(u' %s="%s"' %(metakey, metavalue))
         f.write(u' />\n')
         f.write(u'%s<content>%s</content>\n' %(depth*indent*" ", cgi.escape(self.content)))
@@ -301,7 +358,8 @@ class Document(Holder):
                 f.write(u'%s<annotation name="%s"%s>\n' %(depth*indent*" ", annotation.name, reference))
                 depth += 1
                 for tag in annotation:
-                    f.write(u'%s<tag v="%s" s="%i" l="%i"/>\n' %(depth*indent*" ", tag.getValue(), tag.lb, len(tag)))
+                    confidence = (u' c="%.6g"' %tag.confidence if tag.confidence is not None else u"")
+                    f.write(u'%s<tag v="%s" s="%i" l="%i"%s/>\n' %(depth*indent*" ", tag.getValue(), tag.lb, len(tag), confidence))
                 depth -= 1
                 f.write(u'%s</annotation>\n' %(depth*indent*" "))
                 depth -= 1
@@ -0,0 +1,565 @@
+#-*- encoding: utf-8 -*-
+
+"""
+file: test_crf.py
+
+author: Yoann Dupont
+
+MIT License
+
+Copyright (c) 2018 Yoann Dupont
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import unittest
+import itertools
+import math
+import os.path
+import random
+import shutil
+import tarfile
+import tempfile
+
+from sem.CRF.model import Model, available_backends
+from sem.CRF.binary import is_binary_model
+from sem.CRF.observations import HashedObservations, observation_hash
+from sem.CRF.constraints import Constraints, guess_scheme
+from sem.CRF.lexicon import Lexicon
+import sem.CRF.binary
+from sem.CRF.template import ListPattern, CompiledTemplates, read_patterns
+import sem.CRF.trainer
+from sem.CRF.registry import ModelRegistry
+from sem.CRF.cache import DecodeCache
+from sem.misc import check_model_available
+
+WORDS = [u"Jean", u"Dupont", u"est", u"allé", u"à", u"Paris", u"hier", u"."]
+TAGS = [u"O", u"B-Person", u"I-Person", u"B-Location", u"I-Location"]
+TEMPLATES = [u"u:word=%x[0,0]", u"u:prev=%x[-1,0]", u"u:next=%x[1,0]", u"b", u"b:word=%x[0,0]"]
+
+def toy_model(seed=0):
+    """
+    Returns a small random model with both unigram and bigram features.
+    """
+    rand = random.Random(seed)
+    model = Model()
+    for tag in TAGS:
+        model.tagset.add(tag)
+    model._templates = [ListPattern.from_string(template) for template in TEMPLATES]
+    observations = []
+    for template in TEMPLATES:
+        if u"%x" not in template:
+            observations.append(template)
+            continue
+        for word in WORDS + [u"_x-1", u"_x+1"]:
+            observations.append(template.split(u"%")[0] + word)
+    Y = len(TAGS)
+    weights = []
+    for obs in observations:
+        model.observations.add(obs)
+        size = (Y if obs[0] == u"u" else Y*Y)
+        model.uoff.append(len(weights) if obs[0] == u"u" else -1)
+        model.boff.append(len(weights) if obs[0] == u"b" else -1)
+        weights.extend([round(rand.gauss(0.0, 1.0), 3) for _ in range(size)])
+    model._weights = weights
+    return model
+
+def toy_sentences():
+    return [
+        [[u"Jean"], [u"Dupont"], [u"est"], [u"allé"], [u"à"], [u"Paris"], [u"hier"], [u"."]],
+        [[u"Paris"], [u"."]],
+        [[u"hier"]],
+        [[u"Dupont"], [u"inconnu"], [u"Jean"]],
+    ]
+
+class TestModel(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_backends(self):
+        model = toy_model()
+        for backend in available_backends():
+            model.backend = backend
+            self.assertEquals(model.backend, backend)
+            self.assertEquals(model.tag_viterbi([]), ([], [], 0.0))
+        self.assertRaises(ValueError, setattr, model, "backend", u"unknown")
+
+    @unittest.skipIf("numpy" not in available_backends(), "numpy is not installed")
+    def test_numpy_viterbi(self):
+        model = toy_model()
+        for sentence in toy_sentences():
+            model.backend = u"python"
+            expected = model.tag_viterbi(sentence)
+            model.backend = u"numpy"
+            self.assertEquals(model.tag_viterbi(sentence), expected)
+
+    def test_tag_batch(self):
+        model = toy_model()
+        sentences = toy_sentences() * 3
+        for backend in available_backends():
+            model.backend = backend
+            expected = [model.tag_viterbi(sentence) for sentence in sentences]
+            self.assertEquals(model.tag_batch(sentences), expected)
+            self.assertEquals(model.tag_batch(sentences, batch_size=2, bucket_width=1), expected)
+
+    def test_beam(self):
+        model = toy_model()
+        sentences = toy_sentences()
+        for backend in available_backends():
+            model.backend = backend
+            expected = [model.tag_viterbi(sentence) for sentence in sentences]
+            self.assertEquals([model.tag_beam(sentence, len(TAGS)) for sentence in sentences], expected)
+            for sentence, (_, _, score) in zip(sentences, expected):
+                tags, _, beam_score = model.tag_beam(sentence, 1)
+                self.assertEquals(len(tags), len(sentence))
+                self.assertTrue(beam_score <= score)
+
+    def test_nbest(self):
+        model = toy_model()
+        sentences = [sentence for sentence in toy_sentences() if len(sentence) <= 3]
+        for constrained in (False, True):
+            model.constrain(u"scheme" if constrained else None)
+            for sentence in sentences:
+                # scores of every possible tagging
+                psi = model._psi_python(sentence, model._states(None, len(sentence)))
+                scores = []
+                for path in itertools.product(range(len(TAGS)), repeat=len(sentence)):
+                    tags = [model.tagset.decode(y) for y in path]
+                    if not constrained or model.constraints.is_valid(tags):
+                        scores.append(psi[0][0][path[0]] + sum(psi[t][path[t-1]][path[t]] for t in range(1, len(path))))
+                scores.sort(reverse=True)
+                
+                expected = None
+                for backend in available_backends():
+                    model.backend = backend
+                    nbest = model.tag_nbest(sentence, 4)
+                    self.assertEquals(nbest[0], model.tag_viterbi(sentence))
+                    self.assertEquals(len(set(tuple(tags) for tags, _, _ in nbest)), min(4, len(scores)))
+                    for (_, _, score), best in zip(nbest, scores):
+                        self.assertAlmostEquals(score, best)
+                    self.assertTrue(expected is None or nbest == expected)
+                    expected = nbest
+        self.assertEquals(len(model.tag_nbest(sentences[-1], 10**4)), len(scores))
+
+    def test_forward_backward(self):
+        model = toy_model()
+        sentences = [sentence for sentence in toy_sentences() if len(sentence) <= 3]
+        for constrained in (False, True):
+            model.constrain(u"scheme" if constrained else None)
+            for sentence in sentences:
+                # probability of every possible tagging
+                psi = model._psi_python(sentence, model._states(None, len(sentence)))
+                taggings = []
+                for path in itertools.product(range(len(TAGS)), repeat=len(sentence)):
+                    tags = [model.tagset.decode(y) for y in path]
+                    if not constrained or model.constraints.is_valid(tags):
+                        taggings.append((tags, math.exp(psi[0][0][path[0]] + sum(psi[t][path[t-1]][path[t]] for t in range(1, len(path))))))
+                z = sum(score for _, score in taggings)
+                
+                for backend in available_backends():
+                    model.backend = backend
+                    marginals = model.marginals(sentence)
+                    for t in range(len(sentence)):
+                        for y, tag in enumerate(TAGS):
+                            expected = sum(score for tags, score in taggings if tags[t] == tag) / z
+                            self.assertAlmostEquals(marginals[t][model.tagset.encode(tag)], expected)
+                    tags, _, _ = model.tag_viterbi(sentence)
+                    spans = [(0, len(sentence)), (0, 1), (len(sentence)-1, len(sentence))]
+                    expected = [sum(score for other, score in taggings if other[lb : ub] == tags[lb : ub]) / z for lb, ub in spans]
+                    for probability, value in zip(model.span_probabilities(sentence, tags, spans), expected):
+                        self.assertAlmostEquals(probability, value)
+
+    def test_compact(self):
+        model = toy_model()
+        sentences = toy_sentences()
+        expected = [model.tag_viterbi(sentence) for sentence in sentences]
+        size = model.nbytes
+        
+        model.compact()
+        self.assertTrue(model.nbytes < size)
+        self.assertEquals([model.tag_viterbi(sentence)[0] for sentence in sentences], [tags for tags, _, _ in expected])
+        for sentence, (_, _, score) in zip(sentences, expected):
+            self.assertAlmostEquals(model.tag_viterbi(sentence)[2], score)
+        
+        model.compact(u"float32")
+        self.assertEquals([model.tag_batch(sentences)[i][0] for i in range(len(sentences))], [tags for tags, _, _ in expected])
+        self.assertRaises(ValueError, model.compact, u"int16")
+
+    def test_prune(self):
+        model = toy_model()
+        sentences = toy_sentences()
+        n_observations = len(model.observations)
+        for obs in (u"u:word=Paris", u"b:word=hier"):
+            o = model.observations.encode(obs)
+            off = (model.uoff[o] if obs[0] == u"u" else model.boff[o])
+            for i in range(len(TAGS) if obs[0] == u"u" else len(TAGS)**2):
+                model.weights[off+i] = 0.0
+        expected = [model.tag_viterbi(sentence) for sentence in sentences]
+        
+        self.assertEquals(model.prune(), 2)
+        self.assertEquals(len(model.observations), n_observations-2)
+        self.assertEquals(model.observations.encode(u"u:word=Paris"), -1)
+        self.assertEquals([model.tag_viterbi(sentence) for sentence in sentences], expected)
+        
+        self.assertTrue(model.prune(10.0) > 0)
+        self.assertEquals(len(model.observations), 0)
+        self.assertEquals(len(model.weights), 0)
+
+    @unittest.skipIf("numpy" not in available_backends(), "numpy is not installed")
+    def test_quantize(self):
+        sentences = toy_sentences()
+        reference = toy_model()
+        expected = [reference.tag_viterbi(sentence) for sentence in sentences]
+        for dtype in (u"float16", u"int8"):
+            model = toy_model()
+            model.quantize(dtype, block_size=8)
+            self.assertTrue(model.nbytes < reference.nbytes)
+            for backend in available_backends():
+                model.backend = backend
+                for (tags, _, score), (_, _, expected_score) in zip(model.tag_batch(sentences), expected):
+                    self.assertEquals(len(tags), len(_))
+                    self.assertAlmostEquals(score, expected_score, delta=0.1*len(tags))
+            filename = os.path.join(self.tmpdir, "model.bin")
+            model.write_binary(filename)
+            self.assertEquals(list(Model.load(filename).weights), list(model.weights))
+        self.assertRaises(ValueError, model.quantize, u"int4")
+
+    @unittest.skipIf("numpy" not in available_backends(), "numpy is not installed")
+    def test_hashed_observations(self):
+        model = toy_model()
+        sentences = toy_sentences()
+        expected = [model.tag_viterbi(sentence) for sentence in sentences]
+        strings = list(model.observations)
+        
+        index = HashedObservations.from_strings(strings, keep_strings=False)
+        self.assertEquals([index.encode(obs) for obs in strings], range(len(strings)))
+        self.assertEquals(index.encode_many([u"u:word=unknown", strings[3]]), [-1, 3])
+        self.assertEquals(index.decode(3), None)
+        self.assertRaises(ValueError, index.keys)
+        
+        text = os.path.join(self.tmpdir, "model.txt")
+        model.write(text)
+        self.assertEquals([Model.load(text, observation_index=u"hashed").tag_viterbi(sentence) for sentence in sentences], expected)
+        
+        filename = os.path.join(self.tmpdir, "model.bin")
+        model.write_binary(filename)
+        loaded = Model.load(filename)
+        self.assertTrue(isinstance(loaded.observations, HashedObservations))
+        self.assertEquals([loaded.tag_viterbi(sentence) for sentence in sentences], expected)
+        self.assertEquals(list(loaded.observations), strings)
+        self.assertEquals(loaded.observations.decode(3), strings[3])
+        loaded = Model.load(filename, verify_hashes=True)
+        self.assertEquals(loaded.tag_batch(sentences), expected)
+        self.assertFalse(isinstance(Model.load(filename, observation_index=u"coder").observations, HashedObservations))
+        
+        # hashes are computed from template parts and cell values as they
+        # would be from observation strings.
+        compiled = model.compiled_templates()
+        for sentence in sentences:
+            self.assertEquals([hashes.tolist() for hashes in compiled.hashes(sentence)], [[observation_hash(obs) for obs in observations] for observations in compiled.instanciate(sentence)])
+        self.assertEquals(observation_hash(u"u:word=allé"), observation_hash(u"u:word=allé".encode("utf-8")))
+        self.assertEquals(observation_hash(u"u:word=allé"), 8674306411638977681) # the same everywhere
+
+    def assertSameModel(self, model1, model2):
+        self.assertEquals(list(model1.tagset), list(model2.tagset))
+        self.assertEquals([unicode(t) for t in model1.templates], [unicode(t) for t in model2.templates])
+        self.assertEquals(list(model1.observations), list(model2.observations))
+        self.assertEquals(list(model1.uoff), list(model2.uoff))
+        self.assertEquals(list(model1.boff), list(model2.boff))
+        self.assertEquals(list(model1.weights), list(model2.weights))
+
+    def test_write_read(self):
+        model = toy_model()
+        filename = os.path.join(self.tmpdir, "model.txt")
+        model.write(filename)
+        loaded = Model.from_wapiti_model(filename)
+        self.assertSameModel(loaded, model)
+        self.assertEquals([loaded.tag_viterbi(sentence) for sentence in toy_sentences()], [model.tag_viterbi(sentence) for sentence in toy_sentences()])
+
+    def test_binary(self):
+        model = toy_model()
+        filename = os.path.join(self.tmpdir, "model.bin")
+        model.write_binary(filename)
+        self.assertTrue(is_binary_model(filename))
+        loaded = Model.load(filename)
+        self.assertSameModel(loaded, model)
+        self.assertEquals([loaded.tag_viterbi(sentence) for sentence in toy_sentences()], [model.tag_viterbi(sentence) for sentence in toy_sentences()])
+        
+        # back to Wapiti format
+        text = os.path.join(self.tmpdir, "model.txt")
+        loaded.write(text)
+        self.assertFalse(is_binary_model(text))
+        self.assertSameModel(Model.load(text), model)
+        
+        model.compact(u"float32")
+        model.write_binary(filename)
+        self.assertEquals(list(Model.from_binary(filename).weights), list(model.weights))
+
+    def test_compile_shipped_model(self):
+        from sem import SEM_RESOURCE_DIR
+        from sem.modules.compile_model import compile_model
+        
+        # observations of French models are not all valid utf-8 (some are
+        # cut in the middle of a character), they are kept as bytes.
+        archive = os.path.join(SEM_RESOURCE_DIR, "models", "fr", "POS", "plain.tar.gz")
+        filename = os.path.join(self.tmpdir, "plain.bin")
+        compile_model(archive, filename)
+        model = Model.load(archive, encoding=None)
+        loaded = Model.load(filename)
+        self.assertSameModel(loaded, model)
+        self.assertTrue(any(isinstance(obs, str) and not all(ord(c) < 128 for c in obs) for obs in loaded.observations))
+        columns = max(pattern.y for template in model.templates for pattern in template.patterns if hasattr(pattern, "y")) + 1
+        sentence = [[word] * columns for word in u"Le chat est sur la table .".split()]
+        self.assertEquals(loaded.tag_viterbi(sentence), model.tag_viterbi(sentence))
+        
+        text = os.path.join(self.tmpdir, "plain.txt")
+        compile_model(filename, text, to_text=True)
+        self.assertSameModel(Model.load(text, encoding=None), model)
+    
+    def test_decode_cache(self):
+        model = toy_model()
+        sentences = toy_sentences()
+        expected = model.tag_batch(sentences)
+        for backend in available_backends():
+            model.backend = backend
+            model.decode_cache = DecodeCache(max_entries=2)
+            self.assertEquals(model.tag_batch(sentences + sentences), expected + expected)
+            stats = model.decode_cache.stats()
+            self.assertEquals((stats[u"hits"] + stats[u"misses"], stats[u"entries"]), (2 * len(sentences), 2))
+            self.assertEquals([model.tag_viterbi(sentence) for sentence in sentences[-2:]], expected[-2:])
+            self.assertEquals(model.decode_cache.stats()[u"hits"], stats[u"hits"] + 2)
+            model.decode_cache = None
+        
+        # constraints change the fingerprint of the model
+        fingerprint = model.fingerprint()
+        view = model.view()
+        view.constrain()
+        self.assertEquals(model.fingerprint(), fingerprint)
+        self.assertNotEquals(view.fingerprint(), fingerprint)
+        
+        cache = DecodeCache(max_entries=None, max_bytes=1)
+        model.decode_cache = cache
+        self.assertEquals(model.tag_viterbi(sentences[0]), expected[0])
+        self.assertEquals((len(cache), cache.stats()[u"bytes"]), (0, 0))
+
+    @unittest.skipIf("numpy" not in available_backends(), "numpy is not installed")
+    def test_trainer(self):
+        reference = toy_model()
+        sentences = [[token + [tag] for token, tag in zip(sentence, reference.tag_viterbi(sentence)[0])] for sentence in toy_sentences()]
+        patterns = os.path.join(self.tmpdir, "patterns.txt")
+        with open(patterns, "w") as output_stream:
+            output_stream.write("# comment\n\n" + "\n".join(TEMPLATES) + "\n")
+        templates = read_patterns(patterns)
+        self.assertEquals([unicode(template) for template in templates], TEMPLATES)
+        
+        model = sem.CRF.trainer.train(sentences, templates, rho1=0.0, rho2=0.01, maxiter=50)
+        self.assertEquals(list(model.tagset), sorted(model.tagset, key=[token[-1] for sentence in sentences for token in sentence].index))
+        for sentence in sentences:
+            self.assertEquals(model.tag_viterbi([token[:-1] for token in sentence])[0], [token[-1] for token in sentence])
+        filename = os.path.join(self.tmpdir, "trained.txt")
+        model.write(filename)
+        self.assertSameModel(Model.load(filename), model)
+        
+        # shards computed by other processes give the same gradient
+        sharded = sem.CRF.trainer.train(sentences, templates, rho1=0.5, rho2=0.01, maxiter=5, jobs=2)
+        single = sem.CRF.trainer.train(sentences, templates, rho1=0.5, rho2=0.01, maxiter=5)
+        for w1, w2 in zip(sharded.weights, single.weights):
+            self.assertAlmostEquals(w1, w2)
+        self.assertTrue(0.0 in list(single.weights))
+
+    def test_archive(self):
+        model = toy_model()
+        cache = os.path.join(self.tmpdir, "cache")
+        for write in (model.write, model.write_binary):
+            filename = os.path.join(self.tmpdir, "model")
+            write(filename)
+            with tarfile.open(filename + ".tar.gz", "w:gz") as tar:
+                tar.add(filename, arcname="model")
+            os.remove(filename)
+            self.assertSameModel(Model.load(filename + ".tar.gz"), model)
+            
+            extracted = check_model_available(filename, cache_dir=cache)
+            self.assertEquals(os.path.dirname(os.path.dirname(extracted)), cache)
+            self.assertFalse(os.path.exists(filename))
+            self.assertSameModel(Model.load(extracted), model)
+            self.assertEquals(check_model_available(filename, cache_dir=cache), extracted)
+        self.assertEquals(len([name for name in os.listdir(cache) if not name.endswith(".lock")]), 2)
+        self.assertRaises(IOError, check_model_available, os.path.join(self.tmpdir, "missing"), cache_dir=cache)
+
+    def test_candidates(self):
+        model = toy_model()
+        sentences = toy_sentences()
+        lexicon = Lexicon({u"jean": [u"B-Person"], u"Paris": [u"B-Location", u"I-Location", u"B-Unknown"], u".": [u"O"]})
+        candidates = [lexicon.sentence_candidates([token[0] for token in sentence]) for sentence in sentences]
+        self.assertEquals(candidates[0][:3], [set([u"B-Person"]), None, None])
+        
+        unconstrained = model.tag_batch(sentences)
+        self.assertEquals(model.tag_batch(sentences, candidates=[None]*len(sentences)), unconstrained)
+        expected = None
+        for backend in available_backends():
+            model.backend = backend
+            results = [model.tag_viterbi(sentence, candidates=cands) for sentence, cands in zip(sentences, candidates)]
+            self.assertEquals(model.tag_batch(sentences, candidates=candidates), results)
+            for (tags, _, score), (_, _, best), cands in zip(results, unconstrained, candidates):
+                self.assertTrue(score <= best)
+                for tag, labels in zip(tags, cands):
+                    self.assertTrue(labels is None or tag in labels)
+            self.assertTrue(expected is None or results == expected)
+            expected = results
+        
+        model.constrain()
+        for backend in available_backends():
+            model.backend = backend
+            for tags, _, _ in model.tag_batch(sentences, candidates=candidates):
+                self.assertTrue(model.constraints.is_valid(tags))
+
+    def test_registry(self):
+        filename = os.path.join(self.tmpdir, "model.txt")
+        toy_model().write(filename)
+        models = ModelRegistry()
+        model = models.acquire(filename)
+        self.assertTrue(models.acquire(filename) is model)
+        stats = models.stats()
+        self.assertEquals((stats[u"hits"], stats[u"misses"], stats[u"in_use"]), (1, 1, 1))
+        self.assertTrue(stats[u"resident"] > 0)
+
+        unconstrained = model.tag_batch(toy_sentences())
+        view = model.view()
+        view.constrain()
+        self.assertTrue(model.constraints is None)
+        for tags, _, _ in view.tag_batch(toy_sentences()):
+            self.assertTrue(view.constraints.is_valid(tags))
+        self.assertEquals(model.tag_batch(toy_sentences()), unconstrained)
+
+        # a modified file is loaded again, the old model is dropped once released
+        os.utime(filename, (0, 0))
+        reloaded = models.acquire(filename)
+        self.assertFalse(reloaded is model)
+        models.release(model)
+        models.release(model)
+        self.assertRaises(ValueError, models.release, model)
+        self.assertEquals(models.stats()[u"invalidations"], 1)
+        self.assertEquals(models.stats()[u"models"], 1)
+
+        # models in use are never evicted
+        models.budget = 0
+        self.assertEquals(models.stats()[u"models"], 1)
+        models.release(reloaded)
+        stats = models.stats()
+        self.assertEquals((stats[u"models"], stats[u"evictions"], stats[u"resident"]), (0, 1, 0))
+
+
+class TestTemplates(unittest.TestCase):
+    def test_compiled(self):
+        templates = [ListPattern.from_string(template) for template in TEMPLATES + [
+            u"u:low=%X[0,0]/%x[-6,1]", u"u:upper=%t[0,0,\"^\\u\"]", u"u:suffix=%M[1,0,\"..?$\"]", u"*:50%%x[2,1]"]]
+        compiled = CompiledTemplates(templates)
+        sentence = [[u"Jean", u"NPP"], [u"DUPONT", u"NPP"], [u"Paris", u"NPP"]]
+        expected = [[template.instanciate(sentence, t) for t in range(len(sentence))] for template in templates]
+        self.assertEquals(compiled.instanciate(sentence), expected)
+        self.assertEquals(compiled.instanciate(sentence), expected) # cached %t and %m
+        self.assertEquals(compiled.kinds, [u"u", u"u", u"u", u"b", u"b", u"u", u"u", u"u", u"*"])
+        self.assertEquals(expected[5], [u"u:low=jean/_x-#", u"u:low=dupont/_x-#", u"u:low=paris/_x-4"])
+        self.assertEquals(expected[7], [u"u:suffix=nt", u"u:suffix=is", u"u:suffix=+1"])
+        self.assertEquals(expected[8], [u"*:50%NPP", u"*:50%_x+1", u"*:50%_x+2"])
+        self.assertEquals(unicode(templates[5].patterns[1]), u"%X[0,0]")
+        self.assertEquals(compiled.instanciate([]), [[] for template in templates])
+
+
+class TestConstraints(unittest.TestCase):
+    def test_schemes(self):
+        self.assertEquals(guess_scheme(TAGS), u"BIO")
+        self.assertEquals(guess_scheme([u"O", u"B-PER", u"I-PER", u"E-PER", u"S-PER"]), u"BIOES")
+        self.assertEquals(guess_scheme([u"NPP", u"_NPP", u"DET"]), u"underscore")
+        self.assertEquals(guess_scheme([u"NPP", u"DET"]), None)
+        
+        bio = Constraints.from_scheme(TAGS)
+        self.assertTrue(bio.allowed(u"B-Person", u"I-Person"))
+        self.assertTrue(bio.allowed(u"I-Person", u"B-Location"))
+        self.assertFalse(bio.allowed(u"O", u"I-Person"))
+        self.assertFalse(bio.allowed(u"B-Location", u"I-Person"))
+        self.assertTrue(bio.is_valid([u"B-Person", u"I-Person", u"O"]))
+        self.assertFalse(bio.is_valid([u"I-Person", u"O"]))
+        
+        bioes = Constraints.from_scheme([u"O", u"B-PER", u"I-PER", u"E-PER", u"S-PER"])
+        self.assertFalse(bioes.allowed(u"B-PER", u"O"))
+        self.assertTrue(bioes.allowed(u"I-PER", u"E-PER"))
+        self.assertFalse(bioes.is_valid([u"O", u"B-PER"]))
+        
+        underscore = Constraints.from_scheme([u"NPP", u"_NPP", u"DET", u"_DET"])
+        self.assertTrue(underscore.allowed(u"_NPP", u"_NPP"))
+        self.assertFalse(underscore.allowed(u"DET", u"_NPP"))
+        self.assertFalse(underscore.is_valid([u"_DET"]))
+        
+        self.assertRaises(ValueError, Constraints.from_scheme, [u"NPP", u"DET"])
+
+    def test_constrained_viterbi(self):
+        model = toy_model()
+        sentences = toy_sentences()
+        unconstrained = model.tag_batch(sentences)
+        model.constrain()
+        for backend in available_backends():
+            model.backend = backend
+            results = [model.tag_viterbi(sentence) for sentence in sentences]
+            self.assertEquals(model.tag_batch(sentences), results)
+            for (tags, _, score), (_, _, best) in zip(results, unconstrained):
+                self.assertTrue(model.constraints.is_valid(tags))
+                self.assertTrue(score <= best)
+        model.constrain(None)
+        self.assertEquals(model.tag_batch(sentences), unconstrained)
+
+    def test_whitelist(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "transitions")
+            with open(filename, "w") as output_stream:
+                output_stream.write("^ O\nO O\nO B-Person\nB-Person I-Person\nI-Person O\nO $\n")
+            model = toy_model()
+            model.constrain(filename)
+            for backend in available_backends():
+                model.backend = backend
+                for tags, _, _ in model.tag_batch(toy_sentences()):
+                    self.assertTrue(set(tags) <= set([u"O", u"B-Person", u"I-Person"]))
+                    self.assertEquals(tags[0], u"O")
+                    self.assertEquals(tags[-1], u"O")
+        finally:
+            shutil.rmtree(tmpdir)
+    
+    def test_lexicon(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmpdir, "DET"), "w") as output_stream:
+                output_stream.write("le\nla\n")
+            with open(os.path.join(tmpdir, "PRO"), "w") as output_stream:
+                output_stream.write("le\n")
+            lexicon = Lexicon.from_directory(tmpdir)
+            self.assertEquals(len(lexicon), 2)
+            self.assertEquals(lexicon.candidates(u"Le"), set([u"DET", u"PRO"]))
+            self.assertEquals(lexicon.candidates(u"la", continuations=True), set([u"DET", u"_DET"]))
+            self.assertEquals(lexicon.sentence_candidates([u"La", u"maison"]), [set([u"DET"]), None])
+            self.assertFalse(u"maison" in lexicon)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -29,13 +29,16 @@ SOFTWARE.
 """
 
 import unittest
-import codecs, os.path
+import codecs, os.path, shutil, tempfile, threading, time
 
 from sem import SEM_DATA_DIR
 
 from sem.storage import Document, Corpus
+import sem.libwapiti
+import sem.misc
+import sem.wapiti
 
-from sem.modules import EnrichModule, CleanModule, WapitiLabelModule, LabelConsistencyModule
+from sem.modules import EnrichModule, CleanModule, WapitiLabelModule, LabelConsistencyModule, AnnotateModule
 
 from sem.information import Entry, Informations
 from sem.features import DictGetterFeature
@@ -157,6 +160,391 @@ class TestModules(unittest.TestCase):
         self.assertEquals(tags.count(u"O"), 13)
         self.assertEquals(tags.count(u"B-tag"), 2)
 
+    
+    def test_wapiti_pool(self):
+        model = os.path.join(SEM_DATA_DIR, "non-regression", "models", "model")
+        sentences = [[u"Ceci", u"est", u"un", u"test", u"."], [], [u"ceci", u"est", u"un", u"test"]]
+        documents = []
+        for pooled in (False, True):
+            document = Document("document", u"Ceci est un test.")
+            document._corpus = Corpus([u"word"], sentences=[[{u"word":word} for word in sentence] for sentence in sentences if sentence])
+            WapitiLabelModule(model, u"tag", pooled=pooled).process_document(document)
+            documents.append(document)
+        self.assertEquals(documents[0]._corpus.sentences, documents[1]._corpus.sentences)
+        expected = [[token[u"tag"] for token in sentence] for sentence in documents[0]._corpus.sentences]
+        expected.insert(1, [])
+        
+        pool = sem.wapiti.WorkerPool(model, size=2)
+        try:
+            self.assertEquals(pool.label_many([sentences, sentences[:1], sentences]), [expected, expected[:1], expected])
+            for worker in pool._workers:
+                worker._process.kill()
+                worker._process.wait()
+            self.assertRaises(RuntimeError, pool._workers[0].label, sentences)
+            self.assertEquals(pool.label_many([sentences, sentences]), [expected, expected])
+        finally:
+            pool.close()
+
+    
+    def test_wapiti_stream(self):
+        model = os.path.join(SEM_DATA_DIR, "non-regression", "models", "model")
+        sentences = [[u"Ceci", u"est", u"un", u"test", u"."], [], [u"ceci", u"est", u"un", u"test"]] * 50
+        expected = sem.wapiti.WorkerPool(model).label(sentences)
+        stream = sem.wapiti.label_stream(iter(sentences), model, buffer_size=4)
+        self.assertEquals([labels for _, labels in stream], expected)
+        
+        corpus = Corpus([u"word"], sentences=[[{u"word":word} for word in sentence] for sentence in sentences])
+        sem.wapiti.label_corpus(corpus, model, u"tag", "utf-8")
+        self.assertEquals([[token[u"tag"] for token in sentence] for sentence in corpus.sentences], expected)
+        
+        def failing():
+            yield sentences[0]
+            raise ValueError("invalid sentence")
+        self.assertRaises(ValueError, list, sem.wapiti.label_stream(failing(), model))
+        stream = sem.wapiti.label_stream(iter(sentences), model)
+        self.assertEquals(next(stream)[1], expected[0])
+        stream.close()
+    
+    def test_wapiti_shards(self):
+        model = os.path.join(SEM_DATA_DIR, "non-regression", "models", "model")
+        self.assertEquals(sem.misc.shard(range(10), 3), [[0, 1, 2, 3], [4, 5, 6], [7, 8, 9]])
+        self.assertEquals(sem.misc.shard(range(10), 3, min_size=6), [range(10)])
+        sentences = [[u"Ceci", u"est", u"un", u"test", u"."], [u"ceci", u"est", u"un", u"test"]] * 5
+        documents = []
+        for shards in (1, 3):
+            document = Document("document", u"Ceci est un test.")
+            document._corpus = Corpus([u"word"], sentences=[[{u"word":word} for word in sentence] for sentence in sentences])
+            WapitiLabelModule(model, u"tag", shards=shards, min_shard_size=1).process_document(document)
+            documents.append(document)
+        self.assertEquals(documents[0]._corpus.sentences, documents[1]._corpus.sentences)
+    
+    @unittest.skipIf(not sem.libwapiti.available(), "the Wapiti library is not built")
+    def test_libwapiti(self):
+        model = os.path.join(SEM_DATA_DIR, "non-regression", "models", "model")
+        sentences = [[u"Ceci", u"est", u"un", u"test", u"."], [], [[u"ceci"], [u"est"], [u"un"], [u"test"]]]
+        expected = sem.wapiti.WorkerPool(model).label([[u"".join(token) for token in sentence] for sentence in sentences])
+        library_model = sem.libwapiti.get_model(model)
+        self.assertTrue(library_model is sem.libwapiti.get_model(model))
+        self.assertEquals(library_model.label(sentences), expected)
+        self.assertRaises(RuntimeError, library_model.label, [[u""]]) # Wapiti error: missing tokens
+        self.assertEquals(library_model.label(sentences), expected)
+        
+        training = [[[u"u" + token, label] for token, label in zip(sentence, labels)] for sentence, labels in zip(sentences[:1], expected[:1])]
+        self.assertRaises(RuntimeError, sem.libwapiti.train, training, algorithm=u"unknown")
+        trained = sem.libwapiti.train(training * 10, maxiter=10)
+        self.assertEquals(trained.label([[[u"u" + token] for token in sentences[0]]]), expected[:1])
+    
+    def test_wapiti_train(self):
+        from sem.modules.chunking_fscore import chunk_counts, fscores
+        from sem.modules.wapiti_train import make_folds, cross_validate
+        
+        prf = fscores(chunk_counts([[[u"B-PER", u"B-PER"], [u"I-PER", u"O"], [u"B-LOC", u"B-LOC"]]], reference_column=0, tagging_column=1))
+        self.assertEquals((prf[u"LOC"][u"f"], prf[u"PER"][u"f"], prf[u""][u"p"]), (100.0, 0.0, 50.0))
+        
+        work_dir = tempfile.mkdtemp()
+        try:
+            corpus = os.path.join(work_dir, "corpus.conll")
+            pattern = os.path.join(work_dir, "pattern.txt")
+            with codecs.open(corpus, "w", "utf-8") as output_stream:
+                for sentence in [[(u"Jean", u"B-PER"), (u"vit", u"O"), (u"\xe0", u"O"), (u"Paris", u"B-LOC")], [(u"Paris", u"B-LOC"), (u"et", u"O"), (u"Jean", u"B-PER")]] * 6:
+                    output_stream.write(u"".join(u"%s\t%s\n" %token for token in sentence) + u"\n")
+            with codecs.open(pattern, "w", "utf-8") as output_stream:
+                output_stream.write(u"u:X=%x[0,0]\n")
+            
+            folds = make_folds(corpus, 3, os.path.join(work_dir, "folds"))
+            self.assertEquals(len(folds), 3)
+            self.assertEquals(folds[0][2], [[u"B-PER", u"O", u"O", u"B-LOC"], [u"B-LOC", u"O", u"B-PER"]] * 2)
+            mtime = os.path.getmtime(folds[0][0])
+            self.assertEquals(make_folds(corpus, 3, os.path.join(work_dir, "folds")), folds)
+            self.assertEquals(os.path.getmtime(folds[0][0]), mtime)
+            
+            report = cross_validate(corpus, pattern, rho1s=[0.0, 0.1], k=3, work_dir=work_dir, jobs=2)
+            self.assertEquals(sorted(entry[u"rho1"] for entry in report), [0.0, 0.1])
+            self.assertEquals(report[0][u"f"], 100.0)
+            self.assertEquals(len(report[0][u"folds"]), 3)
+        finally:
+            shutil.rmtree(work_dir)
+    
+    def test_tagger_batch(self):
+        from argparse import Namespace
+        from sem.modules.tagger import load_master, expand_inputs, main as tagger
+        
+        model = os.path.join(SEM_DATA_DIR, "non-regression", "models", "model")
+        master = u"""<master>
+    <pipeline><wapiti_label model="%s" field="tag" /></pipeline>
+    <options>
+        <file format="conll" fields="word" word_field="word" />
+        <export format="conll" />
+    </options>
+</master>""" %model
+        work_dir = tempfile.mkdtemp()
+        try:
+            input_dir = os.path.join(work_dir, "input")
+            os.makedirs(os.path.join(input_dir, "sub"))
+            for name in ("a.conll", "b.conll", os.path.join("sub", "c.conll")):
+                with codecs.open(os.path.join(input_dir, name), "w", "utf-8") as output_stream:
+                    output_stream.write(u"Ceci\nest\nun\ntest\n.\n\nceci\nest\nun\ntest\n")
+            with open(os.path.join(input_dir, "broken.conll"), "wb") as output_stream:
+                output_stream.write(b"not \xe9 utf-8\n") # fails to be read
+            manifest = os.path.join(work_dir, "manifest.txt")
+            with codecs.open(manifest, "w", "utf-8") as output_stream:
+                output_stream.write(u"%s\n\n%s\n" %(os.path.join(input_dir, "sub"), os.path.join(input_dir, "a.conll")))
+            
+            files = [os.path.join(input_dir, name) for name in ("a.conll", "b.conll", "broken.conll")]
+            self.assertEquals(expand_inputs([input_dir]), files)
+            self.assertEquals(expand_inputs([input_dir], recursive=True), files + [os.path.join(input_dir, "sub", "c.conll")])
+            self.assertEquals(expand_inputs([os.path.join(input_dir, "[ab].conll")]), files[:2])
+            self.assertEquals(expand_inputs([], manifest=manifest), [os.path.join(input_dir, "sub", "c.conll"), files[0]])
+            
+            pipeline, options, exporter, couples = load_master(master)
+            args = Namespace(infile=[input_dir], output_directory=os.path.join(work_dir, "output"), pipeline=pipeline, options=options, exporter=exporter, couples=couples)
+            report = tagger(args)
+            self.assertEquals((report[u"documents"], report[u"tokens"], report[u"failed"]), (2, 18, files[2:]))
+            self.assertEquals(sorted(os.listdir(args.output_directory)), [u"a.conll.conll", u"b.conll.conll"])
+            
+            args.infile = files[0]
+            self.assertEquals(tagger(args).corpus.sentences[0][4][u"tag"], u"O")
+            
+            shutil.rmtree(args.output_directory)
+            args.infile, args.jobs, args.max_documents = [input_dir], 2, 1
+            report = tagger(args)
+            self.assertEquals((report[u"documents"], report[u"tokens"], report[u"failed"]), (2, 18, files[2:]))
+            self.assertEquals(sorted(os.listdir(args.output_directory)), [u"a.conll.conll", u"b.conll.conll"])
+        finally:
+            shutil.rmtree(work_dir)
+    
+    def test_tagger_stream(self):
+        import io
+        from sem.modules.pipeline import Pipeline
+        from sem.modules.sem_module import SEMModule
+        from sem.modules.tagger import load_master, read_chunks, tag_file, tag_stream
+        
+        self.assertEquals(list(read_chunks(io.StringIO(u"a b\nc\n\nd\n\ne f g\nh\n"), chunk_size=4)), [u"a b\n", u"c\n\n", u"d\n\n", u"e f g\nh\n"])
+        
+        class Nothing(SEMModule): # needs the whole document
+            def process_document(self, document, **kwargs):
+                pass
+        
+        model = os.path.join(SEM_DATA_DIR, "non-regression", "models", "model")
+        work_dir = tempfile.mkdtemp()
+        try:
+            infile = os.path.join(work_dir, "input.txt")
+            with codecs.open(infile, "w", "utf-8") as output_stream:
+                output_stream.write(u"Ceci est un test. Ceci est un test.\n\nUn test.\n\n\nCeci est\nun test.\n" * 5)
+            for export_format in (u"conll", u"brat"):
+                master = u"""<master>
+    <pipeline><segmentation tokeniser="fr" /><annotate annotator="wapiti" location="%s" field="POS" /><wapiti_label model="%s" field="NER" /><clean to-keep="word,POS,NER" /></pipeline>
+    <options><file format="text" /><export format="%s" pos="POS" ner="NER" /></options>
+</master>""" %(model, model, export_format)
+                pipeline, options, exporter, couples = load_master(master)
+                self.assertFalse(any(pipe.document_scope for pipe in pipeline.pipes))
+                for pipes in (pipeline.pipes, pipeline.pipes + [Nothing()]):
+                    outputs = []
+                    for streamed in (False, True):
+                        output_directory = os.path.join(work_dir, str(streamed))
+                        os.makedirs(output_directory)
+                        if streamed:
+                            tag_stream(infile, Pipeline(pipes), options, exporter, couples, output_directory=output_directory, chunk_size=20)
+                        else:
+                            tag_file(infile, Pipeline(pipes), options, exporter, couples, output_directory=output_directory)
+                        outputs.append(dict((name, codecs.open(os.path.join(output_directory, name), "rU", "utf-8").read()) for name in os.listdir(output_directory)))
+                        shutil.rmtree(output_directory)
+                    self.assertEquals(outputs[1], outputs[0])
+                    self.assertTrue(all(outputs[0].values()))
+        finally:
+            shutil.rmtree(work_dir)
+    
+    def test_staged_pipeline(self):
+        from sem.modules.pipeline import Pipeline, StagedPipeline
+        from sem.modules.sem_module import SEMModule
+        
+        class Upper(SEMModule):
+            barrier = False
+            def process_document(self, document, **kwargs):
+                state = self.begin_document(document)
+                self.process_sentences(document, document.corpus.sentences, state)
+                self.end_document(document, state)
+            def begin_document(self, document, **kwargs):
+                document.corpus.fields.append(u"upper")
+            def process_sentences(self, document, sentences, state, **kwargs):
+                for sentence in sentences:
+                    for token in sentence:
+                        if token[u"word"] == u"error":
+                            raise ValueError(u"error in sentence")
+                        token[u"upper"] = token[u"word"].upper()
+        
+        model = os.path.join(SEM_DATA_DIR, "non-regression", "models", "model")
+        sentences = [[u"Ceci", u"est", u"un", u"test", u"."], [u"ceci", u"est", u"un", u"test"], [u"Test", u"."]] * 7
+        pipes = [Upper(), AnnotateModule(u"wapiti", u"annotated", location=model), WapitiLabelModule(model, u"tag", annotation_fields=[u"word"]), CleanModule(to_keep=[u"word", u"annotated", u"tag"])] # clean is a barrier
+        self.assertFalse(pipes[1].barrier)
+        documents = []
+        for pipeline in (Pipeline(pipes), StagedPipeline(pipes, batch_size=2, queue_size=1)):
+            document = Document("document", u"Ceci est un test.")
+            document._corpus = Corpus([u"word"], sentences=[[{u"word":word} for word in sentence] for sentence in sentences])
+            pipeline.process_document(document)
+            documents.append(document)
+        self.assertEquals(documents[0].corpus.fields, [u"word", u"annotated", u"tag"])
+        self.assertEquals(documents[1].corpus.fields, documents[0].corpus.fields)
+        self.assertEquals(documents[1].corpus.sentences, documents[0].corpus.sentences)
+        for name in (u"annotated", u"tag"):
+            self.assertEquals([(tag.lb, tag.ub, tag.value) for tag in documents[1].annotation(name)], [(tag.lb, tag.ub, tag.value) for tag in documents[0].annotation(name)])
+        
+        document._corpus = Corpus([u"word"], sentences=[[{u"word":word} for word in sentence] for sentence in sentences * 10 + [[u"error"]]])
+        self.assertRaises(ValueError, StagedPipeline(pipes, batch_size=2, queue_size=1).process_document, document)
+        
+        # no barrier: more batches than the queues hold are not to block
+        pipes = [Upper(), AnnotateModule(u"wapiti", u"annotated", location=model)]
+        document = Document("document", u"Ceci est un test.")
+        document._corpus = Corpus([u"word"], sentences=[[{u"word":word} for word in sentence] for sentence in sentences * 10])
+        thread = threading.Thread(target=StagedPipeline(pipes, batch_size=1, queue_size=1).process_document, args=(document,))
+        thread.daemon = True
+        thread.start()
+        thread.join(60)
+        self.assertFalse(thread.is_alive())
+        self.assertEquals(len(document.annotation(u"annotated")), sum(len(sentence) for sentence in sentences * 10))
+        
+        document = Document("empty", u"")
+        document._corpus = Corpus([u"word"], sentences=[])
+        StagedPipeline([WapitiLabelModule(model, u"tag", annotation_fields=[u"word"])]).process_document(document)
+        self.assertEquals(document.corpus.fields, [u"word", u"tag"])
+    
+    def test_parallel_pipeline(self):
+        from sem.modules.pipeline import ParallelPipeline
+        
+        def square(pipeline, x):
+            if x == 3:
+                raise ValueError(u"three")
+            if x == 5:
+                return lambda: x # cannot be pickled
+            return x * x
+        
+        for ordered in (True, False):
+            with ParallelPipeline(None, jobs=2, function=square, ordered=ordered, max_documents=3) as parallel:
+                results = list(parallel.imap(range(10)))
+                if ordered:
+                    self.assertEquals([item for item, _, _ in results], range(10))
+                self.assertEquals(sorted((item, result) for item, result, error in results if error is None), [(x, x * x) for x in range(10) if x not in (3, 5)])
+                self.assertEquals(sorted(item for item, _, error in results if error is not None), [3, 5])
+                self.assertTrue(u"ValueError: three" in dict((item, error) for item, _, error in results)[3])
+                if parallel.parallel:
+                    self.assertTrue(parallel.recycled >= 2)
+                self.assertRaises(RuntimeError, parallel.map, range(5))
+                self.assertEquals(parallel.map([1, 2]), [1, 4])
+        
+        def kill(pipeline, x):
+            if x == 0:
+                os._exit(1)
+            return x
+        
+        with ParallelPipeline(None, jobs=2, function=kill, queue_size=2) as parallel:
+            if parallel.parallel:
+                results = list(parallel.imap(range(4)))
+                self.assertTrue(results[0][2].endswith(u"exited with code 1"))
+                for item, result, error in results[1:]: # the items sent to the same worker fail as well
+                    self.assertTrue(result == item or error == results[0][2])
+                self.assertEquals(parallel.map([1, 2]), [1, 2])
+    
+    def test_serve(self):
+        import httplib, json, socket
+        from sem.modules.serve import Annotator, Service, HTTPServer, UnixHTTPServer
+        
+        class UnixHTTPConnection(httplib.HTTPConnection):
+            def __init__(self, path):
+                httplib.HTTPConnection.__init__(self, u"localhost")
+                self.path = path
+            
+            def connect(self):
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.connect(self.path)
+        
+        def request(connection, method, url, body=None):
+            connection.request(method, url, body)
+            response = connection.getresponse()
+            data = response.read()
+            connection.close()
+            return response.status, response.getheader("content-type"), data
+        
+        model = os.path.join(SEM_DATA_DIR, "non-regression", "models", "model")
+        master = u"""<master>
+    <pipeline><segmentation tokeniser="fr" /><wapiti_label model="%s" field="NER" /></pipeline>
+    <options><file format="text" /><export format="conll" ner="NER" /></options>
+</master>""" %model
+        work_dir = tempfile.mkdtemp()
+        service = Service([Annotator(master, name=u"test", jobs=2, batch_delay=0.05)], timeout=60, max_requests=1)
+        servers = [HTTPServer((u"127.0.0.1", 0), service), UnixHTTPServer(os.path.join(work_dir, u"sem.sock"), service)]
+        threads = [threading.Thread(target=server.serve_forever) for server in servers]
+        for thread in threads:
+            thread.start()
+        try:
+            connections = [lambda: httplib.HTTPConnection(u"127.0.0.1", servers[0].server_address[1]), lambda: UnixHTTPConnection(servers[1].server_address)]
+            for connection in connections:
+                status, _, data = request(connection(), "GET", "/health")
+                self.assertEquals(status, 200)
+                self.assertEquals(json.loads(data)[u"pipelines"][0][u"name"], u"test")
+                
+                status, content_type, data = request(connection(), "POST", "/annotate", u"Ceci est un test.".encode("utf-8"))
+                self.assertEquals((status, content_type), (200, "text/plain; charset=utf-8"))
+                self.assertEquals([line.split(u"\t")[0] for line in data.decode("utf-8").split(u"\n") if line], [u"Ceci", u"est", u"un", u"test", u"."])
+                
+                status, content_type, data = request(connection(), "POST", "/annotate?format=brat&name=test.txt", u"Ceci est un test.".encode("utf-8"))
+                self.assertEquals(status, 200)
+                
+                self.assertEquals(request(connection(), "POST", "/annotate?pipeline=other", "test")[0], 404)
+                self.assertEquals(request(connection(), "POST", "/annotate?format=unknown", "test")[0], 400)
+                self.assertEquals(request(connection(), "POST", "/annotate?timeout=none", "test")[0], 400)
+                self.assertEquals(request(connection(), "GET", "/other")[0], 404)
+            
+            self.assertEquals(request(connections[0](), "POST", "/annotate?timeout=0", "test")[0], 504)
+            
+            jobs = [service.annotators[0].submit(u"Ceci est un test n\u00b0%i." %i) for i in range(5)]
+            for job in jobs:
+                self.assertTrue(job.done.wait(60))
+                self.assertEquals(job.error, None)
+            self.assertEquals(len(set(job.result for job in jobs)), 5)
+            
+            slots = service._slots
+            slots.acquire() # the only request allowed at once
+            try:
+                status, _, data = request(connections[0](), "POST", "/annotate", "test")
+                self.assertEquals(status, 503)
+            finally:
+                slots.release()
+            health = service.health()
+            self.assertEquals((health[u"rejected"], health[u"pipelines"][0][u"failed"]), (1, 0))
+        finally:
+            for server, thread in zip(servers, threads):
+                server.shutdown()
+                server.server_close()
+                thread.join()
+            service.close()
+            shutil.rmtree(work_dir)
+    
+    def test_serve_dispatch(self):
+        from sem.modules.serve import Annotator
+        
+        def slowly(pipeline, request, options, couples):
+            start = time.time()
+            time.sleep(0.5)
+            return request[0], start, time.time()
+        
+        master = u"""<master>
+    <pipeline><segmentation tokeniser="fr" /></pipeline>
+    <options><file format="text" /><export format="conll" /></options>
+</master>"""
+        annotator = Annotator(master, name=u"slow", jobs=4, function=slowly)
+        try:
+            jobs = []
+            for i in range(4):
+                jobs.append(annotator.submit(unicode(i)))
+                time.sleep(0.05)
+            for job in jobs:
+                self.assertTrue(job.done.wait(60))
+            self.assertEquals([job.result[0] for job in jobs], [u"0", u"1", u"2", u"3"])
+            # documents are sent while previous ones are annotated
+            self.assertLess(max(job.result[1] for job in jobs), min(job.result[2] for job in jobs))
+        finally:
+            annotator.close()
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -33,17 +33,25 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import atexit
 import logging
 import os.path
+import Queue
 import subprocess
+import sys
+import tempfile
+import threading
 import time
 import tarfile
 
+from multiprocessing.pool import ThreadPool
+
 from sem.logger import default_handler
 
 from sem import SEM_HOME, SEM_EXT_DIR
+from sem import libwapiti
 
-from sem.misc import check_model_available
+from sem.misc import check_model_available, shard
 
 wapiti_logger = logging.getLogger("sem.wapiti")
 wapiti_logger.addHandler(default_handler)
@@ -60,9 +68,10 @@ def command_name():
     
     return __command_name
 
-def train(inputfile, pattern=None, output=None, algorithm=None, nthreads=1, maxiter=None, rho1=None, rho2=None, model=None, compact=False):
+def train(inputfile, pattern=None, output=None, algorithm=None, nthreads=1, maxiter=None, rho1=None, rho2=None, model=None, compact=False, stderr=None):
     """
-    The train command of Wapiti.
+    The train command of Wapiti. stderr is where Wapiti writes its
+    progress, the error output of the caller by default.
     """
     
     cmd = [command_name(), "train"]
@@ -78,13 +87,13 @@ def train(inputfile, pattern=None, output=None, algorithm=None, nthreads=1, maxi
     cmd.append(str(inputfile))
     if output is not None: cmd.append(str(output))
     
-    exit_status = subprocess.call(cmd)
+    exit_status = subprocess.call(cmd, stderr=stderr)
     
     if exit_status != 0:
         if output is None: output = "*stdout"
         raise RuntimeError("Wapiti exited with status %i.\n%10s: %s\n%10s: %s\n%10s: %s" %(exit_status, "input", inputfile, "pattern", pattern, "output", output))
 
-def label(input, model, output=None, only_labels=False, nbest=None):
+def label(input, model, output=None, only_labels=False, nbest=None, stderr=None):
     """
     The label command of Wapiti.
     """
@@ -97,33 +106,348 @@ def label(input, model, output=None, only_labels=False, nbest=None):
     cmd.append(input)
     if output is not None: cmd.append(str(output))
     
-    exit_status = subprocess.call(cmd)
+    exit_status = subprocess.call(cmd, stderr=stderr)
     
     if exit_status != 0:
         if output is None: output = "*stdout"
         raise RuntimeError("%s exited with status %i.\n\tmodel: %s\n\tinput: %s\n\toutput: %s" %(command_name(), exit_status, model, input, output))
 
-def label_corpus(corpus, model, field, encoding):
-    corpus_unicode = unicode(corpus).encode(encoding)
+_END = object() # marks the end of the sentences in label_stream
+
+def _put(queue, item, stop):
+    """
+    Puts item in queue, giving up if stop is set while waiting.
+    """
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return
+        except Queue.Full:
+            pass
+
+def _feed(process, sentences, formatter, encoding, queue, stop, error):
+    """
+    Writes sentences to the standard input of process one by one. Every
+    sentence is put in queue, along with its number of lines, before it is
+    written, so that labels can be matched with it.
+    """
+    try:
+        for sentence in sentences:
+            if stop.is_set():
+                break
+            sentence = list(sentence) # readers may reuse their lists
+            lines = formatter(sentence)
+            _put(queue, (sentence, len(lines)), stop)
+            if lines:
+                process.stdin.write(u"".join([line + u"\n" for line in lines]).encode(encoding) + b"\n")
+    except IOError: # Wapiti died, reading its output will tell
+        pass
+    except Exception:
+        error.append(sys.exc_info())
+    finally:
+        try:
+            process.stdin.close()
+        except IOError:
+            pass
+        _put(queue, _END, stop)
+
+def label_stream(sentences, model, encoding="utf-8", formatter=None, buffer_size=256):
+    """
+    Labels sentences with a new Wapiti process without building the whole
+    input or output in memory. Yields (sentence, labels) pairs in the same
+    order as sentences, sentence being a shallow copy of the original one.
     
-    cmd = [command_name(), "label", "-m", model, "--label"]
+    A thread writes sentences to Wapiti as they are read from the iterable
+    while their labels are read back, at most buffer_size sentences are
+    waiting for their labels at any time. Memory usage therefore does not
+    depend on the number of sentences, as long as they are read lazily
+    (see sem.IO.columnIO.Reader).
+    formatter gives the lines of a sentence (one per token, columns
+    separated by tabulations), by default sentences are lists of lines.
+    """
+    model = check_model_available(model, logger=wapiti_logger)
+    if formatter is None:
+        formatter = lambda sentence: sentence
     
-    wapiti_process     = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    w_stdout, w_stderr = wapiti_process.communicate(input=corpus_unicode)
+    stderr = tempfile.TemporaryFile()
+    process = subprocess.Popen([command_name(), "label", "-m", model, "--label"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr)
+    queue = Queue.Queue(maxsize=buffer_size)
+    stop = threading.Event()
+    error = []
+    writer = threading.Thread(target=_feed, args=(process, sentences, formatter, encoding, queue, stop, error))
+    writer.daemon = True
+    writer.start()
     
-    i = 0
-    j = 0
+    try:
+        while True:
+            item = queue.get()
+            if item is _END:
+                break
+            sentence, length = item
+            labels = []
+            while len(labels) < length:
+                line = process.stdout.readline()
+                if line == "":
+                    process.wait()
+                    stderr.seek(0)
+                    for error_part in [line for line in stderr.read().decode(encoding, "replace").split(u"\n") if line.strip() != u""]:
+                        wapiti_logger.error(error_part)
+                    raise RuntimeError("%s exited with status %s" %(command_name(), process.returncode))
+                line = line.strip()
+                if line:
+                    labels.append(line.decode(encoding))
+            yield sentence, labels
+        if error:
+            raise error[0][0], error[0][1], error[0][2]
+        process.wait()
+    finally:
+        stop.set()
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        stderr.close()
+        writer.join()
+
+def label_corpus(corpus, model, field, encoding):
+    fmt = u"\t".join([u"%%(%s)s" %f for f in corpus.fields])
     corpus.fields.append(field)
-    for element in w_stdout.split("\n"):
-        element = element.strip()
-        if "" == element:
-            i += 1
-            j  = 0
-        else:
-            corpus.sentences[i][j][field] = element
-            j += 1
+    for sentence, labels in label_stream(corpus.sentences, model, encoding=encoding, formatter=lambda sentence: [fmt %token for token in sentence]):
+        for token, label in zip(sentence, labels):
+            token[field] = label
+
+class Worker(object):
+    """
+    A long-lived "wapiti label" process, the model is loaded once and
+    sentences are labeled as they are written to its standard input.
+    
+    The protocol relies on Wapiti reading its input sentence by sentence:
+    sentences are sent as one line per token followed by an empty line and,
+    for every sentence it reads, Wapiti writes one label per token followed
+    by an empty line and flushes its output. The labels of a batch of n
+    sentences are therefore the n next blocks of output, which is how they
+    are split back per document.
+    """
+    
+    def __init__(self, model, encoding="utf-8"):
+        self._model = model
+        self._encoding = encoding
+        self._process = None
+        self._pid = None
+        self._stderr = None
+        self.start()
+    
+    def start(self):
+        """
+        Starts the Wapiti process, stopping the current one if any.
+        """
+        self.close()
+        self._pid = os.getpid()
+        self._stderr = tempfile.TemporaryFile() # a pipe could fill up and block Wapiti
+        self._process = subprocess.Popen([command_name(), "label", "-m", self._model, "--label"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self._stderr, close_fds=True)
+    
+    def is_alive(self):
+        # after a fork, the process belongs to the parent
+        return self._process is not None and self._pid == os.getpid() and self._process.poll() is None
+    
+    def errors(self):
+        """
+        Returns what the Wapiti process wrote on its error output.
+        """
+        if self._stderr is None:
+            return u""
+        self._stderr.seek(0)
+        return self._stderr.read().decode(self._encoding, "replace")
+    
+    def close(self):
+        if self._process is not None:
+            if self._pid != os.getpid():
+                # inherited through a fork (see sem.modules.pipeline.ParallelPipeline):
+                # only closing our copy of its pipes, the parent still uses it.
+                self._process.stdin.close()
+            elif self._process.poll() is None:
+                try:
+                    self._process.stdin.close()
+                except IOError:
+                    pass
+                # forked processes may hold a copy of stdin, Wapiti would
+                # then never read its end.
+                self._process.terminate()
+                self._process.wait()
+            self._process.stdout.close()
+            self._process = None
+        if self._stderr is not None:
+            self._stderr.close()
+            self._stderr = None
+    
+    def _write(self, data):
+        try:
+            self._process.stdin.write(data)
+            self._process.stdin.flush()
+        except IOError: # Wapiti died, reading its output will tell
+            pass
+    
+    def label(self, sentences):
+        """
+        Returns the labels of every sentence, a sentence being the list of
+        its lines (one per token, columns separated by tabulations).
+        Raises a RuntimeError if the process dies or does not answer as
+        expected, it then has to be restarted.
+        """
+        data = u"".join(u"".join([line + u"\n" for line in sentence]) + u"\n" for sentence in sentences if sentence).encode(self._encoding)
+        # writing in another thread, as Wapiti blocks writing labels once
+        # its output pipe is full, which would block us writing sentences.
+        writer = threading.Thread(target=self._write, args=(data,))
+        writer.daemon = True
+        writer.start()
+        
+        results = []
+        stdout = self._process.stdout
+        for sentence in sentences:
+            labels = []
+            while len(sentence) > 0:
+                line = stdout.readline()
+                if line == "":
+                    writer.join()
+                    self._process.wait()
+                    raise RuntimeError("%s exited with status %s" %(command_name(), self._process.returncode))
+                line = line.strip()
+                if line:
+                    labels.append(line.decode(self._encoding))
+                elif labels:
+                    break
+            if len(labels) != len(sentence):
+                raise RuntimeError("%s returned %i labels for %i tokens" %(command_name(), len(labels), len(sentence)))
+            results.append(labels)
+        writer.join()
+        
+        return results
 
-def label_document(document, model, field, encoding, annotation_name=None, annotation_fields=None):
+class WorkerPool(object):
+    """
+    A pool of Wapiti workers labeling with the same model. Every batch of
+    sentences is sent to an idle worker, so that up to size batches are
+    labeled at the same time.
+    A worker that died is restarted transparently and its batch is sent
+    again once. If it fails again, the error is raised.
+    """
+    
+    def __init__(self, model, size=1, encoding="utf-8"):
+        model = check_model_available(model, logger=wapiti_logger)
+        self._model = model
+        self._encoding = encoding
+        self._workers = []
+        self._idle = Queue.Queue()
+        self._lock = threading.Lock()
+        self.resize(size)
+    
+    @property
+    def model(self):
+        return self._model
+    
+    @property
+    def size(self):
+        return len(self._workers)
+    
+    def resize(self, size):
+        """
+        Adds workers until there are at least size of them.
+        """
+        with self._lock:
+            while len(self._workers) < size:
+                worker = Worker(self._model, encoding=self._encoding)
+                self._workers.append(worker)
+                self._idle.put(worker)
+    
+    def label(self, sentences):
+        """
+        Returns the labels of every sentence (see Worker.label).
+        """
+        worker = self._idle.get()
+        try:
+            for attempt in (1, 2):
+                if not worker.is_alive():
+                    worker.start()
+                try:
+                    return worker.label(sentences)
+                except RuntimeError, re:
+                    for error_part in [line for line in worker.errors().split(u"\n") if line.strip() != u""]:
+                        wapiti_logger.error(error_part)
+                    worker.start()
+                    if attempt == 2:
+                        raise
+                    wapiti_logger.warn("restarted Wapiti worker for %s: %s", self._model, re)
+        finally:
+            self._idle.put(worker)
+    
+    def label_many(self, batches):
+        """
+        Labels every batch of sentences, using all workers at once.
+        Results are in the same order as batches.
+        """
+        if self.size == 1 or len(batches) <= 1:
+            return [self.label(batch) for batch in batches]
+        threads = ThreadPool(min(self.size, len(batches)))
+        try:
+            return threads.map(self.label, batches)
+        finally:
+            threads.close()
+            threads.join()
+    
+    def close(self):
+        with self._lock:
+            for worker in self._workers:
+                worker.close()
+            del self._workers[:]
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(model, size=1, encoding="utf-8"):
+    """
+    Returns the pool of Wapiti workers of model, which is created the
+    first time and has at least size workers. Pools are shared, so that
+    a model is loaded by as few processes as possible, and closed at exit.
+    """
+    key = (os.path.abspath(model), encoding)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = WorkerPool(model, size=size, encoding=encoding)
+            _pools[key] = pool
+    pool.resize(size)
+    return pool
+
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+atexit.register(close_pools)
+
+def sentence_labeler(model, encoding="utf-8", pool=None):
+    """
+    Returns a function labeling a list of sentences (see Worker.label),
+    which may be called from many threads. The Wapiti library is used if
+    it is available and pool is None, the workers of pool (the shared pool
+    of model by default) otherwise.
+    """
+    if pool is None and libwapiti.available():
+        return libwapiti.get_model(check_model_available(model, logger=wapiti_logger), encoding=encoding).label
+    return (pool or get_pool(model, encoding=encoding)).label
+
+def label_document(document, model, field, encoding, annotation_name=None, annotation_fields=None, pool=None, shards=1, min_shard_size=100):
+    """
+    Labels document with a Wapiti model. If pool is given, the workers of
+    the pool are used. Otherwise, the Wapiti library is used if it is
+    available (see sem.libwapiti), a new Wapiti process if it is not.
+    
+    If shards is more than 1, sentences are split in at most shards
+    contiguous shards of at least min_shard_size sentences, labeled at the
+    same time by as many threads (Wapiti library) or Wapiti processes (from
+    pool if given, from a temporary pool otherwise).
+    """
     if annotation_fields is None:
         fields = document.corpus.fields
     else:
@@ -132,38 +456,47 @@ def label_document(document, model, field, encoding, annotation_name=None, annot
     if annotation_name is None:
         annotation_name = unicode(field)
     
-    check_model_available(model, logger=wapiti_logger)
-    
-    corpus_unicode = document.corpus.unicode(fields).encode(encoding)
-    
-    cmd = [command_name(), "label", "-m", model, "--label"]
-    
-    wapiti_process     = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    w_stdout, w_stderr = wapiti_process.communicate(input=corpus_unicode)
+    fmt = u"\t".join([u"%%(%s)s" %f for f in fields])
+    parts = shard(document.corpus.sentences, shards, min_shard_size)
+    use_library = (pool is None and libwapiti.available())
+    if use_library or pool is not None or len(parts) > 1:
+        parts = [[[fmt %token for token in sentence] for sentence in part] for part in parts]
+        if use_library:
+            library_model = libwapiti.get_model(check_model_available(model, logger=wapiti_logger), encoding=encoding)
+            if len(parts) > 1:
+                threads = ThreadPool(len(parts))
+                try:
+                    labels = threads.map(library_model.label, parts)
+                finally:
+                    threads.close()
+            else:
+                labels = [library_model.label(parts[0])]
+        else:
+            temporary = (pool is None)
+            if temporary:
+                pool = WorkerPool(model, size=len(parts), encoding=encoding)
+            else:
+                pool.resize(len(parts))
+            try:
+                labels = pool.label_many(parts)
+            finally:
+                if temporary:
+                    pool.close()
+        tags = [t for part in labels for t in part if t]
+        document.corpus.fields.append(field)
+        document.add_annotation_from_tags(tags, field, annotation_name)
+        return
     
+    tags = []
     try:
-        if wapiti_process.returncode != 0:
-            raise RuntimeError("%s exited with status %i" %(command_name(), wapiti_process.returncode))
+        for sentence, labels in label_stream(document.corpus.sentences, model, encoding=encoding, formatter=lambda sentence: [fmt %token for token in sentence]):
+            for token, label in zip(sentence, labels):
+                token[field] = label
+            if labels:
+                tags.append(labels)
     except RuntimeError, re:
-        for error_part in [line for line in w_stderr.split(u"\n") if line.strip() != ""]:
-            wapiti_logger.error(error_part)
         wapiti_logger.exception(re)
         raise
     
-    i    = 0
-    j    = 0
-    tags = [[]]
     document.corpus.fields.append(field)
-    for element in w_stdout.split("\n"):
-        element = element.strip()
-        if "" == element:
-            if len(tags[-1]) > 0:
-                tags.append([])
-                i += 1
-                j  = 0
-        else:
-            tags[-1].append(element)
-            j += 1
-    
-    tags = [t for t in tags if t]
     document.add_annotation_from_tags(tags, field, annotation_name)
@@ -109,6 +109,31 @@ else:
     print wapiti_exec, "already exists, not compiling."
     print
 
+#
+# compiling the Wapiti library (optional, see sem/libwapiti.py)
+#
+
+os.chdir(cwd)
+wapiti_dir = os.path.join(ext_dir, "wapiti")
+wapiti_lib = os.path.join(wapiti_dir, ("libwapiti.dll" if ON_WINDOWS else "libwapiti.so"))
+if not os.path.exists(wapiti_lib):
+    wapiti_src = os.path.join(wapiti_dir, "src")
+    sources = [os.path.join(wapiti_src, f) for f in sorted(os.listdir(wapiti_src)) if f.endswith(".c") and f != "wapiti.c"]
+    # Wapiti calls exit on errors, libwapiti.c turns it into an error code.
+    cmd = [os.environ.get("CC", "gcc"), "-shared", "-DNDEBUG", "-Dexit=sem_wapiti_exit", "-std=c99", "-O3", "-I", wapiti_src, "-o", wapiti_lib]
+    if not ON_WINDOWS:
+        cmd.append("-fPIC")
+    cmd.extend(sources + [os.path.join(ext_dir, "libwapiti.c"), "-lm", "-lpthread"])
+    try:
+        exit_status = subprocess.call(cmd)
+    except OSError:
+        exit_status = -1
+    if exit_status == 0:
+        print "Wapiti library compilation successful!"
+    else:
+        print "Could not compile the Wapiti library: error code %i. Wapiti will be run as a separate process." %exit_status
+    print
+
 #
 # preparing SEM data
 #